@@ -200,6 +200,23 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 
+# tasks are routed to separate queues by kind and size (see transfer_app/routing.py), 
+# each with its own workers.  Workers take one task at a time, so a long task does 
+# not hold others back, and take the higher-priority tasks in their queue first.
+CELERY_TASK_ROUTES = ('transfer_app.routing.route_task',)
+CELERY_TASK_DEFAULT_QUEUE = 'launch'
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+# (the priorities in routing.py are these steps, the redis broker's default)
+CELERY_BROKER_TRANSPORT_OPTIONS = {'priority_steps': [0, 3, 6, 9]}
+
+# periodic tasks, run by celery beat:
+CELERY_BEAT_SCHEDULE = {
+    'reap': {
+        'task': 'reap',
+        'schedule': float(CONFIG_PARAMS.get('reaper_interval_seconds', 600))
+    }
+}
+
 # if using gmail, need to establish credentials
 # can be blank
 EMAIL_CREDENTIALS_FILE = '{{email_credentials_json}}'
@@ -24,7 +24,9 @@ export CELERY=$(which celery)
 mkdir -p $LOGDIR
 touch $LOGDIR/redis.log
 touch $LOGDIR/celery_beat.log
-touch $LOGDIR/celery_worker.log
+touch $LOGDIR/celery_worker_fast.log
+touch $LOGDIR/celery_worker_launch.log
+touch $LOGDIR/celery_worker_maintenance.log
 
 # Fill-out and copy files for supervisor-managed processes:
 python3 helpers/fill_supervisor_templates.py \
@@ -57,4 +59,10 @@ python3 helpers/fill_javascript.py
 printf "\n\n\nCreate a super user:"
 python3 manage.py createsuperuser
 
-gunicorn cccb_transfers.wsgi:application --bind=unix:/host_mount/dev.sock
+# Each open page holds a stream of transfer events (see transfer_app/events.py) for
+# minutes at a time.  The streams get their own application server, so that they cannot
+# tie up the workers serving every other request.  Its gevent worker holds up to 1000 open
+# streams (i.e. open pages) at once; nginx sends /transfers/events/ to its socket 
+# (see docs/setup_notes.md).
+gunicorn cccb_transfers.wsgi:application --bind=unix:/host_mount/events.sock --worker-class=gevent --worker-connections=1000 &
+gunicorn cccb_transfers.wsgi:application --bind=unix:/host_mount/dev.sock --workers=4
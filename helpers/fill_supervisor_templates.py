@@ -1,7 +1,21 @@
 import os
 import sys
+import configparser
 from jinja2 import Environment, FileSystemLoader
 
+# the celery queues, as in transfer_app/routing.py.  Each gets its own worker program.
+CELERY_QUEUES = ['fast', 'launch', 'maintenance']
+
+def get_worker_queues():
+    '''
+    Returns a list of dicts giving the name and the number of worker processes 
+    for each celery queue, which are set in the general config
+    '''
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.environ['APP_ROOT'], 'config', 'general.cfg'))
+    defaults = config.defaults()
+    return [{'name': x, 'concurrency': defaults.get('celery_%s_concurrency' % x, '1')} for x in CELERY_QUEUES]
+
 def fill_template(template_path, destination_dir):
     basename = os.path.basename(template_path)
     env = Environment(loader=FileSystemLoader(os.path.dirname(template_path)))
@@ -11,6 +25,7 @@ def fill_template(template_path, destination_dir):
     params['celery'] = os.environ['CELERY']
     params['logdir'] = os.environ['LOGDIR']
     params['app_root'] = os.environ['APP_ROOT']
+    params['worker_queues'] = get_worker_queues()
 
     with open(os.path.join(destination_dir, basename), 'w') as outfile:
         outfile.write(template.render(params))
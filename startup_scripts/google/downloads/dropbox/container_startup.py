@@ -3,6 +3,13 @@
 import os
 import sys
 import io
+import time
+import queue
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import json
+import shutil
 import subprocess
 import argparse
 import dropbox
@@ -18,9 +25,22 @@ from apiclient.discovery import build
 WORKING_DIR = '/workspace'
 DEFAULT_TIMEOUT = 60
 DEFAULT_CHUNK_SIZE = 100*1024*1024 # dropbox says <150MB per chunk
+DEFAULT_QUEUE_DEPTH = 2 # number of chunks held in memory ahead of the Dropbox upload when streaming
+MAX_CHUNK_RETRIES = 5
+DEFAULT_SLICES = 4 # number of concurrent range requests when reading from the bucket
+DEFAULT_SLICE_SIZE_MB = 64
+MAX_SLICE_RETRIES = 5
+DEFAULT_CONCURRENCY = 4 # number of transfers run at once when given a manifest
+DEFAULT_IDLE_TIMEOUT = 600 # seconds a pool worker waits for work before removing itself
+POLL_INTERVAL = 10 # seconds between requests for work when idle
 HOSTNAME_REQUEST_URL = 'http://metadata/computeMetadata/v1/instance/hostname'
+PREEMPTED_REQUEST_URL = 'http://metadata/computeMetadata/v1/instance/preempted?wait_for_change=true'
+DEFAULT_CHECKPOINT_INTERVAL = 60 # seconds between checkpoints sent to the main application (Spot VMs only)
 GOOGLE_BUCKET_PREFIX = 'gs://'
 
+# holds the per-thread storage client when downloading slices
+thread_local = threading.local()
+
 def create_logger():
 	"""
 	Creates a logfile
@@ -31,6 +51,16 @@ def create_logger():
 	logging.basicConfig(filename=logfile, level=logging.INFO, format="%(asctime)s:%(levelname)s:%(message)s")
 	return logfile
 
+def get_encrypted_token(params):
+	'''
+	Returns the token which identifies the VM as a 'known' sender to the main application
+	'''
+	token = params['token']
+	obj=DES.new(params['enc_key'], DES.MODE_ECB)
+	enc_token = obj.encrypt(token)
+	return base64.encodestring(enc_token)
+
+
 def notify_master(params, error=False):
 	'''
 	This calls back to the head machine to let it know the work is finished.
@@ -41,11 +71,7 @@ def notify_master(params, error=False):
 	d = {}
 
 	# prepare the token which identifies the VM as a 'known' sender
-	token = params['token']
-	obj=DES.new(params['enc_key'], DES.MODE_ECB)
-	enc_token = obj.encrypt(token)
-	b64_str = base64.encodestring(enc_token)
-	d['token'] = b64_str
+	d['token'] = get_encrypted_token(params)
 
 	# Other required params to return:
 	d['transfer_pk'] = params['transfer_pk']
@@ -56,24 +82,352 @@ def notify_master(params, error=False):
 	logging.info('Response text: %s' % response.text)
 
 
-def download_to_disk(params):
+class Checkpointer(object):
 	'''
-	Downloads the file from the bucket to the local disk.
+	Sends the state of a resumable transfer (e.g. the upload session and how much has been
+	sent to it) to the main application.  If this Spot VM is preempted, the application
+	starts a replacement VM with the last state, which picks the transfer up from there.
+	save() is called as the transfer progresses, but only sends every checkpoint_interval seconds.
+	'''
+	def __init__(self, params):
+		self.params = params
+		self.state = None
+		self.last_sent = 0
+		self.preempted = False
+		self.lock = threading.Lock()
+
+	def send(self, preempted=False):
+		d = {}
+		d['token'] = get_encrypted_token(self.params)
+		d['transfer_pk'] = self.params['transfer_pk']
+		d['state'] = json.dumps(self.state)
+		d['preempted'] = 1 if preempted else 0
+		try:
+			response = requests.post(self.params['checkpoint_url'], data=d, timeout=DEFAULT_TIMEOUT)
+			response.raise_for_status()
+			self.last_sent = time.time()
+		except Exception as ex:
+			logging.error('Could not send the checkpoint: %s' % ex)
+
+	def save(self, state):
+		with self.lock:
+			self.state = state
+			if (not self.preempted) and (time.time() - self.last_sent >= self.params['checkpoint_interval']):
+				self.send()
+
+	def preempt(self):
+		'''
+		Sends the last state, marked so that the application starts a replacement VM
+		'''
+		with self.lock:
+			self.preempted = True
+			self.send(preempted=True)
+
+
+def watch_for_preemption(checkpointer):
+	'''
+	Waits on the metadata server until the VM is preempted.  A Spot VM gets about 
+	30 seconds of warning, which is enough to send the final checkpoint.
+	'''
+	headers = {'Metadata-Flavor':'Google'}
+	while True:
+		try:
+			response = requests.get(PREEMPTED_REQUEST_URL, headers=headers)
+			if response.text.strip() == 'TRUE':
+				logging.info('This VM is being preempted.  Sending the final checkpoint.')
+				checkpointer.preempt()
+				return
+		except Exception as ex:
+			logging.error('Could not check for preemption: %s' % ex)
+			time.sleep(POLL_INTERVAL)
+
+
+def start_checkpoints(params):
+	'''
+	Returns a Checkpointer for the transfer, after starting a thread which watches for preemption
+	'''
+	checkpointer = Checkpointer(params)
+	watcher = threading.Thread(target=watch_for_preemption, args=(checkpointer,))
+	watcher.daemon = True
+	watcher.start()
+	return checkpointer
+
+
+def save_checkpoint(params, state):
+	'''
+	Saves the state of the transfer, if it is being checkpointed (see Checkpointer)
+	'''
+	checkpointer = params.get('checkpointer')
+	if checkpointer is not None:
+		checkpointer.save(state)
+
+
+def parse_resource_path(params):
+	'''
+	Splits the gs://bucket/object path into the bucket and object names
 	'''
 	src = params['resource_path']
 	src_without_prefix = src[len(GOOGLE_BUCKET_PREFIX):] # remove the prefix
 	contents = src_without_prefix.split('/')
 	bucket_name = contents[0]
 	object_name = '/'.join(contents[1:])
-	basename = os.path.basename(object_name)
-	local_path = os.path.join(WORKING_DIR, basename)
+	return bucket_name, object_name
 
+
+def get_object_size(bucket_name, object_name):
+	'''
+	Returns the size of the object in bytes.  Unlike bucket.blob(...), get_blob fetches the metadata.
+	'''
 	storage_client = storage.Client()
-	source_bucket = storage_client.get_bucket(bucket_name)
-	source_blob = source_bucket.blob(object_name)
-	source_blob.download_to_filename(local_path)
+	source_blob = storage_client.bucket(bucket_name).get_blob(object_name)
+	if source_blob is None:
+		raise Exception('Could not find object %s in bucket %s' % (object_name, bucket_name))
+	return source_blob.size
+
+
+def get_slice_ranges(file_size, slice_size, offset=0):
+	'''
+	Returns (start, end) byte ranges covering the file from offset on.  The end is inclusive, as in HTTP range requests.
+	'''
+	return [(start, min(start + slice_size, file_size) - 1) for start in range(offset, file_size, slice_size)]
+
+
+def fetch_slice(bucket_name, object_name, start, end):
+	'''
+	Downloads the bytes start..end (inclusive) of the object.  A failed slice is
+	retried on its own, so a dropped connection does not restart the whole object.
+
+	The HTTP session inside the storage client should not be shared across threads, so
+	each thread keeps its own client.
+	'''
+	fails = 0
+	while True:
+		try:
+			if not hasattr(thread_local, 'storage_client'):
+				thread_local.storage_client = storage.Client()
+			blob = thread_local.storage_client.bucket(bucket_name).blob(object_name)
+			return blob.download_as_string(start=start, end=end)
+		except Exception as ex:
+			fails += 1
+			if fails > MAX_SLICE_RETRIES:
+				raise ex
+			logging.error('Failed fetching bytes %d-%d (%s).  Retrying.' % (start, end, ex))
+			time.sleep(2**fails)
+
+
+def download_slices_to_file(bucket_name, object_name, file_size, local_path, num_slices, slice_size):
+	'''
+	Downloads the object with num_slices concurrent range requests.  The file is preallocated, 
+	and each slice is written at its own offset as soon as it arrives.
+	'''
+	with open(local_path, 'wb') as fout:
+		fout.truncate(file_size)
+	fd = os.open(local_path, os.O_WRONLY)
+
+	def fetch_and_write(byte_range):
+		start, end = byte_range
+		os.pwrite(fd, fetch_slice(bucket_name, object_name, start, end), start)
+
+	try:
+		with ThreadPoolExecutor(max_workers=num_slices) as executor:
+			# consume the results so any exception raised in a slice is raised here
+			for _ in executor.map(fetch_and_write, get_slice_ranges(file_size, slice_size)):
+				pass
+	finally:
+		os.close(fd)
+
+
+def iterate_slices(bucket_name, object_name, file_size, num_slices, slice_size, offset=0):
+	'''
+	Yields the contents of the object (from offset on) in order, while up to num_slices ranges are
+	downloaded concurrently.  At most num_slices slices are buffered in memory.
+	'''
+	with ThreadPoolExecutor(max_workers=num_slices) as executor:
+		pending = collections.deque()
+		for start, end in get_slice_ranges(file_size, slice_size, offset):
+			pending.append(executor.submit(fetch_slice, bucket_name, object_name, start, end))
+			if len(pending) >= num_slices:
+				yield pending.popleft().result()
+		while pending:
+			yield pending.popleft().result()
+
+
+def download_to_disk(params):
+	'''
+	Downloads the file from the bucket to the local disk.
+	'''
+	bucket_name, object_name = parse_resource_path(params)
+	basename = os.path.basename(object_name)
+	local_path = os.path.join(params['working_dir'], basename)
+
+	file_size = get_object_size(bucket_name, object_name)
+	download_slices_to_file(bucket_name, object_name, file_size, local_path, 
+		params['slices'], 
+		params['slice_size']
+	)
 	return local_path
 
+
+def read_chunks_from_bucket(params, file_size, chunk_queue, chunk_size=DEFAULT_CHUNK_SIZE, offset=0):
+	'''
+	Reads the object (from offset on) with concurrent range requests (see iterate_slices) and places it on the 
+	queue in order, as chunks of chunk_size bytes (the last may be shorter).
+	This runs in its own thread so that the next chunk is downloading while the 
+	previous one is being sent to Dropbox.  The queue is bounded, so the reader 
+	blocks if it gets too far ahead of the upload.
+
+	A None placed on the queue marks the end of the object.  If the download fails, 
+	the exception is placed on the queue so the consumer can raise it.
+	'''
+	try:
+		bucket_name, object_name = parse_resource_path(params)
+		buffer = bytearray()
+		for piece in iterate_slices(bucket_name, object_name, file_size, params['slices'], params['slice_size'], offset):
+			buffer.extend(piece)
+			while len(buffer) >= chunk_size:
+				chunk_queue.put(bytes(buffer[:chunk_size]))
+				del buffer[:chunk_size]
+		if len(buffer) > 0:
+			chunk_queue.put(bytes(buffer))
+		chunk_queue.put(None)
+	except Exception as ex:
+		logging.error('Failed while reading from the bucket')
+		chunk_queue.put(ex)
+
+
+def iterate_queue(chunk_queue):
+	'''
+	Yields chunks from the queue filled by read_chunks_from_bucket until the end marker
+	'''
+	while True:
+		item = chunk_queue.get()
+		if item is None:
+			return
+		elif isinstance(item, Exception):
+			raise item
+		yield item
+
+
+def get_incorrect_offset(error):
+	'''
+	Dropbox reports offset mismatches from both the append and finish calls, but
+	the finish error wraps the lookup error.  Returns the correct offset, or None
+	if the error was not an offset error.
+	'''
+	if hasattr(error, 'is_lookup_failed') and error.is_lookup_failed():
+		error = error.get_lookup_failed()
+	if hasattr(error, 'is_incorrect_offset') and error.is_incorrect_offset():
+		return error.get_incorrect_offset().correct_offset
+	return None
+
+
+def send_chunk(client, chunk, cursor, commit=None):
+	'''
+	Sends an in-memory chunk to the upload session at cursor.offset, and advances the
+	cursor.  If commit is given, the session is finished with this chunk.
+
+	Since the chunk is not on disk, we cannot rewind a stream.  Instead, we keep the chunk
+	until Dropbox has accepted it.  If Dropbox reports that it already has part of
+	the chunk (e.g. the request went through but the response was lost), we only send the remainder.
+	'''
+	data = chunk
+	fails = 0
+	while True:
+		try:
+			if commit is None:
+				client.files_upload_session_append_v2(data, cursor)
+			else:
+				client.files_upload_session_finish(data, cursor, commit)
+			cursor.offset += len(data)
+			return
+		except dropbox.exceptions.ApiError as ex:
+			correct_offset = get_incorrect_offset(ex.error)
+			already_sent = None if correct_offset is None else correct_offset - cursor.offset
+			if (already_sent is not None) and (0 <= already_sent <= len(data)):
+				logging.error('Offset error.  Cursor was at %d, Dropbox expects %d' % (cursor.offset, correct_offset))
+				data = data[already_sent:]
+				cursor.offset = correct_offset
+			else:
+				logging.error('API error was raised, but could not be corrected by adjusting the offset')
+				raise ex
+		except requests.exceptions.ConnectionError as ex:
+			fails += 1
+			if fails > MAX_CHUNK_RETRIES:
+				raise ex
+			logging.error('Caught a ConnectionError while sending chunk at offset %d.  Retrying.' % cursor.offset)
+			time.sleep(2**fails)
+
+
+def get_session_offset(client, session_id, offset):
+	'''
+	Returns the offset the Dropbox upload session expects next.  The session may be ahead
+	of our last checkpoint (offset).  An empty append at the wrong offset fails with the correct one.
+	'''
+	try:
+		client.files_upload_session_append_v2(b'', dropbox.files.UploadSessionCursor(session_id, offset=offset))
+		return offset
+	except dropbox.exceptions.ApiError as ex:
+		correct_offset = get_incorrect_offset(ex.error)
+		if correct_offset is None:
+			raise ex
+		return correct_offset
+
+
+def stream_to_dropbox(params):
+	'''
+	Streams the object from the bucket directly into a Dropbox upload session without
+	staging it on the local disk.  Byte ranges are downloaded in a separate thread while
+	the previous range is uploaded, so the transfer takes about as long as the slower
+	of the two, rather than the sum.
+
+	The session and offset are checkpointed after each chunk.  When resuming from a
+	checkpoint (params['resume']), the same session is continued from the offset it has reached.
+	'''
+	bucket_name, object_name = parse_resource_path(params)
+	basename = os.path.basename(object_name)
+	file_size = get_object_size(bucket_name, object_name)
+
+	token = params['access_token']
+	client = dropbox.dropbox.Dropbox(token, timeout=DEFAULT_TIMEOUT)
+	path_in_dropbox = '%s/%s' % (params['dropbox_destination_folderpath'], basename)
+	resume = params.get('resume')
+	if resume is None:
+		offset = 0
+	else:
+		offset = get_session_offset(client, resume['session_id'], resume['offset'])
+		cursor = dropbox.files.UploadSessionCursor(resume['session_id'], offset=offset)
+		logging.info('Resuming the upload session at %d bytes' % offset)
+
+	chunk_queue = queue.Queue(maxsize=DEFAULT_QUEUE_DEPTH)
+	reader = threading.Thread(target=read_chunks_from_bucket, args=(params, file_size, chunk_queue, DEFAULT_CHUNK_SIZE, offset))
+	reader.daemon = True
+	reader.start()
+	chunks = iterate_queue(chunk_queue)
+
+	if (resume is None) and (file_size <= DEFAULT_CHUNK_SIZE):
+		client.files_upload(next(chunks, b''), path_in_dropbox)
+	else:
+		if resume is None:
+			session_start_result = client.files_upload_session_start(next(chunks))
+			cursor = dropbox.files.UploadSessionCursor(session_start_result.session_id, offset=DEFAULT_CHUNK_SIZE)
+			save_checkpoint(params, {'session_id': cursor.session_id, 'offset': cursor.offset})
+		commit = dropbox.files.CommitInfo(path=path_in_dropbox)
+		committed = False
+		for i, chunk in enumerate(chunks):
+			logging.info('Sending chunk %d, cursor=%d' % (i+2, cursor.offset))
+			if cursor.offset + len(chunk) >= file_size:
+				logging.info('Finishing transfer and committing')
+				send_chunk(client, chunk, cursor, commit)
+				committed = True
+			else:
+				send_chunk(client, chunk, cursor)
+				save_checkpoint(params, {'session_id': cursor.session_id, 'offset': cursor.offset})
+		if not committed:
+			# a resumed session which already had every byte still needs to be finished
+			send_chunk(client, b'', cursor, commit)
+	reader.join()
+
+
 def send_to_dropbox(local_filepath, params):
 	'''
 	local_filepath is the path on the VM/container of the file that
@@ -131,32 +485,57 @@ def send_to_dropbox(local_filepath, params):
 	stream.close()
 
 
-def kill_instance(params):
+def get_instance_name():
 	'''
-	Removes the virtual machine
+	Returns the name of this virtual machine
 	'''
 	headers = {'Metadata-Flavor':'Google'}
 	response = requests.get(HOSTNAME_REQUEST_URL, headers=headers)
 	content = response.content.decode('utf-8')
-	instance_name = content.split('.')[0]
+	return content.split('.')[0]
+
+
+def kill_instance(params):
+	'''
+	Removes the virtual machine
+	'''
+	instance_name = get_instance_name()
 	compute = build('compute', 'v1')
 	compute.instances().delete(project=params['google_project_id'],
 		zone=params['google_zone'], 
 	instance=instance_name).execute()
 
 
-def parse_args():
+def parse_args(argv=None):
 	parser = argparse.ArgumentParser()
 	parser.add_argument("-token", help="A token for identifying the container with the main application", dest='token', required=True)
 	parser.add_argument("-key", help="An encryption key for identifying the container with the main application", dest='enc_key', required=True)
-	parser.add_argument("-pk", help="The primary key of the transfer", dest='transfer_pk', required=True)
+	parser.add_argument("-pk", help="The primary key of the transfer", dest='transfer_pk')
 	parser.add_argument("-url", help="The callback URL for communicating with the main application", dest='callback_url', required=True)
-	parser.add_argument("-path", help="The source of the file that is being downloaded", dest='resource_path', required=True)
-	parser.add_argument("-dropbox", help="The access token for Dropbox", dest='access_token', required=True)
+	parser.add_argument("-path", help="The source of the file that is being downloaded", dest='resource_path')
+	parser.add_argument("-dropbox", help="The access token for Dropbox", dest='access_token')
 	parser.add_argument("-d", help="The folder in Dropbox where the file will go", dest='dropbox_destination_folderpath', required=True)
 	parser.add_argument("-proj", help="Google project ID", dest='google_project_id', required=True)
 	parser.add_argument("-zone", help="Google project zone", dest='google_zone', required=True)
-	args = parser.parse_args()
+	parser.add_argument("-slices", help="Number of concurrent range requests when reading from the bucket", dest='slices', type=int, default=DEFAULT_SLICES)
+	parser.add_argument("-slice_size", help="Size (in MB) of each range request", dest='slice_size', type=int, default=DEFAULT_SLICE_SIZE_MB)
+	parser.add_argument("-stream", help="Stream directly from the bucket to Dropbox without writing to disk", dest='stream', action='store_true')
+	parser.add_argument("-manifest", help="A base64-encoded JSON list with the parameters of each transfer, if more than one", dest='manifest')
+	parser.add_argument("-pool", help="Run as a pool worker for this pool, leasing transfers from the main application", dest='pool')
+	parser.add_argument("-lease_url", help="The URL for leasing transfers from the main application (pool workers only)", dest='lease_url')
+	parser.add_argument("-idle_timeout", help="Seconds a pool worker waits for work before removing itself", dest='idle_timeout', type=int, default=DEFAULT_IDLE_TIMEOUT)
+	parser.add_argument("-concurrency", help="The number of transfers from the manifest to run at the same time", dest='concurrency', type=int, default=DEFAULT_CONCURRENCY)
+	parser.add_argument("-checkpoint_url", help="The URL for sending checkpoints to the main application (Spot VMs only)", dest='checkpoint_url')
+	parser.add_argument("-checkpoint_interval", help="Seconds between checkpoints", dest='checkpoint_interval', type=int, default=DEFAULT_CHECKPOINT_INTERVAL)
+	parser.add_argument("-resume", help="A base64-encoded JSON checkpoint to resume the transfer from", dest='resume')
+	args = parser.parse_args(argv)
+	if args.pool is not None:
+		if args.lease_url is None:
+			parser.error('A pool worker requires -lease_url')
+	elif args.manifest is None:
+		missing = [x for x in ('transfer_pk', 'resource_path', 'access_token') if getattr(args, x) is None]
+		if len(missing) > 0:
+			parser.error('Without a manifest, the following are required: %s' % ', '.join(missing))
 	params = {}
 	params['token'] = args.token
 	params['enc_key'] =  args.enc_key
@@ -167,21 +546,154 @@ def parse_args():
 	params['dropbox_destination_folderpath'] = args.dropbox_destination_folderpath
 	params['google_project_id'] = args.google_project_id
 	params['google_zone'] = args.google_zone
+	params['slices'] = max(1, args.slices)
+	params['slice_size'] = max(1, args.slice_size)*1024*1024
+	params['stream'] = args.stream
+	if args.manifest is None:
+		params['manifest'] = None
+	else:
+		params['manifest'] = json.loads(base64.b64decode(args.manifest).decode('utf-8'))
+	params['concurrency'] = max(1, args.concurrency)
+	params['pool'] = args.pool
+	params['lease_url'] = args.lease_url
+	params['idle_timeout'] = args.idle_timeout
+	params['checkpoint_url'] = args.checkpoint_url
+	params['checkpoint_interval'] = args.checkpoint_interval
+	if args.resume is None:
+		params['resume'] = None
+	else:
+		params['resume'] = json.loads(base64.b64decode(args.resume).decode('utf-8'))
 	return params
 
 
-if __name__ == '__main__':
+def run_transfer(params):
+	'''
+	Performs a single transfer and reports the outcome to the master.
+	Returns True if the transfer succeeded.
+	'''
 	try:
-		params = parse_args()
-		os.mkdir(WORKING_DIR)
-		logfile = create_logger()
-		params['logfile'] = logfile
-		local_filepath = download_to_disk(params)
-		send_to_dropbox(local_filepath, params)
+		if params['stream']:
+			stream_to_dropbox(params)
+		else:
+			local_filepath = download_to_disk(params)
+			send_to_dropbox(local_filepath, params)
 		notify_master(params)
-		kill_instance(params)
+		return True
 	except Exception as ex:
-		logging.error('Caught some unexpected exception.')
+		logging.error('Caught some unexpected exception during transfer %s.' % params['transfer_pk'])
 		logging.error(str(type(ex)))
 		logging.error(ex)
+		if (params.get('checkpointer') is not None) and params['checkpointer'].preempted:
+			# the replacement VM finishes the transfer and reports the outcome
+			logging.info('Transfer %s was interrupted by preemption' % params['transfer_pk'])
+			return False
 		notify_master(params, error=True)
+		return False
+
+
+def get_transfer_params(params, entry):
+	'''
+	Combines the parameters common to the VM with those for a single transfer 
+	(a manifest entry or leased job), including a working directory for the transfer
+	'''
+	transfer_params = params.copy()
+	transfer_params.update(entry)
+	transfer_params['working_dir'] = os.path.join(WORKING_DIR, str(entry['transfer_pk']))
+	return transfer_params
+
+
+def run_in_directory(transfer_params):
+	'''
+	Runs the transfer in its own working directory, which is removed afterward
+	'''
+	os.mkdir(transfer_params['working_dir'])
+	try:
+		return run_transfer(transfer_params)
+	finally:
+		shutil.rmtree(transfer_params['working_dir'], ignore_errors=True)
+
+
+def run_manifest(params):
+	'''
+	Performs each transfer listed in the manifest, running at most params['concurrency'] 
+	at once.  Each transfer has its own working directory, which is removed when it finishes,
+	so the disk only needs to hold the files in progress.
+	Returns True if every transfer succeeded.
+	'''
+	all_transfer_params = [get_transfer_params(params, entry) for entry in params['manifest']]
+
+	logging.info('Starting %d transfers' % len(all_transfer_params))
+	with ThreadPoolExecutor(max_workers=params['concurrency']) as executor:
+		results = list(executor.map(run_in_directory, all_transfer_params))
+	return all(results)
+
+
+def lease_job(params, instance_name, idle):
+	'''
+	Asks the main application for a transfer.  Returns the response, which contains
+	'job' (the transfer's parameters, or None) and, if we should stop, 'retire'
+	'''
+	d = {}
+	d['token'] = get_encrypted_token(params)
+	d['pool'] = params['pool']
+	d['worker'] = instance_name
+	d['idle'] = 1 if idle else 0
+	response = requests.post(params['lease_url'], data=d, timeout=DEFAULT_TIMEOUT)
+	response.raise_for_status()
+	return response.json()
+
+
+def run_pool_worker(params):
+	'''
+	Leases transfers from the main application and runs them one at a time, staying
+	up between transfers so that each does not pay for starting a VM.  Returns once the 
+	worker has been idle (or unable to reach the application) for the idle timeout and the 
+	application agrees to let it retire.
+	'''
+	instance_name = get_instance_name()
+	logging.info('Starting pool worker %s for pool %s' % (instance_name, params['pool']))
+	idle_since = time.time()
+	while True:
+		idle = (time.time() - idle_since) > params['idle_timeout']
+		try:
+			response = lease_job(params, instance_name, idle)
+		except Exception as ex:
+			logging.error('Could not lease a job: %s' % ex)
+			if idle:
+				logging.error('Idle past the timeout and cannot reach the application.  Retiring.')
+				return
+			time.sleep(POLL_INTERVAL)
+			continue
+
+		if response.get('retire'):
+			logging.info('Retiring after being idle for %d seconds' % (time.time() - idle_since))
+			return
+		job = response.get('job')
+		if job is None:
+			time.sleep(POLL_INTERVAL)
+		else:
+			logging.info('Leased transfer %s' % job['transfer_pk'])
+			run_in_directory(get_transfer_params(params, job))
+			idle_since = time.time()
+
+
+if __name__ == '__main__':
+	params = parse_args()
+	os.mkdir(WORKING_DIR)
+	logfile = create_logger()
+	params['logfile'] = logfile
+	if params['pool'] is not None:
+		# transfers in a pool report their own outcome, so the VM is always removed
+		run_pool_worker(params)
+		success = True
+	elif params['manifest'] is None:
+		params['working_dir'] = WORKING_DIR
+		if params['checkpoint_url'] is not None:
+			params['checkpointer'] = start_checkpoints(params)
+		success = run_transfer(params)
+	else:
+		success = run_manifest(params)
+
+	# as before, a VM with a failed transfer is left up so it can be inspected
+	if success:
+		kill_instance(params)
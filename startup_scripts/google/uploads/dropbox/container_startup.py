@@ -3,6 +3,13 @@
 import os
 import sys
 import io
+import time
+import queue
+import threading
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+import shutil
 import subprocess
 import argparse
 import datetime
@@ -16,8 +23,30 @@ from apiclient.discovery import build
 
 
 WORKING_DIR = '/workspace'
+DEFAULT_CONCURRENCY = 4 # number of transfers run at once when given a manifest
+DEFAULT_IDLE_TIMEOUT = 600 # seconds a pool worker waits for work before removing itself
+POLL_INTERVAL = 10 # seconds between requests for work when idle
 HOSTNAME_REQUEST_URL = 'http://metadata/computeMetadata/v1/instance/hostname'
+PREEMPTED_REQUEST_URL = 'http://metadata/computeMetadata/v1/instance/preempted?wait_for_change=true'
+DEFAULT_CHECKPOINT_INTERVAL = 60 # seconds between checkpoints sent to the main application (Spot VMs only)
 GOOGLE_BUCKET_PREFIX = 'gs://'
+DEFAULT_TIMEOUT = 60
+READ_SIZE = 8*1024*1024 # size of the pieces read from the source when streaming
+DEFAULT_QUEUE_DEPTH = 16 # number of pieces held in memory ahead of the upload when streaming
+GCS_CHUNK_SIZE = 64*1024*1024 # resumable upload chunks need to be a multiple of 256KB
+RESUMABLE_INCOMPLETE = 308
+MAX_CHUNK_RETRIES = 5
+COMPOSE_LIMIT = 32 # the maximum number of source objects in a single GCS compose request
+DEFAULT_COMPOSITE_PARTS = 8
+DEFAULT_COMPOSITE_THRESHOLD_MB = 4096
+MAX_PART_RETRIES = 5
+DEFAULT_CONNECTIONS = 8 # number of concurrent range requests when downloading from the link
+SEGMENT_SIZE = 256*1024*1024 # the unit of work (and of resume bookkeeping) for each connection
+MAX_SEGMENT_RETRIES = 5 # consecutive failures (without progress) before giving up on a segment
+PROGRESS_INTERVAL = 60 # seconds between progress reports
+
+# holds the per-thread storage client when uploading composite parts
+thread_local = threading.local()
 
 def create_logger():
 	"""
@@ -29,6 +58,16 @@ def create_logger():
 	logging.basicConfig(filename=logfile, level=logging.INFO, format="%(asctime)s:%(levelname)s:%(message)s")
 	return logfile
 
+def get_encrypted_token(params):
+	'''
+	Returns the token which identifies the VM as a 'known' sender to the main application
+	'''
+	token = params['token']
+	obj=DES.new(params['enc_key'], DES.MODE_ECB)
+	enc_token = obj.encrypt(token)
+	return base64.encodestring(enc_token)
+
+
 def notify_master(params, error=False):
 	'''
 	This calls back to the head machine to let it know the work is finished.
@@ -39,11 +78,7 @@ def notify_master(params, error=False):
 	d = {}
 
 	# prepare the token which identifies the VM as a 'known' sender
-	token = params['token']
-	obj=DES.new(params['enc_key'], DES.MODE_ECB)
-	enc_token = obj.encrypt(token)
-	b64_str = base64.encodestring(enc_token)
-	d['token'] = b64_str
+	d['token'] = get_encrypted_token(params)
 
 	# Other required params to return:
 	d['transfer_pk'] = params['transfer_pk']
@@ -54,78 +89,606 @@ def notify_master(params, error=False):
 	logging.info('Response text: %s' % response.text)
 
 
-def send_to_bucket(local_filepath, params):
+class Checkpointer(object):
 	'''
-	Uploads the local file to the bucket
+	Sends the state of a resumable transfer (e.g. the upload session and how much has been
+	sent to it) to the main application.  If this Spot VM is preempted, the application
+	starts a replacement VM with the last state, which picks the transfer up from there.
+	save() is called as the transfer progresses, but only sends every checkpoint_interval seconds.
+	'''
+	def __init__(self, params):
+		self.params = params
+		self.state = None
+		self.last_sent = 0
+		self.preempted = False
+		self.lock = threading.Lock()
+
+	def send(self, preempted=False):
+		d = {}
+		d['token'] = get_encrypted_token(self.params)
+		d['transfer_pk'] = self.params['transfer_pk']
+		d['state'] = json.dumps(self.state)
+		d['preempted'] = 1 if preempted else 0
+		try:
+			response = requests.post(self.params['checkpoint_url'], data=d, timeout=DEFAULT_TIMEOUT)
+			response.raise_for_status()
+			self.last_sent = time.time()
+		except Exception as ex:
+			logging.error('Could not send the checkpoint: %s' % ex)
+
+	def save(self, state):
+		with self.lock:
+			self.state = state
+			if (not self.preempted) and (time.time() - self.last_sent >= self.params['checkpoint_interval']):
+				self.send()
+
+	def preempt(self):
+		'''
+		Sends the last state, marked so that the application starts a replacement VM
+		'''
+		with self.lock:
+			self.preempted = True
+			self.send(preempted=True)
+
+
+def watch_for_preemption(checkpointer):
+	'''
+	Waits on the metadata server until the VM is preempted.  A Spot VM gets about 
+	30 seconds of warning, which is enough to send the final checkpoint.
+	'''
+	headers = {'Metadata-Flavor':'Google'}
+	while True:
+		try:
+			response = requests.get(PREEMPTED_REQUEST_URL, headers=headers)
+			if response.text.strip() == 'TRUE':
+				logging.info('This VM is being preempted.  Sending the final checkpoint.')
+				checkpointer.preempt()
+				return
+		except Exception as ex:
+			logging.error('Could not check for preemption: %s' % ex)
+			time.sleep(POLL_INTERVAL)
+
+
+def start_checkpoints(params):
+	'''
+	Returns a Checkpointer for the transfer, after starting a thread which watches for preemption
+	'''
+	checkpointer = Checkpointer(params)
+	watcher = threading.Thread(target=watch_for_preemption, args=(checkpointer,))
+	watcher.daemon = True
+	watcher.start()
+	return checkpointer
+
+
+def save_checkpoint(params, state):
+	'''
+	Saves the state of the transfer, if it is being checkpointed (see Checkpointer)
+	'''
+	checkpointer = params.get('checkpointer')
+	if checkpointer is not None:
+		checkpointer.save(state)
+
+
+def parse_destination(params):
+	'''
+	Splits the gs://bucket/object destination into the bucket and object names
 	'''
 	full_destination_w_prefix = params['destination']
 	full_destination = full_destination_w_prefix[len(GOOGLE_BUCKET_PREFIX):]
 	contents = full_destination.split('/')
 	bucket_name = contents[0]
 	object_name = '/'.join(contents[1:])
+	return bucket_name, object_name
 
-	storage_client = storage.Client()
+
+def get_or_create_bucket(storage_client, bucket_name):
+	'''
+	Returns the destination bucket, creating it if it does not exist yet
+	'''
 	# trying to get an existing bucket.  If raises exception, means bucket did not exist (or similar)
 	try:
-		destination_bucket = storage_client.get_bucket(bucket_name)
+		return storage_client.get_bucket(bucket_name)
 	except (google.api_core.exceptions.NotFound, google.api_core.exceptions.BadRequest) as ex:
 
 		# try to create the bucket:
 		try:
-			destination_bucket = storage_client.create_bucket(bucket_name)
+			return storage_client.create_bucket(bucket_name)
 		except google.api_core.exceptions.BadRequest as ex2:
-			raise Exception('Could not find or create bucket.  Error was ' % ex2)
+			raise Exception('Could not find or create bucket.  Error was %s' % ex2)
+
+
+def send_to_bucket(local_filepath, params):
+	'''
+	Uploads the local file to the bucket.  Files at or above the composite 
+	threshold are uploaded as parallel parts (see composite_upload)
+	'''
+	bucket_name, object_name = parse_destination(params)
+	storage_client = storage.Client()
+	destination_bucket = get_or_create_bucket(storage_client, bucket_name)
+	file_size = os.path.getsize(local_filepath)
+	threshold = params['composite_threshold']
 	try:
-		destination_blob = destination_bucket.blob(object_name)
-		destination_blob.upload_from_filename(local_filepath)
+		if (threshold > 0) and (file_size >= threshold) and (params['composite_parts'] > 1):
+			composite_upload(destination_bucket, object_name, local_filepath, file_size, params['composite_parts'])
+		else:
+			destination_blob = destination_bucket.blob(object_name)
+			destination_blob.upload_from_filename(local_filepath)
 	except Exception as ex:
+		logging.error(ex)
 		raise Exception('Could not create or upload the blob with name %s' % object_name)
 
 
+def get_part_ranges(file_size, num_parts):
+	'''
+	Splits the file into (at most) num_parts contiguous (offset, length) ranges
+	'''
+	part_size = -(-file_size // num_parts) # ceiling division
+	return [(start, min(part_size, file_size - start)) for start in range(0, file_size, part_size)]
+
+
+def upload_part(bucket_name, part_name, local_filepath, offset, length):
+	'''
+	Uploads length bytes of the local file, starting at offset, as its own object.
+	A failed part is retried on its own, so the other parts are not lost.
+
+	The HTTP session inside the storage client should not be shared across threads, so
+	each thread keeps its own client.
+	'''
+	fails = 0
+	while True:
+		try:
+			if not hasattr(thread_local, 'storage_client'):
+				thread_local.storage_client = storage.Client()
+			part_blob = thread_local.storage_client.bucket(bucket_name).blob(part_name)
+			with open(local_filepath, 'rb') as fin:
+				fin.seek(offset)
+				part_blob.upload_from_file(fin, size=length)
+			return part_blob
+		except Exception as ex:
+			fails += 1
+			if fails > MAX_PART_RETRIES:
+				raise ex
+			logging.error('Failed uploading part %s (%s).  Retrying.' % (part_name, ex))
+			time.sleep(2**fails)
+
+
+def compose_parts(bucket, object_name, parts, temp_blobs):
+	'''
+	Combines the part objects, in order, into the final object.  A single compose request 
+	takes at most COMPOSE_LIMIT sources, so larger lists are composed in rounds of 
+	intermediate objects.  Every intermediate object is added to temp_blobs for cleanup.
+	'''
+	compose_round = 0
+	while len(parts) > COMPOSE_LIMIT:
+		compose_round += 1
+		next_parts = []
+		for i in range(0, len(parts), COMPOSE_LIMIT):
+			intermediate = bucket.blob('%s.compose-%d-%d' % (object_name, compose_round, i // COMPOSE_LIMIT))
+			temp_blobs.append(intermediate)
+			intermediate.compose(parts[i:i + COMPOSE_LIMIT])
+			next_parts.append(intermediate)
+		parts = next_parts
+	bucket.blob(object_name).compose(parts)
+
+
+def composite_upload(bucket, object_name, local_filepath, file_size, num_parts):
+	'''
+	Uploads the file as num_parts temporary objects in parallel, and then combines
+	them into the destination object with compose.  The temporary objects are removed 
+	whether or not the upload succeeded.
+
+	Note that composite objects carry a CRC32C checksum, but no MD5 hash.
+	'''
+	ranges = get_part_ranges(file_size, num_parts)
+	part_names = ['%s.part-%d' % (object_name, i) for i in range(len(ranges))]
+	temp_blobs = [bucket.blob(x) for x in part_names]
+	logging.info('Uploading %s as %d parts' % (object_name, len(ranges)))
+	try:
+		with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+			futures = [executor.submit(upload_part, bucket.name, part_name, local_filepath, offset, length) 
+				for part_name, (offset, length) in zip(part_names, ranges)]
+			# raise any exception from the parts here
+			parts = [f.result() for f in futures]
+		compose_parts(bucket, object_name, parts, temp_blobs)
+	finally:
+		for blob in temp_blobs:
+			try:
+				blob.delete()
+			except google.api_core.exceptions.NotFound:
+				pass
+			except Exception as ex:
+				logging.error('Could not remove temporary object %s: %s' % (blob.name, ex))
+
+
+def iterate_queue(chunk_queue):
+	'''
+	Yields chunks from the queue filled by the reader thread until the end marker (None).
+	If the reader placed an exception on the queue, it is raised here.
+	'''
+	while True:
+		item = chunk_queue.get()
+		if item is None:
+			return
+		elif isinstance(item, Exception):
+			raise item
+		yield item
+
+
+def start_resumable_upload(params):
+	'''
+	Creates a resumable upload session for the destination object and returns the session URL.
+	The URL itself authorizes the subsequent requests, so no credentials are needed to send chunks.
+	'''
+	bucket_name, object_name = parse_destination(params)
+	storage_client = storage.Client()
+	destination_bucket = get_or_create_bucket(storage_client, bucket_name)
+	destination_blob = destination_bucket.blob(object_name)
+	return destination_blob.create_resumable_upload_session()
+
+
+def put_chunk(session_url, data, offset, total_size=None):
+	'''
+	Sends a chunk of the upload, starting at offset, to the resumable session.  The total size
+	is only given with the final chunk.  Returns the offset the session has persisted up to.
+
+	GCS may persist only part of a chunk.  In that case (and after dropped connections 
+	or server errors), we resend the bytes it does not have yet.
+	'''
+	total = '*' if total_size is None else str(total_size)
+	fails = 0
+	while True:
+		if len(data) == 0:
+			content_range = 'bytes */%s' % total
+		else:
+			content_range = 'bytes %d-%d/%s' % (offset, offset + len(data) - 1, total)
+		try:
+			response = requests.put(session_url, data=data, headers={'Content-Range': content_range}, timeout=DEFAULT_TIMEOUT)
+		except requests.exceptions.ConnectionError as ex:
+			response = None
+		if response is not None and response.status_code in (200, 201):
+			return offset + len(data)
+		elif response is not None and response.status_code == RESUMABLE_INCOMPLETE:
+			# the Range header (e.g. 'bytes=0-1234') tells us what the session has persisted
+			if 'Range' in response.headers:
+				persisted = int(response.headers['Range'].split('-')[-1]) + 1
+			else:
+				persisted = 0
+			if persisted == offset + len(data):
+				return persisted
+			logging.info('Session persisted up to %d, resending from there' % persisted)
+			data = data[persisted - offset:]
+			offset = persisted
+		elif response is None or response.status_code >= 500:
+			fails += 1
+			if fails > MAX_CHUNK_RETRIES:
+				raise Exception('Too many failures sending the chunk at offset %d' % offset)
+			logging.error('Failed sending chunk at offset %d.  Retrying.' % offset)
+			time.sleep(2**fails)
+		else:
+			raise Exception('Unexpected response (%d) from the upload session: %s' % (response.status_code, response.text))
+
+
+def get_session_offset(session_url):
+	'''
+	Asks the resumable upload session how much it has persisted.  Returns the offset
+	to continue from, or None if the upload has already completed.
+	'''
+	response = requests.put(session_url, headers={'Content-Range': 'bytes */*'}, timeout=DEFAULT_TIMEOUT)
+	if response.status_code in (200, 201):
+		return None
+	elif response.status_code == RESUMABLE_INCOMPLETE:
+		if 'Range' in response.headers:
+			return int(response.headers['Range'].split('-')[-1]) + 1
+		return 0
+	raise Exception('Could not resume the upload session (%d): %s' % (response.status_code, response.text))
+
+
+def send_chunks_to_bucket(session_url, chunks, offset=0, on_progress=None):
+	'''
+	Takes an iterable of byte strings (of any size) and sends them to the resumable upload session,
+	starting at offset.  GCS requires every chunk except the last to be a multiple of 256KB, so the incoming
+	pieces are collected into GCS_CHUNK_SIZE buffers.  We always hold back the 
+	last buffer until the source is exhausted, since only then do we know the total size.
+	on_progress, if given, is called with the persisted offset after each chunk.
+	'''
+	buffer = bytearray()
+	for piece in chunks:
+		buffer.extend(piece)
+		while len(buffer) > GCS_CHUNK_SIZE:
+			offset = put_chunk(session_url, bytes(buffer[:GCS_CHUNK_SIZE]), offset)
+			del buffer[:GCS_CHUNK_SIZE]
+			logging.info('Sent %d bytes to the bucket' % offset)
+			if on_progress is not None:
+				on_progress(offset)
+	offset = put_chunk(session_url, bytes(buffer), offset, total_size=offset + len(buffer))
+	logging.info('Upload completed, %d bytes' % offset)
+
+
+def stream_to_bucket(read_func, params):
+	'''
+	Pipes the source file into the bucket without writing it to the local disk.
+	read_func runs in a separate thread and places chunks on a bounded queue, while
+	this thread sends them on to a GCS resumable upload session.  Downloading and uploading
+	therefore overlap, and memory use is bounded by the queue depth.
+
+	The session and offset are checkpointed as chunks are persisted.  When resuming from
+	a checkpoint (params['resume']), the same session is continued, and read_func starts
+	reading the source at the offset the session has reached.
+	'''
+	if params.get('resume') is not None:
+		session_url = params['resume']['session_url']
+		offset = get_session_offset(session_url)
+		if offset is None:
+			logging.info('The upload had already completed')
+			return
+		logging.info('Resuming the upload at %d bytes' % offset)
+	else:
+		session_url = start_resumable_upload(params)
+		offset = 0
+	chunk_queue = queue.Queue(maxsize=DEFAULT_QUEUE_DEPTH)
+	reader = threading.Thread(target=read_func, args=(params, chunk_queue, offset))
+	reader.daemon = True
+	reader.start()
+	on_progress = lambda x: save_checkpoint(params, {'session_url': session_url, 'offset': x})
+	send_chunks_to_bucket(session_url, iterate_queue(chunk_queue), offset, on_progress)
+	reader.join()
+
+
+def probe_link(url):
+	'''
+	Asks for the first byte of the file to learn whether the server honors range requests
+	and the total size.  Returns a tuple of (supports_ranges, size).  The size is None
+	if the server does not report it.
+	'''
+	response = requests.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=DEFAULT_TIMEOUT)
+	try:
+		response.raise_for_status()
+		if response.status_code == 206:
+			# Content-Range looks like: bytes 0-0/12345
+			match = re.match(r'bytes\s+0-0/(\d+)', response.headers.get('Content-Range', ''))
+			if match:
+				return True, int(match.group(1))
+		content_length = response.headers.get('Content-Length')
+		return False, int(content_length) if content_length is not None else None
+	finally:
+		response.close()
+
+
+class DownloadState(object):
+	'''
+	Tracks how many bytes of each segment have been written to the local file.  The state
+	is saved next to the file, so a restarted download picks up where the last one stopped
+	'''
+
+	def __init__(self, state_path, url, file_size, segment_size):
+		self.state_path = state_path
+		self.lock = threading.Lock()
+		self.written = {}
+		if os.path.exists(state_path):
+			with open(state_path) as fin:
+				saved = json.load(fin)
+			# only resume if it describes the same download
+			if (saved['url'] == url) and (saved['size'] == file_size) and (saved['segment_size'] == segment_size):
+				self.written = {int(k): v for k, v in saved['written'].items()}
+		self.url = url
+		self.file_size = file_size
+		self.segment_size = segment_size
+
+	def get_written(self, segment):
+		with self.lock:
+			return self.written.get(segment, 0)
+
+	def add_written(self, segment, num_bytes):
+		with self.lock:
+			self.written[segment] = self.written.get(segment, 0) + num_bytes
+			self._save()
+
+	def total_written(self):
+		with self.lock:
+			return sum(self.written.values())
+
+	def _save(self):
+		tmp_path = self.state_path + '.tmp'
+		with open(tmp_path, 'w') as fout:
+			json.dump({'url': self.url, 
+				'size': self.file_size, 
+				'segment_size': self.segment_size, 
+				'written': self.written}, fout)
+		os.replace(tmp_path, self.state_path)
+
+
+def fetch_segment(url, fd, state, segment, start, end):
+	'''
+	Downloads bytes start..end (inclusive) of the file into the local file.  If the
+	connection drops, the request is repeated for only the bytes not yet written.
+	'''
+	fails = 0
+	while True:
+		offset = start + state.get_written(segment)
+		if offset > end:
+			return
+		try:
+			headers = {'Range': 'bytes=%d-%d' % (offset, end)}
+			response = requests.get(url, headers=headers, stream=True, timeout=DEFAULT_TIMEOUT)
+			try:
+				if response.status_code != 206:
+					raise Exception('Expected a partial response (206) but got %d' % response.status_code)
+				for piece in response.iter_content(chunk_size=READ_SIZE):
+					os.pwrite(fd, piece, offset)
+					offset += len(piece)
+					state.add_written(segment, len(piece))
+					fails = 0 # made progress, so only count consecutive failures
+			finally:
+				response.close()
+		except Exception as ex:
+			fails += 1
+			if fails > MAX_SEGMENT_RETRIES:
+				raise ex
+			logging.error('Failed fetching bytes %d-%d (%s).  Retrying.' % (offset, end, ex))
+			time.sleep(2**fails)
+
+
+def fetch_without_ranges(url, local_path):
+	'''
+	Downloads the file on a single connection, for servers that do not support range
+	requests.  Since the download cannot be resumed, a failure starts over from the beginning.
+	'''
+	fails = 0
+	while True:
+		try:
+			response = requests.get(url, stream=True, timeout=DEFAULT_TIMEOUT)
+			try:
+				response.raise_for_status()
+				with open(local_path, 'wb') as fout:
+					for piece in response.iter_content(chunk_size=READ_SIZE):
+						fout.write(piece)
+				return
+			finally:
+				response.close()
+		except Exception as ex:
+			fails += 1
+			if fails > MAX_SEGMENT_RETRIES:
+				raise ex
+			logging.error('Failed downloading %s (%s).  Retrying.' % (url, ex))
+			time.sleep(2**fails)
+
+
+def report_progress(state, finished):
+	'''
+	Logs the progress of the download until the finished event is set
+	'''
+	start_time = time.time()
+	while not finished.wait(PROGRESS_INTERVAL):
+		done = state.total_written()
+		elapsed = time.time() - start_time
+		logging.info('Downloaded %d of %d bytes (%.1f%%, %.1f MB/s)' % (done, 
+			state.file_size, 
+			100.0*done/max(1, state.file_size), 
+			done/(1024*1024*max(1, elapsed))))
+
+
 def download_to_disk(params):
 	'''
-	local_filepath is the path on the VM/container of the file that
-	will be downloaded.
+	Downloads the file from the Dropbox link to the local disk and returns the path.
+	
+	If the server supports range requests, the file is fetched as segments over several 
+	connections.  Progress is saved alongside the file, so dropped connections (or a 
+	restarted worker) only repeat the bytes that did not arrive.  Raises an exception 
+	if the file could not be downloaded.
 	'''
 	source_link = params['resource_path']
-	local_path = os.path.join(WORKING_DIR, 'download')
-	cmd = 'wget -q -O %s "%s"' % (local_path, source_link)
-	p = subprocess.Popen(cmd, shell=True, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
-	stdout, stderr = p.communicate()
-	if p.returncode != 0:
-		print('Failed on transfering %s' % source_link.split('/')[-1])
-		print(stdout)
-		print('--'*10)
-		print(stderr)
-	else:
+	local_path = os.path.join(params['working_dir'], 'download')
+	supports_ranges, file_size = probe_link(source_link)
+
+	if not supports_ranges or not file_size:
+		logging.info('Server does not support range requests.  Downloading on a single connection.')
+		fetch_without_ranges(source_link, local_path)
 		return local_path
 
+	state_path = local_path + '.state'
+	if not os.path.exists(local_path):
+		# any saved progress refers to a file that is gone
+		if os.path.exists(state_path):
+			os.remove(state_path)
+		with open(local_path, 'wb') as fout:
+			fout.truncate(file_size)
+	state = DownloadState(state_path, source_link, file_size, SEGMENT_SIZE)
+	fd = os.open(local_path, os.O_WRONLY)
+	finished = threading.Event()
+	reporter = threading.Thread(target=report_progress, args=(state, finished), daemon=True)
+	reporter.start()
+	try:
+		segments = [(i, start, min(start + SEGMENT_SIZE, file_size) - 1) 
+			for i, start in enumerate(range(0, file_size, SEGMENT_SIZE))]
+		with ThreadPoolExecutor(max_workers=max(1, params['connections'])) as executor:
+			futures = [executor.submit(fetch_segment, source_link, fd, state, *segment) for segment in segments]
+			# raise any exception from the segments here
+			for f in futures:
+				f.result()
+	finally:
+		finished.set()
+		os.close(fd)
+	logging.info('Downloaded %d bytes' % state.total_written())
+	os.remove(state.state_path)
+	return local_path
+
 
-def kill_instance(params):
+def read_from_link(params, chunk_queue, offset=0):
 	'''
-	Removes the virtual machine
+	Downloads the file from the Dropbox link, starting at offset, placing the pieces on the queue in order.
+	Run in a separate thread when streaming (see stream_to_bucket).  A None on the queue marks the end.
+	'''
+	try:
+		headers = {'Range': 'bytes=%d-' % offset} if offset > 0 else {}
+		response = requests.get(params['resource_path'], headers=headers, stream=True, timeout=DEFAULT_TIMEOUT)
+		response.raise_for_status()
+		# a server which ignores the range sends the whole file, so we skip to the offset ourselves
+		skip = offset if response.status_code != 206 else 0
+		for piece in response.iter_content(chunk_size=READ_SIZE):
+			if skip > 0:
+				skipped = min(skip, len(piece))
+				piece = piece[skipped:]
+				skip -= skipped
+				if len(piece) == 0:
+					continue
+			chunk_queue.put(piece)
+		chunk_queue.put(None)
+	except Exception as ex:
+		logging.error('Failed while reading from the Dropbox link')
+		chunk_queue.put(ex)
+
+
+def get_instance_name():
+	'''
+	Returns the name of this virtual machine
 	'''
 	headers = {'Metadata-Flavor':'Google'}
 	response = requests.get(HOSTNAME_REQUEST_URL, headers=headers)
 	content = response.content.decode('utf-8')
-	instance_name = content.split('.')[0]
+	return content.split('.')[0]
+
+
+def kill_instance(params):
+	'''
+	Removes the virtual machine
+	'''
+	instance_name = get_instance_name()
 	compute = build('compute', 'v1')
 	compute.instances().delete(project=params['google_project_id'],
 		zone=params['google_zone'], 
 	instance=instance_name).execute()
 
 
-def parse_args():
+def parse_args(argv=None):
 	parser = argparse.ArgumentParser()
 	parser.add_argument("-token", help="A token for identifying the container with the main application", dest='token', required=True)
 	parser.add_argument("-key", help="An encryption key for identifying the container with the main application", dest='enc_key', required=True)
-	parser.add_argument("-pk", help="The primary key of the transfer", dest='transfer_pk', required=True)
+	parser.add_argument("-pk", help="The primary key of the transfer", dest='transfer_pk')
 	parser.add_argument("-url", help="The callback URL for communicating with the main application", dest='callback_url', required=True)
-	parser.add_argument("-path", help="The source of the file that is being downloaded", dest='resource_path', required=True)
-	parser.add_argument("-destination", help="The bucket/object where the upload will be stored.  Include the gs:// prefix", dest='destination', required=True)
+	parser.add_argument("-path", help="The source of the file that is being downloaded", dest='resource_path')
+	parser.add_argument("-destination", help="The bucket/object where the upload will be stored.  Include the gs:// prefix", dest='destination')
 	parser.add_argument("-proj", help="Google project ID", dest='google_project_id', required=True)
 	parser.add_argument("-zone", help="Google project zone", dest='google_zone', required=True)
-	args = parser.parse_args()
+	parser.add_argument("-stream", help="Stream directly from the source into the bucket without writing to disk", dest='stream', action='store_true')
+	parser.add_argument("-connections", help="The number of concurrent connections used to download from the link", dest='connections', type=int, default=DEFAULT_CONNECTIONS)
+	parser.add_argument("-composite_threshold", help="Files at least this size (in MB) are uploaded as parallel composite parts.  Zero disables", dest='composite_threshold', type=int, default=DEFAULT_COMPOSITE_THRESHOLD_MB)
+	parser.add_argument("-composite_parts", help="The number of parts uploaded in parallel for a composite upload", dest='composite_parts', type=int, default=DEFAULT_COMPOSITE_PARTS)
+	parser.add_argument("-manifest", help="A base64-encoded JSON list with the parameters of each transfer, if more than one", dest='manifest')
+	parser.add_argument("-pool", help="Run as a pool worker for this pool, leasing transfers from the main application", dest='pool')
+	parser.add_argument("-lease_url", help="The URL for leasing transfers from the main application (pool workers only)", dest='lease_url')
+	parser.add_argument("-idle_timeout", help="Seconds a pool worker waits for work before removing itself", dest='idle_timeout', type=int, default=DEFAULT_IDLE_TIMEOUT)
+	parser.add_argument("-concurrency", help="The number of transfers from the manifest to run at the same time", dest='concurrency', type=int, default=DEFAULT_CONCURRENCY)
+	parser.add_argument("-checkpoint_url", help="The URL for sending checkpoints to the main application (Spot VMs only)", dest='checkpoint_url')
+	parser.add_argument("-checkpoint_interval", help="Seconds between checkpoints", dest='checkpoint_interval', type=int, default=DEFAULT_CHECKPOINT_INTERVAL)
+	parser.add_argument("-resume", help="A base64-encoded JSON checkpoint to resume the transfer from", dest='resume')
+	args = parser.parse_args(argv)
+	if args.pool is not None:
+		if args.lease_url is None:
+			parser.error('A pool worker requires -lease_url')
+	elif args.manifest is None:
+		missing = [x for x in ('transfer_pk', 'resource_path', 'destination') if getattr(args, x) is None]
+		if len(missing) > 0:
+			parser.error('Without a manifest, the following are required: %s' % ', '.join(missing))
 	params = {}
 	params['token'] = args.token
 	params['enc_key'] =  args.enc_key
@@ -135,21 +698,155 @@ def parse_args():
 	params['destination'] = args.destination
 	params['google_project_id'] = args.google_project_id
 	params['google_zone'] = args.google_zone
+	params['stream'] = args.stream
+	params['connections'] = args.connections
+	params['composite_threshold'] = args.composite_threshold*1024*1024
+	params['composite_parts'] = args.composite_parts
+	if args.manifest is None:
+		params['manifest'] = None
+	else:
+		params['manifest'] = json.loads(base64.b64decode(args.manifest).decode('utf-8'))
+	params['concurrency'] = max(1, args.concurrency)
+	params['pool'] = args.pool
+	params['lease_url'] = args.lease_url
+	params['idle_timeout'] = args.idle_timeout
+	params['checkpoint_url'] = args.checkpoint_url
+	params['checkpoint_interval'] = args.checkpoint_interval
+	if args.resume is None:
+		params['resume'] = None
+	else:
+		params['resume'] = json.loads(base64.b64decode(args.resume).decode('utf-8'))
 	return params
 
 
-if __name__ == '__main__':
+def run_transfer(params):
+	'''
+	Performs a single transfer and reports the outcome to the master.
+	Returns True if the transfer succeeded.
+	'''
 	try:
-		params = parse_args()
-		os.mkdir(WORKING_DIR)
-		logfile = create_logger()
-		params['logfile'] = logfile
-		local_filepath = download_to_disk(params)
-		send_to_bucket(local_filepath, params)
+		if params['stream']:
+			stream_to_bucket(read_from_link, params)
+		else:
+			local_filepath = download_to_disk(params)
+			send_to_bucket(local_filepath, params)
 		notify_master(params)
-		kill_instance(params)
+		return True
 	except Exception as ex:
-		logging.error('Caught some unexpected exception.')
+		logging.error('Caught some unexpected exception during transfer %s.' % params['transfer_pk'])
 		logging.error(str(type(ex)))
 		logging.error(ex)
+		if (params.get('checkpointer') is not None) and params['checkpointer'].preempted:
+			# the replacement VM finishes the transfer and reports the outcome
+			logging.info('Transfer %s was interrupted by preemption' % params['transfer_pk'])
+			return False
 		notify_master(params, error=True)
+		return False
+
+
+def get_transfer_params(params, entry):
+	'''
+	Combines the parameters common to the VM with those for a single transfer 
+	(a manifest entry or leased job), including a working directory for the transfer
+	'''
+	transfer_params = params.copy()
+	transfer_params.update(entry)
+	transfer_params['working_dir'] = os.path.join(WORKING_DIR, str(entry['transfer_pk']))
+	return transfer_params
+
+
+def run_in_directory(transfer_params):
+	'''
+	Runs the transfer in its own working directory, which is removed afterward
+	'''
+	os.mkdir(transfer_params['working_dir'])
+	try:
+		return run_transfer(transfer_params)
+	finally:
+		shutil.rmtree(transfer_params['working_dir'], ignore_errors=True)
+
+
+def run_manifest(params):
+	'''
+	Performs each transfer listed in the manifest, running at most params['concurrency'] 
+	at once.  Each transfer has its own working directory, which is removed when it finishes,
+	so the disk only needs to hold the files in progress.
+	Returns True if every transfer succeeded.
+	'''
+	all_transfer_params = [get_transfer_params(params, entry) for entry in params['manifest']]
+
+	logging.info('Starting %d transfers' % len(all_transfer_params))
+	with ThreadPoolExecutor(max_workers=params['concurrency']) as executor:
+		results = list(executor.map(run_in_directory, all_transfer_params))
+	return all(results)
+
+
+def lease_job(params, instance_name, idle):
+	'''
+	Asks the main application for a transfer.  Returns the response, which contains
+	'job' (the transfer's parameters, or None) and, if we should stop, 'retire'
+	'''
+	d = {}
+	d['token'] = get_encrypted_token(params)
+	d['pool'] = params['pool']
+	d['worker'] = instance_name
+	d['idle'] = 1 if idle else 0
+	response = requests.post(params['lease_url'], data=d, timeout=DEFAULT_TIMEOUT)
+	response.raise_for_status()
+	return response.json()
+
+
+def run_pool_worker(params):
+	'''
+	Leases transfers from the main application and runs them one at a time, staying
+	up between transfers so that each does not pay for starting a VM.  Returns once the 
+	worker has been idle (or unable to reach the application) for the idle timeout and the 
+	application agrees to let it retire.
+	'''
+	instance_name = get_instance_name()
+	logging.info('Starting pool worker %s for pool %s' % (instance_name, params['pool']))
+	idle_since = time.time()
+	while True:
+		idle = (time.time() - idle_since) > params['idle_timeout']
+		try:
+			response = lease_job(params, instance_name, idle)
+		except Exception as ex:
+			logging.error('Could not lease a job: %s' % ex)
+			if idle:
+				logging.error('Idle past the timeout and cannot reach the application.  Retiring.')
+				return
+			time.sleep(POLL_INTERVAL)
+			continue
+
+		if response.get('retire'):
+			logging.info('Retiring after being idle for %d seconds' % (time.time() - idle_since))
+			return
+		job = response.get('job')
+		if job is None:
+			time.sleep(POLL_INTERVAL)
+		else:
+			logging.info('Leased transfer %s' % job['transfer_pk'])
+			run_in_directory(get_transfer_params(params, job))
+			idle_since = time.time()
+
+
+if __name__ == '__main__':
+	params = parse_args()
+	os.mkdir(WORKING_DIR)
+	logfile = create_logger()
+	params['logfile'] = logfile
+	if params['pool'] is not None:
+		# transfers in a pool report their own outcome, so the VM is always removed
+		run_pool_worker(params)
+		success = True
+	elif params['manifest'] is None:
+		params['working_dir'] = WORKING_DIR
+		if params['checkpoint_url'] is not None:
+			params['checkpointer'] = start_checkpoints(params)
+		success = run_transfer(params)
+	else:
+		success = run_manifest(params)
+
+	# as before, a VM with a failed transfer is left up so it can be inspected
+	if success:
+		kill_instance(params)
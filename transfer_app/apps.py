@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class TransferAppConfig(AppConfig):
     name = 'transfer_app'
+
+    def ready(self):
+        # connects the handlers which record deletions (see signals.py)
+        import transfer_app.signals
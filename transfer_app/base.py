@@ -1,9 +1,259 @@
-from transfer_app.launchers import GoogleLauncher, AWSLauncher
+import os
+import json
+import uuid
+import datetime
+
+from django.conf import settings
+from django.urls import reverse
+from django.contrib.sites.models import Site
+from django.utils import timezone
+
+from celery import chord
+
+from transfer_app.launchers import GoogleLauncher, GoogleComputeLauncher, LocalLauncher, AWSLauncher, record_launch
+import transfer_app.exceptions as exceptions
+from transfer_app.models import Transfer, WorkerJob, PoolWorker, LaunchAttempt
+import transfer_app.scheduler as scheduler
+import transfer_app.utils as utils
 
 class GoogleBase(object):
     launcher_cls = GoogleLauncher
+    local_launcher_cls = LocalLauncher
     config_keys = ['google',]
 
+    # the script run by the worker VMs, relative to the project directory.  Set by the subclasses
+    worker_script = None
+
+    # maps the worker's parameter names to its command-line flags.  Set by the subclasses
+    worker_flags = {}
+
+    # the available ways of starting VMs, chosen with 'launcher' in the config:
+    launcher_classes = {
+        'gcloud': GoogleLauncher,
+        'api': GoogleComputeLauncher
+    }
+
+    def _create_launcher(self):
+        launcher_name = self.config_params.get('launcher', 'gcloud')
+        try:
+            return self.launcher_classes[launcher_name]()
+        except KeyError as ex:
+            raise exceptions.ExceptionWithMessage('Unknown launcher "%s".  Choose from: %s' % (launcher_name, ', '.join(self.launcher_classes.keys())))
+
+    def _instance_name(self, custom_config, index):
+        # the timestamp is only to the second, and batches are often started together,
+        # so the random suffix keeps the names (which identify the VMs) unique:
+        return '%s-%s-%s-%s' % (custom_config['instance_name_prefix'], \
+            datetime.datetime.now().strftime('%m%d%y%H%M%S'), \
+            index,
+            uuid.uuid4().hex[:8]
+        )
+
+    def _record_shape(self, spec):
+        '''
+        Records the shape of the VM on the Transfers it will run, so that
+        throughput can be compared across shapes
+        '''
+        Transfer.objects.filter(pk__in=spec['transfer_pks']).update(machine_type=spec['machine_type'],
+            disk_type=spec['disk_type'],
+            disk_size_gb=spec['disk_size_gb']
+        )
+
+    def _split_local_items(self, custom_config, items):
+        '''
+        Separates the transfers that are small enough to run here (rather than on a VM) 
+        from the rest.  Returns a tuple of two lists: (local items, other items)
+
+        A size of zero means the size was not given (see the uploaders), so those
+        transfers are not assumed to be small.
+        '''
+        max_size = float(custom_config['local_transfer_max_size_mb'])*1e6
+        is_local = lambda x: (x['size_in_bytes'] > 0) and (x['size_in_bytes'] <= max_size)
+        local_items = [x for x in items if is_local(x)]
+        other_items = [x for x in items if not is_local(x)]
+        return local_items, other_items
+
+    def _run_locally(self, custom_config, items):
+        '''
+        Runs the transfers with the worker script in this process, returning once they
+        have finished and been marked complete.  The worker gets the same args it would on a VM.
+        '''
+        script_path = os.path.join(settings.BASE_DIR, self.worker_script)
+        launcher = self.local_launcher_cls(script_path, int(custom_config['local_transfer_concurrency']))
+        for item in items:
+            spec = self._prep_instance(custom_config, 'local', [item,])
+            spec['container_args'].extend(self._transfer_args(custom_config, [item,]))
+            spec['transfer_pks'] = [item['transfer_pk'],]
+            launcher.go(spec)
+        launcher.wait()
+
+    def _pool_enabled(self, custom_config):
+        return int(custom_config['worker_pool_size']) > 0
+
+    def _split_pool_items(self, custom_config, items):
+        '''
+        Separates the transfers that are small enough to hand to the warm pool
+        from those that get their own VM.  Returns a tuple of two lists: (pool items, other items)
+        '''
+        max_size = float(custom_config['worker_pool_max_file_size_gb'])*1e9
+        pool_items = [x for x in items if x['size_in_bytes'] <= max_size]
+        other_items = [x for x in items if x['size_in_bytes'] > max_size]
+        return pool_items, other_items
+
+    def _queue_for_pool(self, custom_config, items):
+        '''
+        Queues the transfers as WorkerJobs for the pool workers to lease, and then
+        starts more pool workers if needed
+        '''
+        pool = custom_config['instance_name_prefix']
+        for item in items:
+            WorkerJob.objects.create(transfer_id=item['transfer_pk'],
+                pool=pool,
+                spec=json.dumps(self._manifest_entry(custom_config, item))
+            )
+        self._scale_pool(custom_config)
+
+    def _scale_pool(self, custom_config):
+        '''
+        Starts pool workers until there is one per outstanding job, up to worker_pool_size.
+        Idle workers remove themselves (see the worker's idle timeout), so there is no scale-down here.
+
+        A worker asks for work every few seconds while idle, so one that has not been heard
+        from in worker_pool_stale_seconds (and is not running a job) is assumed to be gone.
+        '''
+        pool = custom_config['instance_name_prefix']
+        now = timezone.now()
+        stale_cutoff = now - datetime.timedelta(seconds=int(custom_config['worker_pool_stale_seconds']))
+        busy_workers = WorkerJob.objects.filter(pool=pool, leased_by__isnull=False).values('leased_by')
+        stale_workers = PoolWorker.objects.filter(pool=pool, last_seen__lt=stale_cutoff).exclude(instance_name__in=busy_workers)
+        stale_names = list(stale_workers.values_list('instance_name', flat=True))
+        if len(stale_names) > 0:
+            stale_workers.delete()
+            scheduler.workers_finished(stale_names)
+
+        live_workers = PoolWorker.objects.filter(pool=pool).count()
+        outstanding_jobs = WorkerJob.objects.filter(pool=pool).count()
+        num_to_start = min(int(custom_config['worker_pool_size']), outstanding_jobs) - live_workers
+
+        if num_to_start <= 0:
+            return
+
+        # The pool workers are identical, so they are started with a single launch spec
+        # (which the launcher can create with one request).
+        # The disk is sized for the largest transfer the pool accepts.
+        instance_names = [self._instance_name(custom_config, 'pool-%d' % i) for i in range(num_to_start)]
+        largest_item = {'size_in_bytes': float(custom_config['worker_pool_max_file_size_gb'])*1e9}
+        spec = self._prep_instance(custom_config, instance_names[0], [largest_item,])
+        spec['instance_names'] = instance_names
+        spec['container_args'].extend(self._pool_args(custom_config))
+        for instance_name in instance_names:
+            PoolWorker.objects.create(instance_name=instance_name, pool=pool, last_seen=now)
+        self._launch(spec)
+        self.launcher.wait()
+
+    def _launch(self, spec):
+        '''
+        Passes the launch spec to the launcher, less any VMs that the scheduler 
+        queued because they would exceed the caps on running VMs.  If the launcher
+        cannot take the spec, that is recorded as a failed launch.
+        '''
+        admitted_spec = scheduler.admit(spec, self.config_params.get('launcher', 'gcloud'))
+        if admitted_spec is None:
+            return
+        try:
+            self.launcher.go(admitted_spec)
+        except Exception as ex:
+            # recorded on the LaunchAttempts the scheduler created for it:
+            print('Could not launch %s: %s' % (', '.join(admitted_spec['instance_names']), ex))
+            record_launch(admitted_spec, LaunchAttempt.FAILED, error=str(ex))
+
+    def _use_spot(self, custom_config, items):
+        '''
+        Returns True if the VM for these transfers should be a Spot VM.  Only a VM with a single,
+        large transfer is, since the checkpoints (and the replacement VM) are per transfer.
+        '''
+        min_size = float(custom_config['spot_min_size_gb'])*1e9
+        return (min_size > 0) and (len(items) == 1) and (items[0]['size_in_bytes'] >= min_size)
+
+    def _spot_args(self, custom_config):
+        '''
+        Returns the container args (a list) that have the worker checkpoint its transfer, so
+        that it can be resumed on a replacement VM if the Spot VM is preempted
+        '''
+        current_site = Site.objects.get_current()
+        checkpoint_url = 'https://%s%s' % (current_site.domain, reverse('transfer-checkpoint'))
+        return ['-checkpoint_url', checkpoint_url,
+            '-checkpoint_interval', custom_config['checkpoint_interval']
+        ]
+
+    def _launch_all(self, custom_config, specs):
+        '''
+        Starts the VMs for the launch specs of a batch.  A batch with at least launch_fanout_min_vms
+        specs is fanned out, with one launch task per spec, so that the launches are spread
+        over the celery workers (see _fan_out).  Smaller batches are launched here.
+        Either way, a spec that cannot be launched is recorded as a failed launch, 
+        and does not stop the others.
+        '''
+        fanout_min = int(custom_config['launch_fanout_min_vms'])
+        if (fanout_min > 0) and (len(specs) >= fanout_min):
+            self._fan_out(specs)
+            return
+        for spec in specs:
+            try:
+                self._launch(spec)
+            except Exception as ex:
+                print('Could not launch %s: %s' % (', '.join(spec['instance_names']), ex))
+                record_launch(spec, LaunchAttempt.FAILED, error=str(ex))
+
+        # wait until the launcher has sent all the requests:
+        self.launcher.wait()
+
+    def _fan_out(self, specs):
+        '''
+        Queues a launch task for each spec.  The chord runs finish_launches once
+        every launch has been sent (or has failed).
+        '''
+        # imported here since the tasks module imports (indirectly) this module
+        from transfer_app.tasks import launch_vm, finish_launches
+        launcher_name = self.config_params.get('launcher', 'gcloud')
+        chord([launch_vm.s(spec, launcher_name) for spec in specs])(finish_launches.s())
+
+    def _pool_args(self, custom_config):
+        '''
+        Returns the container args (a list) that put a worker in pool mode, where it leases
+        jobs from the application until it has been idle for the timeout
+        '''
+        current_site = Site.objects.get_current()
+        lease_url = 'https://%s%s' % (current_site.domain, reverse('worker-lease'))
+        return ['-pool', custom_config['instance_name_prefix'],
+            '-lease_url', lease_url,
+            '-idle_timeout', custom_config['worker_pool_idle_timeout']
+        ]
+
+    def _transfer_args(self, custom_config, items):
+        '''
+        Returns the container args (a list) describing the transfers.  A single transfer is given
+        with the usual flags (see worker_flags).  Several transfers are sent as a manifest,
+        which the worker works through with a bounded number running at once.
+        '''
+        entries = [self._manifest_entry(custom_config, item) for item in items]
+        if len(entries) == 1:
+            args = []
+            for key, value in entries[0].items():
+                args.extend([self.worker_flags[key], str(value)])
+            return args
+        return ['-manifest', utils.encode_manifest(entries), '-concurrency', custom_config['batch_concurrency']]
+
+    def _manifest_entry(self, custom_config, item):
+        '''
+        Returns a dict of the values the worker needs for this particular transfer, keyed
+        by the worker's parameter names.  Implemented by the subclasses.
+        '''
+        raise NotImplementedError
+
 class AWSBase(object):
     launcher_cls = AWSLauncher
     config_keys = ['aws',]
+
+    def _create_launcher(self):
+        return self.launcher_cls()
@@ -19,6 +19,7 @@ from django.http import HttpResponseRedirect, HttpResponse, JsonResponse
 from django.urls import reverse
 from django.contrib.sites.models import Site
 from django.contrib.auth import get_user_model
+from django.db import transaction
 from rest_framework.exceptions import MethodNotAllowed
 
 import dropbox
@@ -26,8 +27,12 @@ import google.oauth2.credentials
 from googleapiclient.discovery import build
 
 import transfer_app.utils as utils
+import transfer_app.events as events
 from transfer_app.base import GoogleBase, AWSBase
+import transfer_app.launchers as _launchers
+from transfer_app.sizing import get_sizing_policy
 from transfer_app import tasks as transfer_tasks
+import transfer_app.submissions as submissions
 import transfer_app.exceptions as exceptions
 from transfer_app.models import Resource, Transfer, TransferCoordinator
 
@@ -83,8 +88,10 @@ class Downloader(object):
                There were no valid resources to download.                
             ''')   
 
-    def __init__(self, download_data):
+    def __init__(self, download_data, batch_id=None):
         self.download_data = download_data
+        # the id given to the batch when it was submitted (see submissions.py), if any
+        self.batch_id = batch_id
 
     def _transfer_setup(self):
         '''
@@ -95,15 +102,21 @@ class Downloader(object):
         item in the list is a dict.  Each dict NEEDS to have certain keys (see code)
 
         '''
-        if len(self.download_data) > 0:
-            tc = TransferCoordinator()
-            tc.save()
-        else:
+        if len(self.download_data) == 0:
             return
 
+        # look up all the users and resources at once, rather than per item:
+        user_pks = set([x['originator'] for x in self.download_data])
+        users = get_user_model().objects.in_bulk(user_pks)
+        if len(users) < len(user_pks):
+            raise get_user_model().DoesNotExist('Unknown user(s): %s' % ', '.join([str(x) for x in user_pks if x not in users]))
+        resource_pks = set([x['resource_pk'] for x in self.download_data])
+        resources = Resource.objects.in_bulk(resource_pks)
+        if len(resources) < len(resource_pks):
+            raise Resource.DoesNotExist('Unknown resource(s): %s' % ', '.join([str(x) for x in resource_pks if x not in resources]))
+
         for item in self.download_data:
-            originator = get_user_model().objects.get(pk=item['originator'])
-            resource = Resource.objects.get(pk=item['resource_pk'])
+            resource = resources[item['resource_pk']]
 
             # we obviously need the path where the resource is:
             item['path'] = resource.path
@@ -112,19 +125,29 @@ class Downloader(object):
             # know how large to size the transfer VM
             item['size_in_bytes'] = resource.size
 
-            t = Transfer(
-                 download=True,
-                 resource=resource,
-                 destination=item['destination'],
-                 coordinator=tc,
-                 originator = originator
+        with transaction.atomic():
+            tc = TransferCoordinator(batch_id=self.batch_id,
+                total_transfers=len(self.download_data),
+                total_bytes=sum([x['size_in_bytes'] for x in self.download_data])
             )
-            t.save()
-
-            # finally add the transfer primary key to the dictionary so we will
-            # be able to track the transfers
+            tc.save()
+            transfers = [Transfer(
+                    download=True,
+                    resource=resources[item['resource_pk']],
+                    destination=item['destination'],
+                    coordinator=tc,
+                    originator = users[item['originator']]
+                ) for item in self.download_data]
+            utils.bulk_create_with_pks(Transfer, transfers, ('coordinator', 'resource', 'destination'))
+
+        # finally add the transfer primary key to the dictionary so we will
+        # be able to track the transfers
+        for item, t in zip(self.download_data, transfers):
             item['transfer_pk'] = t.pk
 
+        events.publish_transfers([t.pk for t in transfers])
+        events.publish_batch(tc)
+
 
 class DropboxDownloader(Downloader):
 
@@ -217,6 +240,8 @@ class DropboxDownloader(Downloader):
             for item in download_info:
                 size_in_bytes = Resource.objects.get(pk=item['resource_pk']).size
                 running_total += size_in_bytes
+                # the size also decides which celery queue the batch goes to (see routing.py):
+                item['size_in_bytes'] = size_in_bytes
                 if running_total < space_remaining_in_bytes:
                     item['access_token'] = access_token
                     passing_items.append(item)
@@ -226,18 +251,20 @@ class DropboxDownloader(Downloader):
 
             at_least_one_transfer = len(passing_items) > 0
             if not problem:
-                # call async method:
-                transfer_tasks.download.delay(passing_items, request.session['download_destination'])
+                # call async method.  A repeat of a recent submission is not started again:
+                batch_id, submitted = submissions.submit_once(transfer_tasks.download, passing_items, request.session['download_destination'], request.user.pk)
                 context = {'email_enabled': settings.EMAIL_ENABLED, 
                     'problem': problem, 
-                    'at_least_one_transfer':at_least_one_transfer
+                    'at_least_one_transfer':at_least_one_transfer,
+                    'duplicate': not submitted
                 }
                 return render(request, 'transfer_app/download_started.html', context)
             else:
                 # if there was a problem-- could not fit all files
                 # Still initiate the good transfers
+                submitted = True
                 if len(passing_items) > 0:
-                    transfer_tasks.download.delay(passing_items, request.session['download_destination'])
+                    batch_id, submitted = submissions.submit_once(transfer_tasks.download, passing_items, request.session['download_destination'], request.user.pk)
                 warning_list = []
                 for item in failed_items:
                     resource_name = Resource.objects.get(pk=item['resource_pk']).name
@@ -246,6 +273,7 @@ class DropboxDownloader(Downloader):
                     'email_enabled': settings.EMAIL_ENABLED,
                     'problem': problem,
                     'at_least_one_transfer':at_least_one_transfer,
+                    'duplicate': not submitted,
                     'warnings': warning_list
                 }
                 return render(request, 'transfer_app/download_started.html', context)
@@ -357,6 +385,7 @@ class DriveDownloader(Downloader):
                 for item in download_info:
                     size_in_bytes = Resource.objects.get(pk=item['resource_pk']).size
                     running_total += size_in_bytes
+                    item['size_in_bytes'] = size_in_bytes
                     if (running_total < space_remaining_in_bytes):
                         passing_items.append(item)
                     else:
@@ -367,21 +396,26 @@ class DriveDownloader(Downloader):
 
             for item in passing_items:
                 item['access_token'] = access_token
+                # the size also decides which celery queue the batch goes to (see routing.py):
+                if 'size_in_bytes' not in item:
+                    item['size_in_bytes'] = Resource.objects.get(pk=item['resource_pk']).size
 
             at_least_one_transfer = len(passing_items) > 0
             if not problem:
-                # call async method:
-                transfer_tasks.download.delay(passing_items, request.session['download_destination'])
+                # call async method.  A repeat of a recent submission is not started again:
+                batch_id, submitted = submissions.submit_once(transfer_tasks.download, passing_items, request.session['download_destination'], request.user.pk)
                 context = {'email_enabled': settings.EMAIL_ENABLED, 
                     'problem': problem, 
-                    'at_least_one_transfer':at_least_one_transfer
+                    'at_least_one_transfer':at_least_one_transfer,
+                    'duplicate': not submitted
                 }
                 return render(request, 'transfer_app/download_started.html', context)
             else:
                 # if there was a problem-- could not fit all files
                 # Still initiate the good transfers
+                submitted = True
                 if len(passing_items) > 0:
-                    transfer_tasks.download.delay(passing_items, request.session['download_destination'])
+                    batch_id, submitted = submissions.submit_once(transfer_tasks.download, passing_items, request.session['download_destination'], request.user.pk)
                 warning_list = []
                 for item in failed_items:
                     resource_name = Resource.objects.get(pk=item['resource_pk']).name
@@ -390,6 +424,7 @@ class DriveDownloader(Downloader):
                     'email_enabled': settings.EMAIL_ENABLED,
                     'problem': problem,
                     'at_least_one_transfer':at_least_one_transfer,
+                    'duplicate': not submitted,
                     'warnings': warning_list
                 }
                 return render(request, 'transfer_app/download_started.html', context)
@@ -402,10 +437,9 @@ class EnvironmentSpecificDownloader(object):
     config_key_list = []
     config_file = settings.DOWNLOADER_CONFIG['CONFIG_PATH']
 
-    def __init__(self, download_data):
+    def __init__(self, download_data, batch_id=None):
         #instantiate the wrapped classes:
-        self.downloader = self.downloader_cls(download_data)
-        self.launcher = self.launcher_cls()
+        self.downloader = self.downloader_cls(download_data, batch_id)
 
         # get the config params for the downloader:
         downloader_cfg = self.downloader_cls.get_config(self.config_file)
@@ -413,6 +447,9 @@ class EnvironmentSpecificDownloader(object):
         downloader_cfg.update(additional_cfg)
         self.config_params = downloader_cfg
 
+        # the config can choose how VMs are started, so this comes after loading it
+        self.launcher = self._create_launcher()
+
     @classmethod
     def authenticate(cls, request):
         return cls.downloader_cls.authenticate(cls.config_file, request)
@@ -430,15 +467,6 @@ class EnvironmentSpecificDownloader(object):
 class GoogleEnvironmentDownloader(EnvironmentSpecificDownloader, GoogleBase):
 
 
-    gcloud_cmd_template = '''{gcloud} beta compute --project={google_project_id} instances \
-                             create-with-container {instance_name} \
-                             --zone={google_zone} \
-                             --scopes={scopes} \
-                             --machine-type={machine_type} \
-                             --boot-disk-size={disk_size_gb}GB \
-                             --metadata=google-logging-enabled=true \
-                             --container-image={docker_image} \
-                             --no-restart-on-failure --container-restart-policy=never'''
     @classmethod
     def check_format(cls, download_info, user_pk):
         '''
@@ -471,19 +499,21 @@ class GoogleEnvironmentDownloader(EnvironmentSpecificDownloader, GoogleBase):
         # Thus, it's ok to grab the first element of the list and know that 
         # each download has the same originator
         originator_pk = download_data[0]['originator']
-        originator = get_user_model().objects.get(pk=originator_pk)
 
-        # get all the incomplete transfers started by this user:
-        all_incomplete_transfers = Transfer.objects.filter(completed=False, originator=originator)
-        resource_pks_for_incomplete_transfers = [x.resource.pk for x in all_incomplete_transfers]
+        # get the incomplete transfers of the requested resources started by this user
+        # (see the indexes on Transfer), with the paths for the messages:
+        requested_resource_pks = [x['resource_pk'] for x in download_data]
+        incomplete_transfers = Transfer.objects.filter(completed=False, 
+            originator_id=originator_pk, 
+            resource_id__in=requested_resource_pks)
+        paths_in_progress = dict(incomplete_transfers.values_list('resource_id', 'resource__path'))
 
         new_transfers = []
         error_messages = []
         for item in download_data:
             # check if this resource is already being transferred:
-            if item['resource_pk'] in resource_pks_for_incomplete_transfers:
-                resource = Resource.objects.get(pk = item['resource_pk'])
-                filename = os.path.basename(resource.path)
+            if item['resource_pk'] in paths_in_progress:
+                filename = os.path.basename(paths_in_progress[item['resource_pk']])
                 msg = '''The file with name %s is already in progress.  
                         If you wish to overwrite, please wait until the download is complete and
                         try again, if available.''' % filename
@@ -493,56 +523,91 @@ class GoogleEnvironmentDownloader(EnvironmentSpecificDownloader, GoogleBase):
         # reassign self.upload_data now that we have checked for existing transfers:
         return new_transfers, error_messages
 
-    def __init__(self, download_data):
-        self.config_key_list.extend(GoogleBase.config_keys)
-        super().__init__(download_data)
-
-    def _prep_single_download(self, custom_config, index, item):
-
-        disk_size_factor = float(custom_config['disk_size_factor'])
-        min_disk_size = int(float(custom_config['min_disk_size']))
+    def __init__(self, download_data, batch_id=None):
+        self.config_key_list = self.config_key_list + GoogleBase.config_keys
+        super().__init__(download_data, batch_id)
 
+    def _prep_instance(self, custom_config, instance_name, items):
+        '''
+        Builds the launch spec for the worker VM named `instance_name` which will run the 
+        transfers in `items` (a list of the item dicts).  The spec is a dict describing the
+        machine and the container, and is turned into an actual VM by the launcher.  
+        Its container args are those common to every transfer; the caller adds the 
+        per-transfer args.
+        '''
         # construct a callback so the worker can communicate back to the application server:
         callback_url = reverse('transfer-complete')
         current_site = Site.objects.get_current()
         domain = current_site.domain
         full_callback_url = 'https://%s%s' % (domain, callback_url)
 
-        docker_image = custom_config['docker_image']
-
-        instance_name = '%s-%s-%s' % (custom_config['instance_name_prefix'], \
-            datetime.datetime.now().strftime('%m%d%y%H%M%S'), \
-            index
-        )
-
-        # approx size in Gb so we can size the VM appropriately
-        size_in_gb = item['size_in_bytes']/1e9
-        target_disk_size = int(disk_size_factor*size_in_gb)
-        if target_disk_size < min_disk_size:
-            target_disk_size = min_disk_size
-
-        # fill out the template command:
-        cmd = self.gcloud_cmd_template.format(gcloud=os.environ['GCLOUD'],
-            google_project_id = settings.CONFIG_PARAMS['google_project_id'],
-            google_zone = settings.CONFIG_PARAMS['google_zone'],
-            instance_name = instance_name,
-            scopes = custom_config['scopes'],
-            machine_type = custom_config['machine_type'],
-            disk_size_gb = target_disk_size,
-            docker_image = custom_config['docker_image']
-        )
+        # the machine and disk are chosen by the sizing policy:
+        stream = utils.get_boolean(custom_config, 'stream_transfers')
+        shape = get_sizing_policy(custom_config).choose(items, True, self.downloader_cls.destination)
+
+        spec = {
+            'instance_names': [instance_name,],
+            'project': settings.CONFIG_PARAMS['google_project_id'],
+            'zone': settings.CONFIG_PARAMS['google_zone'],
+            'scopes': custom_config['scopes'],
+            'machine_type': shape['machine_type'],
+            'disk_type': shape['disk_type'],
+            'disk_size_gb': shape['disk_size_gb'],
+            'docker_image': custom_config['docker_image'],
+            'transfer_pks': [],
+        }
 
-        # Since these are passed via the gcloud command, the arg strings are a bit strange
         # These should be common to all google-environment activity.  
         # Args specific to the particular downloader should be handled in the subclass
-        cmd += ' --container-arg="-token" --container-arg="%s"' % settings.CONFIG_PARAMS['token']
-        cmd += ' --container-arg="-key" --container-arg="%s"' % settings.CONFIG_PARAMS['enc_key']
-        cmd += ' --container-arg="-pk" --container-arg="%s"' % item['transfer_pk']
-        cmd += ' --container-arg="-url" --container-arg="%s"' % full_callback_url
-        cmd += ' --container-arg="-path" --container-arg="%s"' % item['path']
-        cmd += ' --container-arg="-proj" --container-arg="%s"' % settings.CONFIG_PARAMS['google_project_id']
-        cmd += ' --container-arg="-zone" --container-arg="%s"' % settings.CONFIG_PARAMS['google_zone']
-        return cmd
+        spec['container_args'] = [
+            '-token', settings.CONFIG_PARAMS['token'],
+            '-key', settings.CONFIG_PARAMS['enc_key'],
+            '-url', full_callback_url,
+            '-proj', settings.CONFIG_PARAMS['google_project_id'],
+            '-zone', settings.CONFIG_PARAMS['google_zone'],
+            '-slices', custom_config['download_slices'],
+            '-slice_size', custom_config['slice_size_mb'],
+        ]
+        if stream:
+            spec['container_args'].append('-stream')
+        return spec
+
+    def config_and_start_downloads(self):
+
+        custom_config = copy.deepcopy(self.config_params)
+
+        items = self.downloader.download_data
+
+        # the smallest transfers are run right here, which is much faster than starting a VM:
+        local_items, items = self._split_local_items(custom_config, items)
+
+        # small transfers can go to the warm pool, if it is enabled:
+        if self._pool_enabled(custom_config):
+            pool_items, items = self._split_pool_items(custom_config, items)
+            if len(pool_items) > 0:
+                self._queue_for_pool(custom_config, pool_items)
+
+        # decide which of the remaining transfers share a VM:
+        groups = _launchers.group_transfers(items, 
+            int(custom_config['batch_max_items']),
+            float(custom_config['batch_max_size_gb'])*1e9
+        )
+        specs = []
+        for i, items in enumerate(groups):
+            instance_name = self._instance_name(custom_config, i)
+            spec = self._prep_instance(custom_config, instance_name, items)
+            spec['container_args'].extend(self._transfer_args(custom_config, items))
+            spec['transfer_pks'] = [x['transfer_pk'] for x in items]
+            if self._use_spot(custom_config, items):
+                spec['spot'] = True
+                spec['container_args'].extend(self._spot_args(custom_config))
+            self._record_shape(spec)
+            specs.append(spec)
+        self._launch_all(custom_config, specs)
+
+        # the VMs start up while the local transfers run:
+        if len(local_items) > 0:
+            self._run_locally(custom_config, local_items)
 
 class AWSEnvironmentDownloader(EnvironmentSpecificDownloader, AWSBase):
     pass
@@ -551,37 +616,54 @@ class AWSEnvironmentDownloader(EnvironmentSpecificDownloader, AWSBase):
 class GoogleDropboxDownloader(GoogleEnvironmentDownloader):
     downloader_cls = DropboxDownloader
     config_keys = ['dropbox_in_google',]
+    worker_script = os.path.join('startup_scripts', 'google', 'downloads', 'dropbox', 'container_startup.py')
 
-    def __init__(self, download_data):
-        self.config_key_list.extend(GoogleDropboxDownloader.config_keys)
-        super().__init__(download_data)
+    # maps the worker's parameter names to its command-line flags
+    worker_flags = {
+        'transfer_pk': '-pk',
+        'resource_path': '-path',
+        'access_token': '-dropbox'
+    }
 
-    def config_and_start_downloads(self):
+    def __init__(self, download_data, batch_id=None):
+        self.config_key_list = self.config_key_list + GoogleDropboxDownloader.config_keys
+        super().__init__(download_data, batch_id)
 
-        custom_config = copy.deepcopy(self.config_params)
+    def _prep_instance(self, custom_config, instance_name, items):
+        spec = super()._prep_instance(custom_config, instance_name, items)
+        spec['container_args'].extend(['-d', custom_config['dropbox_destination_folderpath']])
+        return spec
 
-        for i, item in enumerate(self.downloader.download_data):
-            cmd = self._prep_single_download(custom_config, i, item)
-            cmd += ' --container-arg="-dropbox" --container-arg="%s"' % item['access_token']
-            cmd += ' --container-arg="-d" --container-arg="%s"' % custom_config['dropbox_destination_folderpath']
-            self.launcher.go(cmd)
+    def _manifest_entry(self, custom_config, item):
+        return {
+            'transfer_pk': item['transfer_pk'],
+            'resource_path': item['path'],
+            'access_token': item['access_token']
+        }
 
 
 class GoogleDriveDownloader(GoogleEnvironmentDownloader):
     downloader_cls = DriveDownloader
     config_keys = ['drive_in_google',]
+    worker_script = os.path.join('startup_scripts', 'google', 'downloads', 'google_drive', 'container_startup.py')
 
-    def __init__(self, download_data):
-        self.config_key_list.extend(GoogleDriveDownloader.config_keys)
-        super().__init__(download_data)
+    # maps the worker's parameter names to its command-line flags
+    worker_flags = {
+        'transfer_pk': '-pk',
+        'resource_path': '-path',
+        'access_token': '-access_token'
+    }
 
-    def config_and_start_downloads(self):
-        custom_config = copy.deepcopy(self.config_params)
-        for i, item in enumerate(self.downloader.download_data):
+    def __init__(self, download_data, batch_id=None):
+        self.config_key_list = self.config_key_list + GoogleDriveDownloader.config_keys
+        super().__init__(download_data, batch_id)
 
-            cmd = self._prep_single_download(custom_config, i, item)
-            cmd += ' --container-arg="-access_token" --container-arg="%s"' % item['access_token'] # the oauth2 access token
-            self.launcher.go(cmd)
+    def _manifest_entry(self, custom_config, item):
+        return {
+            'transfer_pk': item['transfer_pk'],
+            'resource_path': item['path'],
+            'access_token': item['access_token'] # the oauth2 access token
+        }
 
 
 class AWSDropboxDownloader(AWSEnvironmentDownloader):
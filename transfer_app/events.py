@@ -0,0 +1,142 @@
+'''
+Pushes changes to Transfers and TransferCoordinators to the users who started them,
+so that the front page can update without polling the listings.
+
+Changes are published on a redis channel per user (redis is already running as the
+celery broker), and each open page holds a stream of server-sent events (see
+views.TransferEvents) subscribed to its user's channel.  There are two kinds of event,
+each carrying the serialized object:
+  - transfer: a Transfer was created or completed (as in the transferred-resources listing)
+  - batch: a TransferCoordinator's counts changed (as in the batch listing)
+
+Publishing is best-effort: if redis cannot be reached, the change is only visible
+through the listings.
+
+Each event has an id, the time it was sent.  A browser reconnecting after its stream
+closed sends the id of the last event it got (the Last-Event-ID header), and the new stream
+starts by replaying the Transfers changed since then (by their updated_at), so nothing
+published in between is lost.  Batch events are not replayed: the counts are in the listing.
+'''
+import json
+import time
+import datetime
+
+import redis
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from transfer_app.models import Transfer
+from transfer_app.serializers import TransferredResourceSerializer, TransferCoordinatorSerializer
+
+
+CHANNEL_PREFIX = 'transfer-events:'
+
+# how long the browser waits before reconnecting a closed stream, in milliseconds:
+RECONNECT_MS = 3000
+
+# A change is published shortly after it is stamped, so the replay starts a little before
+# the last event the browser got, in case a change was stamped before it but published after:
+REPLAY_MARGIN_SECONDS = 5
+
+# the most Transfers replayed to a reconnecting stream.  A page which has missed more
+# (e.g. after sleeping for a long time) is sent a 'reset' event, and reloads the history:
+MAX_REPLAY = 500
+
+
+def get_redis():
+    return redis.StrictRedis.from_url(settings.CELERY_BROKER_URL)
+
+
+def user_channel(user_pk):
+    return '%s%s' % (CHANNEL_PREFIX, user_pk)
+
+
+def publish(messages):
+    '''
+    Publishes the messages, a list of (user pk, event name, data) tuples, in one round trip
+    '''
+    if len(messages) == 0:
+        return
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        for user_pk, event, data in messages:
+            pipe.publish(user_channel(user_pk), json.dumps({'event': event, 'data': data}))
+        pipe.execute()
+    except redis.RedisError as ex:
+        print('Could not publish transfer events: %s' % ex)
+
+
+def publish_transfers(transfer_pks):
+    '''
+    Publishes the current state of the Transfers to their originators
+    '''
+    transfers = Transfer.objects.filter(pk__in=transfer_pks).select_related('resource')
+    publish([(t.originator_id, 'transfer', TransferredResourceSerializer(t).data) for t in transfers])
+
+
+def publish_batch(transfer_coordinator):
+    '''
+    Publishes the current state of the TransferCoordinator to the originators of its Transfers
+    '''
+    data = TransferCoordinatorSerializer(transfer_coordinator).data
+    originators = Transfer.objects.filter(coordinator=transfer_coordinator).values_list('originator', flat=True).distinct()
+    publish([(x, 'batch', data) for x in originators])
+
+
+def event_id():
+    return timezone.now().isoformat()
+
+
+def format_event(event, data, id=None):
+    id_line = '' if id is None else 'id: %s\n' % id
+    return '%sevent: %s\ndata: %s\n\n' % (id_line, event, json.dumps(data))
+
+
+def replay(user_pk, last_event_id):
+    '''
+    Returns the events (a list of strings) for the user's Transfers changed since the
+    event with id last_event_id, or an empty list if there is no (valid) id
+    '''
+    try:
+        since = parse_datetime(last_event_id or '')
+    except ValueError:
+        since = None
+    if since is None:
+        return []
+    since = since - datetime.timedelta(seconds=REPLAY_MARGIN_SECONDS)
+    transfers = Transfer.objects.filter(originator=user_pk, updated_at__gte=since).select_related('resource')
+    transfers = list(transfers.order_by('updated_at', 'id')[:MAX_REPLAY + 1])
+    if len(transfers) > MAX_REPLAY:
+        return [format_event('reset', {})]
+    return [format_event('transfer', TransferredResourceSerializer(t).data) for t in transfers]
+
+
+def stream(user_pk, heartbeat_seconds, max_seconds, last_event_id=None):
+    '''
+    Generates the server-sent events for the user, as strings in the text/event-stream format,
+    starting with the changes since last_event_id (see replay).
+    A comment is sent when there has been nothing else for heartbeat_seconds, which keeps
+    proxies from closing the connection.  The stream ends after max_seconds, so that it does not
+    hold an application server connection indefinitely; the browser then reconnects by itself.
+
+    Every message carries an id (even those without an event, which only update the browser's
+    last id), so the replay after a reconnect covers no more than the time since the last message.
+    '''
+    # subscribed before the replay, so that a change made meanwhile is in one or the other:
+    pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(user_channel(user_pk))
+    try:
+        yield 'retry: %d\nid: %s\n\n' % (RECONNECT_MS, event_id())
+        for event in replay(user_pk, last_event_id):
+            yield event
+        deadline = time.time() + max_seconds
+        while time.time() < deadline:
+            message = pubsub.get_message(timeout=heartbeat_seconds)
+            if message is None:
+                yield 'id: %s\n: keepalive\n\n' % event_id()
+            else:
+                payload = json.loads(message['data'])
+                yield format_event(payload['event'], payload['data'], event_id())
+    finally:
+        pubsub.close()
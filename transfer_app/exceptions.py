@@ -28,3 +28,8 @@ class FilenameException(ExceptionWithMessage):
     pass
 
 
+
+class CursorExpired(APIException):
+    status_code = status.HTTP_410_GONE
+    default_detail = _('The cursor is older than the record of deletions.  Sync again without a cursor.')
+    default_code = 'cursor_expired'
@@ -1,21 +1,547 @@
+import os
+import re
+import json
+import base64
+import random
+import shutil
+import tempfile
+import threading
+import importlib.util
 import subprocess as sb
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
 
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+
+from transfer_app.models import Transfer, LaunchAttempt, PoolWorker, TransferCheckpoint
+import transfer_app.utils as utils
+import transfer_app.scheduler as scheduler
+
+
+def group_transfers(items, max_items, max_size_in_bytes):
+    '''
+    Decides which transfers share a worker VM.  items is a list of dicts, each with
+    a 'size_in_bytes' key.  Returns a list of lists of those dicts, one per VM.
+
+    Transfers are packed (in order) until a group holds max_items transfers or adding
+    the next would push the group past max_size_in_bytes.  A transfer that is larger than
+    max_size_in_bytes on its own gets its own VM, as does every transfer if max_items is 1.
+    '''
+    groups = []
+    current_group = []
+    current_size = 0
+    for item in items:
+        size = item['size_in_bytes']
+        if (len(current_group) >= max_items) or ((len(current_group) > 0) and (current_size + size > max_size_in_bytes)):
+            groups.append(current_group)
+            current_group = []
+            current_size = 0
+        current_group.append(item)
+        current_size += size
+    if len(current_group) > 0:
+        groups.append(current_group)
+    return groups
+
+
+# the kinds of launch failure:
+QUOTA = 'quota' # the project is out of CPUs, IPs, etc. in the region
+STOCKOUT = 'stockout' # the zone is out of the requested machines
+TRANSIENT = 'transient' # a hiccup in the API, which may work on another try
+PERMANENT = 'permanent' # anything else, e.g. a bad machine type.  Not retried.
+
+# pieces of the error messages (from gcloud or the compute API) which identify the kind of failure
+ERROR_PATTERNS = [
+    (QUOTA, ['quota_exceeded', 'quota exceeded', 'quota \'']),
+    (STOCKOUT, ['zone_resource_pool_exhausted', 'does not have enough resources available', 'stockout']),
+    (TRANSIENT, ['ratelimitexceeded', 'backenderror', 'internalerror', 'internal error', 'resource_not_ready',
+        'unavailable', 'timed out', 'timeout', 'connection', 'status 429', 'status 500', 'status 502', 
+        'status 503', 'status 504'])
+]
+
+def classify_error(error):
+    '''
+    Returns the kind of failure (one of the constants above) from the error message of a launch
+    '''
+    message = (error or '').lower()
+    for kind, patterns in ERROR_PATTERNS:
+        if any([x in message for x in patterns]):
+            return kind
+    return PERMANENT
+
+
+def retry_delay(attempt_number):
+    '''
+    Returns the seconds to wait before the given retry: exponential backoff, with jitter
+    so that the VMs of a batch which failed together do not all retry at the same moment.
+    '''
+    base = float(settings.CONFIG_PARAMS.get('launch_retry_base_seconds', 30))
+    max_delay = float(settings.CONFIG_PARAMS.get('launch_retry_max_seconds', 600))
+    delay = min(max_delay, base * 2**(attempt_number - 1))
+    return delay/2 + random.uniform(0, delay/2)
+
+
+def retry_spec(spec, zone, attempt_number):
+    '''
+    Returns a copy of the (single VM) launch spec for another attempt in `zone`.  
+    The VM gets a new name, since a failed attempt can leave a VM behind.
+    '''
+    instance_name = re.sub('-r[0-9]+$', '', spec['instance_names'][0]) + '-r%d' % attempt_number
+    zones_tried = spec.get('zones_tried', [spec['zone'],])
+    new_spec = dict(spec, 
+        instance_names=[instance_name,], 
+        zone=zone, 
+        attempt_number=attempt_number,
+        zones_tried=zones_tried + ([zone,] if zone not in zones_tried else [])
+    )
+    # the worker is told its zone, so it can remove itself:
+    args = list(spec['container_args'])
+    if '-zone' in args:
+        args[args.index('-zone') + 1] = zone
+    new_spec['container_args'] = args
+    return new_spec
+
+
+def handle_launch_failure(spec, launcher_name, error):
+    '''
+    Decides what happens after the launch of the VM(s) in the spec fails.  Transient failures
+    are retried in the same zone after a backoff.  Quota and stockout failures move to the next 
+    zone in the fallback_zones config which has not been tried; once there are none left, those 
+    are retried with a backoff as well.  Nothing is retried more than max_launch_retries times.  
+    Returns True if the launch will be retried.
+    '''
+    kind = classify_error(error)
+    attempt_number = spec.get('attempt_number', 0) + 1
+    max_retries = int(settings.CONFIG_PARAMS.get('max_launch_retries', 3))
+    if (kind == PERMANENT) or (attempt_number > max_retries) or (launcher_name is None):
+        return False
+
+    zones_tried = spec.get('zones_tried', [spec['zone'],])
+    fallback_zones = [x.strip() for x in settings.CONFIG_PARAMS.get('fallback_zones', '').split(',') if len(x.strip()) > 0]
+    untried_zones = [x for x in fallback_zones if x not in zones_tried]
+    if (kind in (QUOTA, STOCKOUT)) and (len(untried_zones) > 0):
+        zone = untried_zones[0]
+        delay = 0
+    else:
+        zone = spec['zone']
+        delay = retry_delay(attempt_number)
+
+    for instance_name in spec['instance_names']:
+        new_spec = retry_spec(dict(spec, instance_names=[instance_name,]), zone, attempt_number)
+        # a pool worker keeps its place in the pool under the new name:
+        PoolWorker.objects.filter(instance_name=instance_name).update(instance_name=new_spec['instance_names'][0])
+        print('Launch of %s failed (%s).  Retrying as %s in %s in %d seconds' % (instance_name, kind, 
+            new_spec['instance_names'][0], zone, delay))
+        scheduler.retry_later(new_spec, launcher_name, delay)
+    return True
+
+
+def resume_spec(spec, state, preemptions):
+    '''
+    Returns a copy of the (single VM) launch spec for the VM which replaces a preempted Spot VM.
+    The worker resumes from the checkpointed state, or starts over if there is none.
+    '''
+    instance_name = re.sub('-p[0-9]+$', '', spec['instance_names'][0]) + '-p%d' % preemptions
+    args = list(spec['container_args'])
+    if '-resume' in args:
+        i = args.index('-resume')
+        del args[i:i+2]
+    if state is not None:
+        args.extend(['-resume', base64.b64encode(json.dumps(state).encode('utf-8')).decode('utf-8')])
+    return dict(spec, instance_names=[instance_name,], container_args=args, attempt_number=0)
+
+
+def relaunch_preempted(transfer):
+    '''
+    Starts a replacement for the preempted Spot VM that was running `transfer`, which resumes
+    from the transfer's last checkpoint.  A transfer is moved at most max_preemptions times.
+    After that (or if the launch spec is not known), it is marked as failed.
+    Returns True if a replacement was queued.
+    '''
+    checkpoint, created = TransferCheckpoint.objects.get_or_create(transfer=transfer)
+    checkpoint.preemptions += 1
+    checkpoint.save()
+    attempt = LaunchAttempt.objects.filter(transfers=transfer, spec__isnull=False).order_by('-created', '-pk').first()
+    max_preemptions = int(settings.CONFIG_PARAMS.get('max_preemptions', 5))
+    if (attempt is None) or (checkpoint.preemptions > max_preemptions):
+        print('Transfer %d was preempted and will not be moved to another VM' % transfer.pk)
+        utils.mark_transfer_complete(transfer, False)
+        return False
+
+    state = None if checkpoint.state is None else json.loads(checkpoint.state)
+    spec = resume_spec(json.loads(attempt.spec), state, checkpoint.preemptions)
+    print('%s was preempted.  Resuming transfer %d on %s' % (attempt.instance_name, transfer.pk, spec['instance_names'][0]))
+    # the preempted VM is gone, which makes room for the replacement:
+    LaunchAttempt.objects.filter(pk=attempt.pk).update(status=LaunchAttempt.FINISHED)
+    scheduler.queue(spec, attempt.launcher)
+    scheduler.release()
+    return True
+
+
+def record_launch(spec, status, operation=None, error=None):
+    '''
+    Records the outcome of the launch on the LaunchAttempt for each VM in the launch spec
+    (created when the scheduler admitted it, and found by the pks in spec['attempt_pks']).
+    A launch that never got that far (e.g. admission itself failed) is recorded on a new LaunchAttempt.
+    A failed launch is retried if it is worth another try (see handle_launch_failure).  
+    Otherwise, the Transfers the VMs were meant to run are marked as complete (and unsuccessful), 
+    since no worker will report back for them.
+    Either way, the room they held under the VM caps goes to queued launches.
+    '''
+    transfers = list(Transfer.objects.filter(pk__in=spec['transfer_pks']))
+    error_kind = classify_error(error) if status == LaunchAttempt.FAILED else None
+    attempt_pks = spec.get('attempt_pks', {})
+    launcher_name = None
+    for instance_name in spec['instance_names']:
+        outcome = {
+            'zone': spec['zone'],
+            'operation': operation,
+            'status': status,
+            'error': error,
+            'error_kind': error_kind
+        }
+        if instance_name in attempt_pks:
+            LaunchAttempt.objects.filter(pk=attempt_pks[instance_name]).update(**outcome)
+            launcher_name = LaunchAttempt.objects.filter(pk=attempt_pks[instance_name]).values_list('launcher', flat=True).first()
+        else:
+            attempt = LaunchAttempt.objects.create(instance_name=instance_name, **outcome)
+            attempt.transfers.set(transfers)
+    if status == LaunchAttempt.FAILED:
+        if not handle_launch_failure(spec, launcher_name, error):
+            for transfer in transfers:
+                utils.mark_transfer_complete(transfer, False)
+        scheduler.release()
+
+
+def fail_operation(operation, error):
+    '''
+    Marks the launches that were waiting on `operation` as failed, and retries them
+    or marks their Transfers as failed (see record_launch)
+    '''
+    attempts = list(LaunchAttempt.objects.filter(operation=operation, status=LaunchAttempt.PENDING))
+    LaunchAttempt.objects.filter(pk__in=[x.pk for x in attempts]).update(status=LaunchAttempt.FAILED, 
+        error=error, 
+        error_kind=classify_error(error)
+    )
+    for attempt in attempts:
+        if (attempt.spec is not None) and handle_launch_failure(json.loads(attempt.spec), attempt.launcher, error):
+            continue
+        for transfer in attempt.transfers.filter(completed=False):
+            utils.mark_transfer_complete(transfer, False)
+    scheduler.release()
+
 
 class Launcher(object):
+    '''
+    Launchers turn a launch spec (a dict describing the VM(s) and the container
+    to run, see the uploaders/downloaders) into running machines.
+    go() may return before the machines are requested; wait() returns once they have been.
+    '''
     def __init__(self):
         pass
 
-class GoogleLauncher(Launcher):   
-    def go(self, cmd):
-        print('Launch: %s' % cmd)
-        p = sb.Popen(cmd, shell=True, stdout=sb.PIPE, stderr=sb.STDOUT)
-        stdout, stderr = p.communicate()
-        if p.returncode != 0:
-            print('There was a problem:')
-            print('stdout: %s' % stdout)
-            print('stderr: %s' % stderr)
+    def go(self, spec):
+        raise NotImplementedError
+
+    def wait(self):
+        pass
+
+
+class GoogleLauncher(Launcher):
+    '''
+    Starts VMs by calling the gcloud command-line tool, one VM at a time
+    '''
+
+    gcloud_cmd_template = '''{gcloud} beta compute --project={google_project_id} instances \
+                             create-with-container {instance_name} \
+                             --zone={google_zone} \
+                             --scopes={scopes} \
+                             --machine-type={machine_type} \
+                             --boot-disk-size={disk_size_gb}GB \
+                             --boot-disk-type={disk_type} \
+                             --metadata=google-logging-enabled=true \
+                             --container-image={docker_image} \
+                             --no-restart-on-failure --container-restart-policy=never'''
+
+    def render_command(self, spec, instance_name):
+        cmd = self.gcloud_cmd_template.format(gcloud=os.environ['GCLOUD'],
+            google_project_id = spec['project'],
+            google_zone = spec['zone'],
+            instance_name = instance_name,
+            scopes = spec['scopes'],
+            machine_type = spec['machine_type'],
+            disk_size_gb = spec['disk_size_gb'],
+            disk_type = spec['disk_type'],
+            docker_image = spec['docker_image']
+        )
+        if spec.get('spot'):
+            # a preempted Spot VM is removed, since its transfer moves to a replacement VM
+            cmd += ' --provisioning-model=SPOT --instance-termination-action=DELETE'
+        # Since these are passed via the gcloud command, the arg strings are a bit strange
+        for arg in spec['container_args']:
+            cmd += ' --container-arg="%s"' % arg
+        return cmd
+
+    def go(self, spec):
+        for instance_name in spec['instance_names']:
+            cmd = self.render_command(spec, instance_name)
+            print('Launch: %s' % cmd)
+            p = sb.Popen(cmd, shell=True, stdout=sb.PIPE, stderr=sb.STDOUT)
+            stdout, stderr = p.communicate()
+            single_spec = dict(spec, instance_names=[instance_name,])
+            if p.returncode != 0:
+                print('There was a problem:')
+                print('stdout: %s' % stdout)
+                print('stderr: %s' % stderr)
+                record_launch(single_spec, LaunchAttempt.FAILED, error=stdout.decode('utf-8', 'replace'))
+            else:
+                record_launch(single_spec, LaunchAttempt.DONE)
+
+
+class GoogleComputeLauncher(Launcher):
+    '''
+    Starts VMs with direct calls to the Compute Engine API, which avoids starting the
+    gcloud tool for each VM.  The requests are sent concurrently over a shared,
+    authenticated session.  Identical VMs in one spec (e.g. pool workers) are created
+    with a single bulkInsert request.
+
+    The API answers with an operation which finishes after the VM is created (or fails).
+    Those are followed asynchronously by the check_launch task so a failed launch is
+    recorded on its Transfers.
+    '''
+
+    API_ROOT = 'https://compute.googleapis.com/compute/v1/projects/{project}/zones/{zone}'
+
+    # create-with-container uses a Container-Optimized OS image which starts
+    # the container described in the instance metadata
+    CONTAINER_OS_IMAGE = 'projects/cos-cloud/global/images/family/cos-stable'
+
+    MAX_CONCURRENT_REQUESTS = 8
+    REQUEST_TIMEOUT = 60
+
+    # seconds between checks on an operation, and how many checks before giving up
+    OPERATION_POLL_INTERVAL = 15
+    MAX_OPERATION_POLLS = 40
+
+    # one authenticated session is shared by every launcher in the process
+    _session = None
+    _session_lock = threading.Lock()
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.MAX_CONCURRENT_REQUESTS)
+        self.pending = []
+
+    @classmethod
+    def get_session(cls):
+        with cls._session_lock:
+            if cls._session is None:
+                credentials, project = google.auth.default(scopes=['https://www.googleapis.com/auth/cloud-platform'])
+                cls._session = AuthorizedSession(credentials)
+            return cls._session
+
+    def instance_properties(self, spec):
+        '''
+        Returns the instance properties shared by every VM in the spec, in the form
+        used by the API (the same as for an instance, less the name)
+        '''
+        # the container declaration is YAML, and JSON is valid YAML:
+        container_declaration = json.dumps({
+            'spec': {
+                'containers': [{
+                    'image': spec['docker_image'],
+                    'args': [str(x) for x in spec['container_args']],
+                    'stdin': False,
+                    'tty': False
+                }],
+                'restartPolicy': 'Never'
+            }
+        })
+        return {
+            'machineType': spec['machine_type'],
+            'disks': [{
+                'boot': True,
+                'autoDelete': True,
+                'initializeParams': {
+                    'sourceImage': self.CONTAINER_OS_IMAGE,
+                    'diskSizeGb': str(spec['disk_size_gb']),
+                    'diskType': spec['disk_type']
+                }
+            }],
+            'networkInterfaces': [{
+                'network': 'global/networks/default',
+                'accessConfigs': [{'type': 'ONE_TO_ONE_NAT', 'name': 'External NAT'}]
+            }],
+            'serviceAccounts': [{
+                'email': 'default',
+                'scopes': spec['scopes'].split(',')
+            }],
+            'metadata': {
+                'items': [
+                    {'key': 'gce-container-declaration', 'value': container_declaration},
+                    {'key': 'google-logging-enabled', 'value': 'true'}
+                ]
+            },
+            'labels': {'container-vm': 'cos-stable'},
+            'scheduling': self.scheduling(spec)
+        }
+
+    def scheduling(self, spec):
+        '''
+        Returns the scheduling options for the VMs in the spec.  A preempted Spot VM 
+        is removed, since its transfer moves to a replacement VM.
+        '''
+        if spec.get('spot'):
+            return {
+                'automaticRestart': False,
+                'onHostMaintenance': 'TERMINATE',
+                'provisioningModel': 'SPOT',
+                'instanceTerminationAction': 'DELETE'
+            }
+        return {'automaticRestart': False}
+
+    def request_body(self, spec):
+        '''
+        Returns the URL and body of the request which creates the VMs in the spec
+        '''
+        api_root = self.API_ROOT.format(project=spec['project'], zone=spec['zone'])
+        properties = self.instance_properties(spec)
+        if len(spec['instance_names']) == 1:
+            body = dict(properties, name=spec['instance_names'][0])
+            # a single instance gives the machine and disk types relative to the zone
+            body['machineType'] = 'zones/%s/machineTypes/%s' % (spec['zone'], spec['machine_type'])
+            body['disks'][0]['initializeParams']['diskType'] = 'zones/%s/diskTypes/%s' % (spec['zone'], spec['disk_type'])
+            return '%s/instances' % api_root, body
+        body = {
+            'count': len(spec['instance_names']),
+            'perInstanceProperties': {x: {} for x in spec['instance_names']},
+            'instanceProperties': properties
+        }
+        return '%s/instances/bulkInsert' % api_root, body
+
+    def _send(self, spec):
+        '''
+        Sends the request to create the VMs.  Runs in a thread, so it does not touch
+        the database.  Returns a tuple of (operation name, error message), one of which is None
+        '''
+        try:
+            url, body = self.request_body(spec)
+            response = self.get_session().post(url, json=body, timeout=self.REQUEST_TIMEOUT)
+            if response.status_code >= 400:
+                return None, 'Request failed with status %d: %s' % (response.status_code, response.text)
+            return response.json()['name'], None
+        except Exception as ex:
+            return None, 'Request failed: %s' % ex
+
+    def go(self, spec):
+        self.pending.append((spec, self.executor.submit(self._send, spec)))
+
+    def wait(self):
+        # imported here since the tasks module imports the uploaders/downloaders, which import this module
+        from transfer_app.tasks import check_launch
+        for spec, future in self.pending:
+            operation, error = future.result()
+            if error is not None:
+                print('There was a problem launching %s: %s' % (', '.join(spec['instance_names']), error))
+                record_launch(spec, LaunchAttempt.FAILED, error=error)
+            else:
+                record_launch(spec, LaunchAttempt.PENDING, operation=operation)
+                check_launch.apply_async(args=[spec['project'], spec['zone'], operation],
+                    countdown=self.OPERATION_POLL_INTERVAL)
+        self.pending = []
+
+    @classmethod
+    def check_operation(cls, project, zone, operation):
+        '''
+        Checks on an operation returned when creating VMs.  When it has finished, the
+        corresponding LaunchAttempts are updated, and if it failed, so are their Transfers.
+        Returns True if the operation has finished.
+        '''
+        url = '%s/operations/%s' % (cls.API_ROOT.format(project=project, zone=zone), operation)
+        response = cls.get_session().get(url, timeout=cls.REQUEST_TIMEOUT)
+        response.raise_for_status()
+        result = response.json()
+        if result['status'] != 'DONE':
+            return False
+        if 'error' in result:
+            errors = result['error'].get('errors', [])
+            error = '; '.join(['%s: %s' % (x.get('code'), x.get('message')) for x in errors])
+            fail_operation(operation, error)
+        else:
+            LaunchAttempt.objects.filter(operation=operation, status=LaunchAttempt.PENDING).update(status=LaunchAttempt.DONE)
+        return True
+
+
+class LocalLauncher(Launcher):
+    '''
+    Runs transfers in this process instead of on a new VM.  For small files, starting
+    a VM takes far longer than the transfer itself.
+
+    The transfers are run by the same worker script the VM would run (loaded as a module),
+    in a pool of threads.  The worker normally reports the outcome by calling back to the 
+    application; here the outcomes are collected and the Transfers are marked complete 
+    (as the TransferComplete view would) once their work is done.
+    '''
+
+    # the worker scripts, loaded once per process and keyed by path
+    _modules = {}
+    _modules_lock = threading.Lock()
+
+    def __init__(self, script_path, max_workers):
+        self.module = self.load_worker(script_path)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.pending = []
+
+    @classmethod
+    def load_worker(cls, script_path):
+        with cls._modules_lock:
+            if script_path not in cls._modules:
+                module_name = 'transfer_worker_%d' % len(cls._modules)
+                module_spec = importlib.util.spec_from_file_location(module_name, script_path)
+                module = importlib.util.module_from_spec(module_spec)
+                module_spec.loader.exec_module(module)
+
+                # instead of calling back to the application, the worker adds the outcome
+                # to the list in its params (see _run):
+                module.notify_master = lambda params, error=False: params['outcomes'].append((int(params['transfer_pk']), not error))
+
+                # the worker keeps the files for transfers in a manifest under WORKING_DIR
+                module.WORKING_DIR = tempfile.mkdtemp(prefix='transfers-')
+                cls._modules[script_path] = module
+            return cls._modules[script_path]
+
+    def _run(self, spec):
+        '''
+        Runs the transfers in the spec.  Runs in a thread, so it does not touch the database.
+        Returns a list of (transfer primary key, success) tuples.
+        '''
+        outcomes = []
+        try:
+            params = self.module.parse_args([str(x) for x in spec['container_args']])
+            params['outcomes'] = outcomes
+            if params['manifest'] is None:
+                params['working_dir'] = tempfile.mkdtemp(dir=self.module.WORKING_DIR)
+                try:
+                    self.module.run_transfer(params)
+                finally:
+                    shutil.rmtree(params['working_dir'], ignore_errors=True)
+            else:
+                self.module.run_manifest(params)
+        # parse_args exits on bad arguments, so catch that too:
+        except (Exception, SystemExit) as ex:
+            print('There was a problem running transfers %s locally: %s' % (spec['transfer_pks'], ex))
+        return outcomes
+
+    def go(self, spec):
+        self.pending.append((spec, self.executor.submit(self._run, spec)))
+
+    def wait(self):
+        for spec, future in self.pending:
+            outcomes = dict(future.result())
+            for transfer in Transfer.objects.filter(pk__in=spec['transfer_pks'], completed=False):
+                # a transfer without an outcome did not get to run
+                utils.mark_transfer_complete(transfer, outcomes.get(transfer.pk, False))
+        self.pending = []
 
 
 class AWSLauncher(Launcher):
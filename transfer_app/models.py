@@ -1,8 +1,20 @@
 from django.db import models
+from django.utils import timezone
 
 from django.contrib.auth import get_user_model
 
-class ResourceManager(models.Manager):
+
+class ChangeTrackingQuerySet(models.QuerySet):
+    '''
+    A bulk update() does not call save, so it would not touch updated_at (auto_now).
+    This sets it as well, so that the rows are picked up by the sync endpoints (see sync.py).
+    '''
+    def update(self, **kwargs):
+        kwargs.setdefault('updated_at', timezone.now())
+        return super().update(**kwargs)
+
+
+class ResourceManager(models.Manager.from_queryset(ChangeTrackingQuerySet)):
      '''
      This class provides a nice way to filter Resource objects for a particular user
      '''
@@ -42,7 +54,20 @@ class Resource(models.Model):
     # be set to inactive.  Can be null, which would allow it to be permanent
     expiration_date = models.DateTimeField(null=True)
 
+    # when the Resource was last changed (including by a bulk update, see ChangeTrackingQuerySet)
+    updated_at = models.DateTimeField(null=False, auto_now=True)
+
     objects = ResourceManager()
+
+    class Meta:
+        # for the pages of the listings, newest first (see pagination.py):
+        indexes = [
+            models.Index(fields=['date_added', 'id']),
+            models.Index(fields=['owner', 'date_added', 'id']),
+            # for the changes since a client's last sync (see sync.py):
+            models.Index(fields=['updated_at', 'id']),
+            models.Index(fields=['owner', 'updated_at', 'id']),
+        ]
     
     def __str__(self):
         return '%s' % self.source
@@ -54,14 +79,13 @@ class Resource(models.Model):
 class TransferCoordinatorObjectManager(models.Manager):
      '''
      This class provides a way to filter TransferCoordinator objects for a particular user
-     Could perhaps be optimized.
      '''
      def user_transfer_coordinators(self, user):
+         # a single query: each coordinator is checked for a Transfer started by the user
+         # (backed by the index on Transfer's coordinator and originator)
          all_tc = super(TransferCoordinatorObjectManager, self).get_queryset()
-         all_user_transfers = Transfer.objects.user_transfers(user)
-         user_tc_pk = list(set([t.coordinator.pk for t in all_user_transfers]))
-         q = all_tc.filter(pk__in = user_tc_pk)
-         return q
+         user_transfers = Transfer.objects.filter(coordinator=models.OuterRef('pk'), originator=user)
+         return all_tc.annotate(has_user_transfer=models.Exists(user_transfers)).filter(has_user_transfer=True)
 
 
 
@@ -82,10 +106,30 @@ class TransferCoordinator(models.Model):
     # when all the Transfers completed. This does NOT imply success.
     finish_time = models.DateTimeField(null=True)
 
+    # the id the batch was given when it was submitted (see submissions.py), so that
+    # a client told its submission was a repeat can find the batch.  Null for batches
+    # created otherwise
+    batch_id = models.CharField(max_length=32, null=True, unique=True)
+
+    # counts of the Transfers (and their bytes) in the batch, and of those completed
+    # and succeeded so far.  These are only changed with F() updates, so that concurrent
+    # completions are all counted (see utils.count_completions)
+    total_transfers = models.IntegerField(default=0)
+    completed_transfers = models.IntegerField(default=0)
+    succeeded_transfers = models.IntegerField(default=0)
+    total_bytes = models.BigIntegerField(default=0)
+    completed_bytes = models.BigIntegerField(default=0)
+
     objects = TransferCoordinatorObjectManager()
 
+    class Meta:
+        # for the pages of the listings, newest first (see pagination.py):
+        indexes = [
+            models.Index(fields=['start_time', 'id']),
+        ]
+
 
-class TransferObjectManager(models.Manager):
+class TransferObjectManager(models.Manager.from_queryset(ChangeTrackingQuerySet)):
      '''
      This class provides a nice way to filter Transfer objects for a particular user
      '''
@@ -139,8 +183,33 @@ class Transfer(models.Model):
     # owned by that regular user
     originator = models.ForeignKey(get_user_model(), on_delete=models.CASCADE)
 
+    # the shape of the VM that ran the transfer, as chosen by the sizing policy.
+    # Null if the transfer did not get its own VM (e.g. it was run by a pool worker)
+    machine_type = models.CharField(max_length=100, null=True)
+    disk_type = models.CharField(max_length=100, null=True)
+    disk_size_gb = models.IntegerField(null=True)
+
+    # when the Transfer was last changed (including by a bulk update, see ChangeTrackingQuerySet)
+    updated_at = models.DateTimeField(null=False, auto_now=True)
+
     objects = TransferObjectManager()
 
+    class Meta:
+        # for the checks against transfers already in progress (see the
+        # _check_conflicts methods of the uploaders and downloaders):
+        indexes = [
+            models.Index(fields=['completed', 'destination']),
+            models.Index(fields=['originator', 'completed', 'resource']),
+            # for the batches of a user (see TransferCoordinatorObjectManager):
+            models.Index(fields=['coordinator', 'originator']),
+            # for the pages of the listings, newest first (see pagination.py):
+            models.Index(fields=['start_time', 'id']),
+            models.Index(fields=['originator', 'start_time', 'id']),
+            # for the changes since a client's last sync (see sync.py):
+            models.Index(fields=['updated_at', 'id']),
+            models.Index(fields=['originator', 'updated_at', 'id']),
+        ]
+
     def __str__(self):
         return 'Transfer of %s, %s' % (self.resource, 'download' if self.download else 'upload')
 
@@ -150,4 +219,152 @@ class Transfer(models.Model):
     def save(self, *args, **kwargs):
         if self.finish_time:
             self.duration = self.finish_time - self.start_time
+        adding = self._state.adding
         super().save(*args, **kwargs)
+
+        # a new Transfer is added to its coordinator's counts.  Note that bulk_create
+        # does not call save, so code creating Transfers that way sets the counts itself.
+        if adding:
+            size = self.resource.size
+            TransferCoordinator.objects.filter(pk=self.coordinator_id).update(
+                total_transfers=models.F('total_transfers') + 1,
+                total_bytes=models.F('total_bytes') + size,
+                completed_transfers=models.F('completed_transfers') + int(self.completed),
+                succeeded_transfers=models.F('succeeded_transfers') + int(self.completed and self.success),
+                completed_bytes=models.F('completed_bytes') + (size if self.completed else 0)
+            )
+
+
+class Tombstone(models.Model):
+    '''
+    Records the deletion of a Resource or Transfer, so that clients syncing changes
+    (see sync.py) learn to drop their copy.  Created by the signal handlers in signals.py,
+    and removed by the reaper after tombstone_retention_days.
+    '''
+    RESOURCE = 'resource'
+    TRANSFER = 'transfer'
+
+    # which kind of object was deleted (one of the above), and its primary key
+    model_name = models.CharField(max_length=20, null=False)
+    object_id = models.IntegerField(null=False)
+
+    # the user who could see the object (the Resource's owner or the Transfer's originator).
+    # Not a foreign key, since the user may have been deleted as well
+    user_pk = models.IntegerField(null=True)
+
+    # when the object was deleted
+    deleted_at = models.DateTimeField(null=False, auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['model_name', 'deleted_at', 'id']),
+            models.Index(fields=['model_name', 'user_pk', 'deleted_at', 'id']),
+        ]
+
+
+class WorkerJob(models.Model):
+    '''
+    A Transfer that is waiting for (or being run by) a worker in a warm pool.
+    Pool workers lease these from the application instead of being started for
+    a single Transfer.
+    '''
+
+    # the Transfer this job performs
+    transfer = models.OneToOneField(Transfer, on_delete=models.CASCADE)
+
+    # the kind of worker that can run this job (e.g. 'dropbox-upload')
+    pool = models.CharField(max_length=100, null=False)
+
+    # a JSON string with the per-transfer parameters the worker needs
+    spec = models.TextField(null=False)
+
+    # the name of the worker machine that has leased this job.  Null while the job is waiting
+    leased_by = models.CharField(max_length=200, null=True)
+
+    # when the job was leased
+    lease_time = models.DateTimeField(null=True)
+
+    # when the job was queued
+    created = models.DateTimeField(null=False, auto_now_add=True)
+
+
+class PoolWorker(models.Model):
+    '''
+    A long-lived worker machine in a warm pool.  Created when the machine is
+    started, and removed when it retires after sitting idle.
+    '''
+
+    # the name of the machine, which the worker reports when asking for work
+    instance_name = models.CharField(max_length=200, null=False, unique=True)
+
+    # the kind of worker (see WorkerJob.pool)
+    pool = models.CharField(max_length=100, null=False)
+
+    # the last time the worker asked for work (or when it was started)
+    last_seen = models.DateTimeField(null=False)
+
+
+class LaunchAttempt(models.Model):
+    '''
+    Records the request to start a worker machine, so that a failed launch
+    can be traced to (and recorded on) the Transfers it was meant to run.
+    '''
+    QUEUED = 'queued' # waiting for room under the VM caps (see scheduler.py)
+    PENDING = 'pending' # requested
+    DONE = 'done' # the machine was started
+    FAILED = 'failed'
+    FINISHED = 'finished' # the machine's work is complete
+
+    # the Transfers the machine was started for.  Empty for pool workers, 
+    # which lease their Transfers later
+    transfers = models.ManyToManyField(Transfer, related_name='launch_attempts')
+
+    # the name of the machine and where it was requested
+    instance_name = models.CharField(max_length=200, null=False)
+    zone = models.CharField(max_length=100, null=False)
+
+    # the name of the asynchronous operation returned by the compute API, if any.  
+    # Several machines started with one request share an operation.
+    operation = models.CharField(max_length=200, null=True)
+
+    # one of the statuses above
+    status = models.CharField(max_length=20, null=False, default=PENDING)
+
+    # an explanation if the launch failed, and the kind of failure (see launchers.classify_error)
+    error = models.TextField(null=True)
+    error_kind = models.CharField(max_length=20, null=True)
+
+    # the launch spec (JSON) and the name of the launcher that starts it
+    spec = models.TextField(null=True)
+    launcher = models.CharField(max_length=100, null=True)
+
+    # a retried launch counts the attempts (the first is zero), and waits until not_before
+    attempt_number = models.IntegerField(null=False, default=0)
+    not_before = models.DateTimeField(null=True)
+
+    # when the launch was requested
+    created = models.DateTimeField(null=False, auto_now_add=True)
+
+    # when the VM was admitted under the caps (see scheduler.py), i.e. when it was
+    # started rather than queued.  Null while the launch is queued
+    admitted = models.DateTimeField(null=True)
+
+
+class TransferCheckpoint(models.Model):
+    '''
+    The last progress reported by the worker running a Transfer on a Spot VM.  If
+    the VM is preempted, the replacement VM resumes the Transfer from this state.
+    '''
+
+    # the Transfer being checkpointed
+    transfer = models.OneToOneField(Transfer, on_delete=models.CASCADE, related_name='checkpoint')
+
+    # a JSON string with the worker's state (e.g. the upload session and offset).  
+    # Null until the worker has sent one
+    state = models.TextField(null=True)
+
+    # the number of times the Transfer has been moved to a replacement VM
+    preemptions = models.IntegerField(null=False, default=0)
+
+    # when the last checkpoint arrived
+    updated = models.DateTimeField(null=False, auto_now=True)
@@ -0,0 +1,29 @@
+'''
+Cursor (keyset) pagination for the list endpoints.  Pages are ordered newest first on
+a timestamp and the primary key, which are indexed (see the models), so fetching a page
+does not depend on how much history there is.  A cursor points at a position in that
+ordering rather than an offset, so rows added while a client is paging do not shift
+or repeat the pages it has not yet fetched.
+
+Clients follow the 'next' link of each response.  The page size can be set with
+the page_size query parameter, up to max_page_size.
+'''
+from rest_framework.pagination import CursorPagination
+
+
+class NewestFirstPagination(CursorPagination):
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+
+class ResourcePagination(NewestFirstPagination):
+    ordering = ('-date_added', '-id')
+
+
+class TransferPagination(NewestFirstPagination):
+    ordering = ('-start_time', '-id')
+
+
+class BatchPagination(NewestFirstPagination):
+    ordering = ('-start_time', '-id')
@@ -0,0 +1,173 @@
+'''
+The reaper cleans up after workers which did not finish properly.  It is run periodically
+by celery beat (see CELERY_BEAT_SCHEDULE in the settings), and:
+  - removes worker VMs which have no transfer left to run, e.g. because the worker crashed
+    before reporting back or could not remove its own VM.  Those would otherwise run
+    (and be billed) indefinitely.
+  - gives up on transfers which have run far longer than expected for their size, since
+    their worker is presumably gone.  A transfer on a Spot VM whose checkpoints have stopped
+    arriving (e.g. the VM was lost without warning) is resumed on a new VM instead.
+
+The settings are in the general config.
+'''
+import re
+import datetime
+
+from django.conf import settings
+from django.db.models import Q, Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from transfer_app.models import Transfer, LaunchAttempt, PoolWorker
+from transfer_app.launchers import GoogleComputeLauncher, relaunch_preempted
+from transfer_app import uploaders, downloaders
+import transfer_app.scheduler as scheduler
+import transfer_app.utils as utils
+
+
+INSTANCE_LIST_URL = 'https://compute.googleapis.com/compute/v1/projects/{project}/aggregated/instances'
+
+
+def get_setting(key, default):
+    return float(settings.CONFIG_PARAMS.get(key, default))
+
+
+def instance_name_prefixes():
+    '''
+    Returns the instance_name_prefix of each uploader and downloader.  The names of
+    the worker VMs all start with one of these.
+    '''
+    prefixes = set()
+    for source in settings.UPLOADER_CONFIG['UPLOAD_SOURCES']:
+        prefixes.add(uploaders.get_uploader(source)([]).config_params['instance_name_prefix'])
+    for destination in settings.DOWNLOADER_CONFIG['DOWNLOAD_DESTINATIONS']:
+        prefixes.add(downloaders.get_downloader(destination)([]).config_params['instance_name_prefix'])
+    return prefixes
+
+
+def list_instances(project, prefixes):
+    '''
+    Returns the VMs (in any zone) whose names start with one of the prefixes, as a list
+    of dicts with keys 'name', 'zone' and 'created'
+    '''
+    session = GoogleComputeLauncher.get_session()
+    url = INSTANCE_LIST_URL.format(project=project)
+    query = {'filter': 'name eq "(%s)-.*"' % '|'.join([re.escape(x) for x in sorted(prefixes)])}
+    instances = []
+    while True:
+        response = session.get(url, params=query, timeout=GoogleComputeLauncher.REQUEST_TIMEOUT)
+        response.raise_for_status()
+        result = response.json()
+        for zone_result in result.get('items', {}).values():
+            for instance in zone_result.get('instances', []):
+                instances.append({
+                    'name': instance['name'],
+                    'zone': instance['zone'].split('/')[-1],
+                    'created': parse_datetime(instance['creationTimestamp'])
+                })
+        if 'nextPageToken' not in result:
+            return instances
+        query['pageToken'] = result['nextPageToken']
+
+
+def delete_instance(project, zone, instance_name):
+    session = GoogleComputeLauncher.get_session()
+    url = '%s/instances/%s' % (GoogleComputeLauncher.API_ROOT.format(project=project, zone=zone), instance_name)
+    response = session.delete(url, timeout=GoogleComputeLauncher.REQUEST_TIMEOUT)
+    response.raise_for_status()
+
+
+def find_orphans(instances, now):
+    '''
+    Returns the instances (see list_instances) which have nothing left to do.  A VM is kept if:
+      - it was created in the last reaper_grace_seconds, since its launch may not be recorded yet
+      - it was started for a Transfer which is not complete
+      - it is in a warm pool
+      - it ran a Transfer which failed in the last failed_vm_retention_hours, so it can be inspected
+    '''
+    grace_cutoff = now - datetime.timedelta(seconds=get_setting('reaper_grace_seconds', 900))
+    retention_cutoff = now - datetime.timedelta(hours=get_setting('failed_vm_retention_hours', 24))
+    names = set([x['name'] for x in instances if x['created'] < grace_cutoff])
+
+    attempts = LaunchAttempt.objects.filter(instance_name__in=names)
+    busy = attempts.filter(status__in=scheduler.IN_FLIGHT, transfers__completed=False)
+    failed = attempts.filter(transfers__success=False, transfers__finish_time__gte=retention_cutoff)
+    keep = set(busy.values_list('instance_name', flat=True))
+    keep.update(failed.values_list('instance_name', flat=True))
+    keep.update(PoolWorker.objects.filter(instance_name__in=names).values_list('instance_name', flat=True))
+    return [x for x in instances if (x['name'] in names) and (x['name'] not in keep)]
+
+
+def find_stale_transfers(now):
+    '''
+    Returns a tuple of two lists of Transfer pks: those which have run longer than expected,
+    and those on Spot VMs whose last checkpoint is older than stale_checkpoint_minutes.
+    A transfer is expected to take at most stale_transfer_base_minutes plus
+    stale_transfer_minutes_per_gb for each GB of the file.  Transfers still waiting for a
+    VM (queued under the VM caps, or for a pool worker) are not counted.
+
+    The time is counted from when the transfer's latest VM was admitted (or its pool job was
+    leased), since it may have waited for a long time under the caps before that.  Only a
+    checkpoint sent by that VM counts: after a preemption, the replacement is held to the 
+    expected duration until it checkpoints (and a transfer which cannot resume never does).
+    '''
+    base = datetime.timedelta(minutes=get_setting('stale_transfer_base_minutes', 60))
+    minutes_per_gb = get_setting('stale_transfer_minutes_per_gb', 10)
+    checkpoint_cutoff = now - datetime.timedelta(minutes=get_setting('stale_checkpoint_minutes', 30))
+
+    waiting = Transfer.objects.filter(Q(launch_attempts__status=LaunchAttempt.QUEUED) |
+        Q(workerjob__isnull=False, workerjob__leased_by__isnull=True))
+    in_progress = Transfer.objects.filter(completed=False, start_time__lt=now - base).exclude(pk__in=waiting)
+    in_progress = in_progress.annotate(admitted=Max('launch_attempts__admitted'),
+        leased=Max('workerjob__lease_time'),
+        checkpointed=Max('checkpoint__updated', filter=Q(checkpoint__state__isnull=False))
+    )
+    stale = []
+    stale_checkpoints = []
+    for pk, start_time, size, admitted, leased, checkpointed in in_progress.values_list('pk', 
+            'start_time', 'resource__size', 'admitted', 'leased', 'checkpointed'):
+        launch_times = [x for x in (admitted, leased) if x is not None]
+        launch_time = max(launch_times) if len(launch_times) > 0 else start_time
+        if (checkpointed is not None) and (checkpointed >= launch_time):
+            if checkpointed < checkpoint_cutoff:
+                stale_checkpoints.append(pk)
+        elif launch_time + base + datetime.timedelta(minutes=minutes_per_gb*size/1e9) < now:
+            stale.append(pk)
+    return stale, stale_checkpoints
+
+
+def reap_transfers():
+    '''
+    Fails the transfers which have run longer than expected, and resumes those on
+    Spot VMs which have gone quiet on a new VM
+    '''
+    stale, stale_checkpoints = find_stale_transfers(timezone.now())
+    if len(stale) > 0:
+        print('Transfers %s have run longer than expected.  Marking them as failed.' % ', '.join([str(x) for x in stale]))
+        utils.mark_transfers_failed(stale)
+    for transfer in Transfer.objects.filter(pk__in=stale_checkpoints):
+        relaunch_preempted(transfer)
+    return stale, stale_checkpoints
+
+
+def reap_instances():
+    '''
+    Removes the worker VMs which have nothing left to do (see find_orphans).
+    Returns the list of instances that were removed.
+    '''
+    if settings.CONFIG_PARAMS['cloud_environment'] != settings.GOOGLE:
+        return []
+    project = settings.CONFIG_PARAMS['google_project_id']
+    orphans = find_orphans(list_instances(project, instance_name_prefixes()), timezone.now())
+    removed = []
+    for instance in orphans:
+        print('Removing %s, which has no transfer left to run' % instance['name'])
+        try:
+            delete_instance(project, instance['zone'], instance['name'])
+            removed.append(instance)
+        except Exception as ex:
+            print('Could not remove %s: %s' % (instance['name'], ex))
+    if len(removed) > 0:
+        # the removed VMs no longer count against the caps on running VMs:
+        scheduler.workers_finished([x['name'] for x in removed])
+    return removed
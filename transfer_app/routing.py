@@ -0,0 +1,76 @@
+'''
+Routes the celery tasks to separate queues, each served by its own pool of worker
+processes (see etc/celery_worker.conf), so that a large batch does not hold up a user's
+single small transfer:
+  - FAST: upload/download batches small enough for the fast path (see is_fast_batch)
+  - LAUNCH: the other batches, and the tasks which start VMs and follow their launch
+  - MAINTENANCE: periodic cleanup and batch bookkeeping
+Unknown tasks go to the default queue (CELERY_TASK_DEFAULT_QUEUE in the settings).
+'''
+from django.conf import settings
+
+
+FAST = 'fast'
+LAUNCH = 'launch'
+MAINTENANCE = 'maintenance'
+
+QUEUES = (FAST, LAUNCH, MAINTENANCE)
+
+# Within a queue, lower numbers are taken first.  These are the priority steps of the
+# redis broker (see CELERY_BROKER_TRANSPORT_OPTIONS in the settings).  Each queue has its
+# own workers, so a priority only orders the tasks waiting in the same queue.
+URGENT = 0 # quick bookkeeping which gets admitted or queued VMs going
+INTERACTIVE = 3 # batches of a few transfers, which a user is likely waiting on
+BULK = 6 # large batches, their fanned-out launches, and periodic cleanup
+
+# the tasks given a batch of transfers (a list of item dicts), and the name of that argument:
+BATCH_TASKS = {
+    'upload': 'upload_info',
+    'download': 'download_info'
+}
+
+# the (queue, priority) of the other tasks:
+TASK_ROUTES = {
+    'release_launches': (LAUNCH, URGENT),
+    'check_launch': (LAUNCH, URGENT),
+    'launch_vm': (LAUNCH, BULK),
+    'finish_launches': (MAINTENANCE, URGENT),
+    'reap': (MAINTENANCE, BULK)
+}
+
+
+def is_fast_batch(items):
+    '''
+    Returns True if the batch has at most fast_queue_max_items transfers, each at most
+    fast_queue_max_size_mb.  A transfer of unknown size (zero) is not assumed to be small.
+    '''
+    max_items = int(settings.CONFIG_PARAMS.get('fast_queue_max_items', 1))
+    max_size = float(settings.CONFIG_PARAMS.get('fast_queue_max_size_mb', 1024))*1e6
+    sizes = [float(x.get('size_in_bytes', 0)) for x in items]
+    return (len(items) <= max_items) and all([(x > 0) and (x <= max_size) for x in sizes])
+
+
+def is_large_batch(items):
+    '''
+    Returns True if the batch has at least large_batch_min_items transfers
+    '''
+    return len(items) >= int(settings.CONFIG_PARAMS.get('large_batch_min_items', 10))
+
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    '''
+    The celery router (see CELERY_TASK_ROUTES in the settings)
+    '''
+    if name in BATCH_TASKS:
+        items = args[0] if len(args) > 0 else kwargs[BATCH_TASKS[name]]
+        if isinstance(items, dict):
+            items = [items,]
+        if is_fast_batch(items):
+            queue, priority = FAST, INTERACTIVE
+        else:
+            queue, priority = LAUNCH, (BULK if is_large_batch(items) else INTERACTIVE)
+    elif name in TASK_ROUTES:
+        queue, priority = TASK_ROUTES[name]
+    else:
+        return None
+    return {'queue': queue, 'priority': priority}
@@ -0,0 +1,182 @@
+'''
+Admission control for worker VMs.  Every VM request goes through here before it
+reaches a launcher, so that the number of VMs running at once stays within the caps
+set in the general config (max_concurrent_vms overall and max_vms_per_zone in each zone).
+A cap of zero means no limit.
+
+VMs over the cap are queued in the database (as LaunchAttempts with status QUEUED,
+holding the launch spec) and are started as running VMs finish.  A VM counts against
+the caps from the time it is admitted until its Transfers are complete (or, for a
+pool worker, until it leaves the pool) or its launch fails.
+
+Note that the caps are checked with a count of the running VMs, so two requests admitted
+at the same moment can go slightly over.  The caps should leave some room under the quota.
+
+Failed launches that are worth another try (see launchers.handle_launch_failure)
+go back on the queue with a time before which they are not started.
+'''
+import json
+import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from transfer_app.models import LaunchAttempt
+
+
+IN_FLIGHT = (LaunchAttempt.PENDING, LaunchAttempt.DONE)
+
+
+def get_cap(key):
+    return int(settings.CONFIG_PARAMS.get(key, 0))
+
+
+def free_slots(zone):
+    '''
+    Returns the number of VMs that can be started in the zone now, or None if there is no limit
+    '''
+    in_flight = LaunchAttempt.objects.filter(status__in=IN_FLIGHT)
+    slots = []
+    global_cap = get_cap('max_concurrent_vms')
+    if global_cap > 0:
+        slots.append(global_cap - in_flight.count())
+    zone_cap = get_cap('max_vms_per_zone')
+    if zone_cap > 0:
+        slots.append(zone_cap - in_flight.filter(zone=zone).count())
+    if len(slots) == 0:
+        return None
+    return max(0, min(slots))
+
+
+def queue(spec, launcher_name, not_before=None, status=LaunchAttempt.QUEUED):
+    '''
+    Queues each VM in the launch spec, to be started by the launcher named `launcher_name`.
+    Returns the list of LaunchAttempts.  With a status of PENDING, the VMs are recorded
+    as admitted instead (see admit).
+    '''
+    attempts = []
+    for instance_name in spec['instance_names']:
+        # each VM is queued on its own, so the VMs of one spec can start at different times.
+        # The spec may be a retry of an earlier launch, whose attempts are not this one's:
+        single_spec = dict(spec, instance_names=[instance_name,])
+        single_spec.pop('attempt_pks', None)
+        attempt = LaunchAttempt.objects.create(instance_name=instance_name,
+            zone=spec['zone'],
+            status=status,
+            spec=json.dumps(single_spec),
+            launcher=launcher_name,
+            attempt_number=spec.get('attempt_number', 0),
+            not_before=not_before,
+            admitted=timezone.now() if status == LaunchAttempt.PENDING else None
+        )
+        attempt.transfers.set(spec['transfer_pks'])
+        attempts.append(attempt)
+    return attempts
+
+
+def admit(spec, launcher_name):
+    '''
+    Records a LaunchAttempt for each VM in the launch spec, and admits as many as
+    there is room for.  Returns a spec for the admitted VMs (to be given to the launcher),
+    or None if all of them were queued.  The spec maps each admitted VM to its LaunchAttempt
+    (attempt_pks), where the launcher records the outcome (see launchers.record_launch).  The launcher named `launcher_name` starts the
+    queued VMs later on.
+    '''
+    instance_names = spec['instance_names']
+    num_free = free_slots(spec['zone'])
+    if num_free is None:
+        num_free = len(instance_names)
+    admitted_names = instance_names[:num_free]
+    queued_names = instance_names[num_free:]
+
+    # The admitted VMs are never QUEUED, even briefly, since claim_queued (run by
+    # release_launches) could otherwise claim and start them a second time.
+    if len(queued_names) > 0:
+        queue(dict(spec, instance_names=queued_names), launcher_name)
+    if len(admitted_names) == 0:
+        print('No room to start %s now.  Queued.' % ', '.join(instance_names))
+        return None
+    admitted_spec = dict(spec, instance_names=admitted_names)
+    attempts = queue(admitted_spec, launcher_name, status=LaunchAttempt.PENDING)
+    return dict(admitted_spec, attempt_pks={x.instance_name: x.pk for x in attempts})
+
+
+def claim_queued():
+    '''
+    Takes queued VMs off the queue (oldest first) for as long as there is room for them.
+    Returns a list of the claimed LaunchAttempts, which the caller is responsible for launching
+    (with the spec from launch_spec).
+    '''
+    claimed = []
+    full_zones = set()
+    queued = LaunchAttempt.objects.filter(status=LaunchAttempt.QUEUED)
+    queued = queued.filter(Q(not_before__isnull=True) | Q(not_before__lte=timezone.now()))
+    for attempt in queued.order_by('created', 'pk'):
+        if attempt.zone in full_zones:
+            continue
+        if free_slots(attempt.zone) == 0:
+            full_zones.add(attempt.zone)
+            continue
+        # the update only succeeds if no one else has claimed it in the meantime:
+        if LaunchAttempt.objects.filter(pk=attempt.pk, status=LaunchAttempt.QUEUED).update(status=LaunchAttempt.PENDING, 
+                admitted=timezone.now()) > 0:
+            claimed.append(attempt)
+    return claimed
+
+
+def launch_spec(attempt):
+    '''
+    Returns the launch spec for a queued LaunchAttempt, pointing back to it (see admit)
+    '''
+    return dict(json.loads(attempt.spec), attempt_pks={attempt.instance_name: attempt.pk})
+
+
+def release():
+    '''
+    Starts queued VMs (asynchronously) if there are any
+    '''
+    if LaunchAttempt.objects.filter(status=LaunchAttempt.QUEUED).exists():
+        # imported here since the tasks module imports (indirectly) this module
+        from transfer_app.tasks import release_launches
+        release_launches.delay()
+
+
+def retry_later(spec, launcher_name, delay):
+    '''
+    Queues the launch spec to be started in `delay` seconds (or later, if there is no room then)
+    '''
+    queue(spec, launcher_name, not_before=timezone.now() + datetime.timedelta(seconds=delay))
+    # imported here since the tasks module imports (indirectly) this module
+    from transfer_app.tasks import release_launches
+    release_launches.apply_async(countdown=delay)
+
+
+def transfer_finished(transfer):
+    '''
+    Called when a Transfer is complete.  A VM whose Transfers are all complete no longer
+    counts against the caps, which makes room for a queued VM.
+    '''
+    transfers_finished([transfer.pk,])
+
+
+def transfers_finished(transfer_pks):
+    '''
+    As transfer_finished, for several Transfers at once
+    '''
+    finished = LaunchAttempt.objects.filter(transfers__in=transfer_pks, status__in=IN_FLIGHT).exclude(transfers__completed=False)
+    finished = list(finished.values_list('pk', flat=True).distinct())
+    # a Transfer that was still queued will not need its VM:
+    LaunchAttempt.objects.filter(transfers__in=transfer_pks, status=LaunchAttempt.QUEUED).exclude(transfers__completed=False).delete()
+    if len(finished) > 0:
+        LaunchAttempt.objects.filter(pk__in=finished).update(status=LaunchAttempt.FINISHED)
+        release()
+
+
+def workers_finished(instance_names):
+    '''
+    Called when pool workers leave the pool, which makes room for queued VMs
+    '''
+    LaunchAttempt.objects.filter(instance_name__in=instance_names, status=LaunchAttempt.QUEUED).delete()
+    if LaunchAttempt.objects.filter(instance_name__in=instance_names, status__in=IN_FLIGHT).update(status=LaunchAttempt.FINISHED) > 0:
+        release()
@@ -42,13 +42,16 @@ class TransferSerializer(serializers.ModelSerializer):
                   'start_time', \
                   'finish_time', \
                   'duration', \
-                  'coordinator',
+                  'coordinator', \
+                  'machine_type', \
+                  'disk_type', \
+                  'disk_size_gb',
         )
 
 class TransferCoordinatorSerializer(serializers.ModelSerializer):
     class Meta:
         model = TransferCoordinator
-        fields = ('id', 'completed')
+        fields = ('id', 'batch_id', 'completed', 'total_transfers', 'completed_transfers', 'succeeded_transfers', 'total_bytes', 'completed_bytes')
 
 
 class TransferredResourceSerializer(serializers.ModelSerializer):
@@ -0,0 +1,20 @@
+'''
+Records a Tombstone when a Resource or Transfer is deleted, so that the deletion reaches
+the clients syncing changes (see sync.py).  These are signal handlers rather than
+overrides of delete(), since most deletions are cascades (e.g. removing a Resource removes
+its Transfers) or queryset deletes, neither of which calls delete() on each object.
+'''
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from transfer_app.models import Resource, Transfer, Tombstone
+
+
+@receiver(post_delete, sender=Resource)
+def resource_deleted(sender, instance, **kwargs):
+    Tombstone.objects.create(model_name=Tombstone.RESOURCE, object_id=instance.pk, user_pk=instance.owner_id)
+
+
+@receiver(post_delete, sender=Transfer)
+def transfer_deleted(sender, instance, **kwargs):
+    Tombstone.objects.create(model_name=Tombstone.TRANSFER, object_id=instance.pk, user_pk=instance.originator_id)
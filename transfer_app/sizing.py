@@ -0,0 +1,94 @@
+'''
+Sizing policies decide the shape of the VM (machine type, disk type and disk size)
+for the transfers it will run.  The policy is chosen with 'sizing_policy' in the
+uploader/downloader config, given as the dotted path to a SizingPolicy subclass.
+'''
+from django.utils.module_loading import import_string
+
+import transfer_app.utils as utils
+import transfer_app.exceptions as exceptions
+
+
+def get_sizing_policy(custom_config):
+    '''
+    Returns an instance of the sizing policy named in the config
+    '''
+    policy_path = custom_config.get('sizing_policy', 'transfer_app.sizing.TieredSizingPolicy')
+    try:
+        policy_cls = import_string(policy_path)
+    except ImportError as ex:
+        raise exceptions.ExceptionWithMessage('Could not load the sizing policy "%s": %s' % (policy_path, ex))
+    return policy_cls(custom_config)
+
+
+class SizingPolicy(object):
+    '''
+    The interface for sizing policies.  choose() gets the item dicts (each with a
+    'size_in_bytes' key) for the transfers the VM will run, whether they are downloads, and the
+    provider on the other end (e.g. settings.DROPBOX).  It returns a dict with keys
+    'machine_type', 'disk_type' and 'disk_size_gb'.
+    '''
+    def __init__(self, custom_config):
+        self.config = custom_config
+
+    def choose(self, items, download, provider):
+        raise NotImplementedError
+
+    def active_size_in_bytes(self, items):
+        '''
+        A VM with several transfers runs batch_concurrency of them at once, and removes
+        each file once it is transferred.  This returns the most that can be in progress at once.
+        '''
+        concurrency = int(self.config['batch_concurrency'])
+        sizes = sorted([x['size_in_bytes'] for x in items], reverse=True)
+        return sum(sizes[:concurrency])
+
+    def disk_size_gb(self, size_in_bytes):
+        '''
+        Returns the disk size (in GB) needed to hold size_in_bytes, at least min_disk_size.
+        If the worker streams the file, it never lands on disk, so the minimum is enough.
+        '''
+        disk_size_factor = float(self.config['disk_size_factor'])
+        min_disk_size = int(float(self.config['min_disk_size']))
+        target_disk_size = int(disk_size_factor*size_in_bytes/1e9)
+        if (target_disk_size < min_disk_size) or utils.get_boolean(self.config, 'stream_transfers'):
+            target_disk_size = min_disk_size
+        return target_disk_size
+
+
+class TieredSizingPolicy(SizingPolicy):
+    '''
+    Chooses the machine and disk type from the tiers in 'sizing_tiers', based on the
+    amount of data in progress on the VM.  Each line of the setting is a tier given as
+        <max size in GB> <machine type> <disk type>
+    in increasing order of size.  The first tier that holds the data is used, and
+    a max size of * matches anything.  Network throughput scales with the number of CPUs,
+    so larger transfers benefit from larger machines.
+    '''
+
+    def tiers(self):
+        tiers = []
+        for line in self.config['sizing_tiers'].strip().splitlines():
+            contents = line.split()
+            if len(contents) != 3:
+                raise exceptions.ExceptionWithMessage('Could not parse the sizing tier "%s".  '
+                    'Expected <max size in GB> <machine type> <disk type>' % line.strip())
+            max_size, machine_type, disk_type = contents
+            max_size_in_bytes = float('inf') if max_size == '*' else float(max_size)*1e9
+            tiers.append((max_size_in_bytes, machine_type, disk_type))
+        return tiers
+
+    def choose(self, items, download, provider):
+        size_in_bytes = self.active_size_in_bytes(items)
+        tiers = self.tiers()
+        # if nothing matches, the largest tier is used:
+        chosen_tier = tiers[-1]
+        for tier in tiers:
+            if size_in_bytes <= tier[0]:
+                chosen_tier = tier
+                break
+        return {
+            'machine_type': chosen_tier[1],
+            'disk_type': chosen_tier[2],
+            'disk_size_gb': self.disk_size_gb(size_in_bytes)
+        }
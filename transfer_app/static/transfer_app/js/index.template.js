@@ -40,30 +40,46 @@ START Loading of dynamic resources:
 
 var csrfToken = getCookie('csrftoken');
 
-// Get the active resources for the download tab:
-$.ajax({
-    url:"{{resource_endpoint}}?is_active=true",
-    type:"GET",
-    headers:{"X-CSRFToken": csrfToken},
-    success:function(response){
-        var tableBody = $("#download-table tbody");
-        var markup = "";
-        for(var i=0; i<response.length; i++){
-            var item = response[i];
-            var size = humanFileSize(item['size']);
-            var filename = item['name'];
-            markup += `<tr>
-                      <td><input class="download-selector" type="checkbox" target="${item['id']}"/></td>
-                      <td>${filename}</td>
-                      <td>${size}</td>
-                    </tr>`;
+// The listings are paginated (see transfer_app/pagination.py).  This gets the page
+// at url and passes its items to onPage.  While there are more pages, moreLink (a
+// "load more" element) is shown, and clicking it gets the next one.  That way only the
+// pages the user asks for are loaded, however long the listing is.
+function getPage(url, onPage, moreLink){
+    moreLink.off("click").hide();
+    $.ajax({
+        url:url,
+        type:"GET",
+        headers:{"X-CSRFToken": csrfToken},
+        success:function(response){
+            onPage(response['results']);
+            if(response['next']){
+                moreLink.one("click", function(){
+                    getPage(response['next'], onPage, moreLink);
+                }).show();
+            }
+        },
+        error:function(){
+            console.log('error!');
         }
-        tableBody.append(markup); 
-    },
-    error:function(){
-        console.log('error!');
+    });
+}
+
+// Get the active resources for the download tab:
+getPage("{{resource_endpoint}}?is_active=true", function(results){
+    var tableBody = $("#download-table tbody");
+    var markup = "";
+    for(var i=0; i<results.length; i++){
+        var item = results[i];
+        var size = humanFileSize(item['size']);
+        var filename = item['name'];
+        markup += `<tr>
+                  <td><input class="download-selector" type="checkbox" target="${item['id']}"/></td>
+                  <td>${filename}</td>
+                  <td>${size}</td>
+                </tr>`;
     }
-});
+    tableBody.append(markup); 
+}, $("#more-downloads"));
 
 function parseDateString(s){
     // string is formatted like:
@@ -141,36 +157,65 @@ function showDetail(pk){
 // need this in the global scope
 var history = {};
 
-// get the history
+// the largest transfer id seen, so that an event for a newer transfer can be told
+// apart from one for an older transfer on a page not loaded yet:
+var newestTransfer = 0;
+
+// returns the row of the history table for the item (from the transferred-resources listing)
+function historyRow(item){
+    var pk = item['id'];
+    var filename = item['resource']['name'];
+    var row = $(`<tr>
+          <td>${filename}</td>
+          <td><span class="detail-loader" detail-key="${pk}">View</span></td>
+        </tr>`);
+    row.find(".detail-loader").click(function(e){
+        e.preventDefault();
+        var targetedDetail = $(this).attr("detail-key");
+        showDetail(targetedDetail);
+    });
+    return row;
+}
+
+function inHistoryTable(pk){
+    return $("#history-table tbody").find(`[detail-key="${pk}"]`).length > 0;
+}
+
+// get the (first page of the) history
 get_history = function(){
-    $.ajax({
-        url:"{{transferred_resources_endpoint}}",
-        type:"GET",
-        headers:{"X-CSRFToken": csrfToken},
-        success:function(response){
-            var tableBody = $("#history-table tbody");
-            var markup = "";
-            for(var i=0; i<response.length; i++){
-                var item = response[i];
-                var pk = item['id'];
-                history[pk] = item;
-                var filename = item['resource']['name'];
-                markup += `<tr>
-                      <td>${filename}</td>
-                      <td><span class="detail-loader" detail-key="${pk}">View</span></td>
-                    </tr>`;
+    var tableBody = $("#history-table tbody");
+    tableBody.empty();
+    getPage("{{transferred_resources_endpoint}}", function(results){
+        for(var i=0; i<results.length; i++){
+            var item = results[i];
+            history[item['id']] = item;
+            newestTransfer = Math.max(newestTransfer, item['id']);
+            // (it may have arrived as an event while the pages were loading)
+            if(!inHistoryTable(item['id'])){
+                tableBody.append(historyRow(item));
             }
-            tableBody.empty().append(markup);
+        }
+    }, $("#more-history"));
+}
 
-            $(".detail-loader").click(function(e){
-                e.preventDefault();
-                var targetedDetail = $(this).attr("detail-key");
-                showDetail(targetedDetail);
-            });
-        },
-        error:function(){
-            console.log('error!');
+// Changes to the user's transfers are pushed by the server as they happen (see 
+// transfer_app/events.py), so the history stays current without reloading it.
+// A new transfer goes at the top of the history; a changed one replaces the 
+// copy the detail view shows.  After a reconnect, the server first sends the
+// changes that were missed while the stream was closed.
+if(window.EventSource){
+    var transferEvents = new EventSource("{{transfer_events_url}}");
+    transferEvents.addEventListener("transfer", function(e){
+        var item = JSON.parse(e.data);
+        if(!inHistoryTable(item['id']) && (item['id'] > newestTransfer)){
+            $("#history-table tbody").prepend(historyRow(item));
+            newestTransfer = item['id'];
         }
+        history[item['id']] = item;
+    });
+    // sent after a reconnect if too much was missed to replay (see transfer_app/events.py):
+    transferEvents.addEventListener("reset", function(e){
+        get_history();
     });
 }
 
@@ -396,7 +441,10 @@ $("#refresh-history").click(function(){
 
 
 $("#back-to-history").click(function(){
-    get_history();
+    // with the event stream, the history is already current:
+    if(!window.EventSource){
+        get_history();
+    }
     $("#history-detail-section").toggle();
     $("#history").toggle();
 });
@@ -0,0 +1,94 @@
+'''
+Deduplicates the submission of upload and download batches.  The Transfer rows for a
+batch are only created once its task runs, so a double-click or a client retry could
+otherwise start a second set of VMs before the conflict checks can see the first.
+
+Each submission gets an idempotency key derived from the user and the content of the
+request.  The first submission takes a short-lived lock on that key in redis (the celery
+broker) and enqueues the task; a repeat within submission_dedup_seconds (general config)
+gets back the id of the batch already submitted instead.  The id is recorded on the batch's
+TransferCoordinator (once the task has created it), so the batch can be looked up by it
+(e.g. transfers/batch/?batch_id=...).
+'''
+import json
+import uuid
+import hashlib
+
+import redis
+from django.conf import settings
+
+
+KEY_PREFIX = 'transfer-submission:'
+
+# these differ between otherwise identical requests (e.g. a fresh OAuth token),
+# so they are left out of the key:
+IGNORED_KEYS = ('access_token', 'drive_token')
+
+# deletes the key only if it still holds the given batch id (a later submission may have 
+# taken it since ours expired), in one step:
+RELEASE_SCRIPT = '''
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+'''
+
+
+def get_redis():
+    return redis.StrictRedis.from_url(settings.CELERY_BROKER_URL)
+
+
+def submission_key(user_pk, items, target):
+    '''
+    Returns the idempotency key for a batch of transfers (a list of item dicts)
+    sent to `target` (the upload source or download destination)
+    '''
+    content = [{k:v for k,v in x.items() if k not in IGNORED_KEYS} for x in items]
+    content = sorted([json.dumps(x, sort_keys=True, default=str) for x in content])
+    digest = hashlib.sha256(json.dumps([user_pk, target, content], default=str).encode('utf-8'))
+    return KEY_PREFIX + digest.hexdigest()
+
+
+def release(client, key, batch_id):
+    '''
+    Releases the lock on the key taken for the batch, so that the batch can be submitted again
+    '''
+    try:
+        client.eval(RELEASE_SCRIPT, 1, key, batch_id)
+    except redis.RedisError as ex:
+        print('Could not release the submission of batch %s: %s' % (batch_id, ex))
+
+
+def submit_once(task, items, target, user_pk):
+    '''
+    Enqueues the task (upload or download) for the batch, unless the same batch was
+    submitted by the same user in the last submission_dedup_seconds.
+    Returns a tuple of (batch id, boolean), where the boolean is True if the task was enqueued.
+
+    If redis cannot be reached, the batch is submitted without the check.
+    '''
+    window = int(settings.CONFIG_PARAMS.get('submission_dedup_seconds', 60))
+    batch_id = uuid.uuid4().hex
+    locked = False
+    if window > 0:
+        key = submission_key(user_pk, items, target)
+        try:
+            client = get_redis()
+            if not client.set(key, batch_id, nx=True, ex=window):
+                existing_id = client.get(key)
+                if existing_id is not None:
+                    print('Batch %s was already submitted.  Not submitting again.' % existing_id.decode('utf-8'))
+                    return existing_id.decode('utf-8'), False
+                # the lock expired in the meantime, so this is no longer a repeat:
+                client.set(key, batch_id, ex=window)
+            locked = True
+        except redis.RedisError as ex:
+            print('Could not check for a repeated submission: %s' % ex)
+    try:
+        task.delay(items, target, batch_id)
+    except Exception:
+        # the batch was never enqueued, so a retry should not be taken for a repeat:
+        if locked:
+            release(client, key, batch_id)
+        raise
+    return batch_id, True
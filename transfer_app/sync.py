@@ -0,0 +1,116 @@
+'''
+Lets a client which keeps its own copy of the Resources or Transfers ask only for what
+has changed since it last asked, rather than fetching the listings again.  A sync then
+costs in proportion to the number of changes, not to the number of rows.
+
+A sync returns the rows changed since the client's cursor (by updated_at, which every
+save and bulk update sets; see models.ChangeTrackingQuerySet), the primary keys of those
+deleted since then (see models.Tombstone), and a new cursor for the next sync.  A first
+sync, without a cursor, returns every row and no deletions.  While 'more' is True, the
+client asks again straight away with the new cursor.
+
+The cursor is opaque to the client.  It holds the position reached in the changed rows
+and in the Tombstones, each as a (timestamp, id) pair which the indexes can seek to.
+
+A row is stamped when it is written, but is only visible once its transaction commits,
+which may be after a row stamped later.  So that a sync does not step past a row which
+commits late, rows and Tombstones from the last sync_settle_seconds are left for the next sync.
+
+Tombstones are removed after tombstone_retention_days (see prune_tombstones), so a cursor
+older than that could miss deletions.  It is refused, and the client starts over.
+'''
+import json
+import base64
+import datetime
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from transfer_app.models import Tombstone
+import transfer_app.exceptions as exceptions
+
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def get_setting(key, default):
+    return float(settings.CONFIG_PARAMS.get(key, default))
+
+
+def encode_cursor(position):
+    '''
+    position is a dict with keys 'changed' and 'deleted', each a (datetime, id) tuple
+    '''
+    data = {k: [v[0].isoformat(), v[1]] for k,v in position.items()}
+    return base64.urlsafe_b64encode(json.dumps(data).encode('utf-8')).decode('utf-8')
+
+
+def decode_cursor(cursor):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8'))
+        position = {k: (parse_datetime(data[k][0]), int(data[k][1])) for k in ('changed', 'deleted')}
+    except (ValueError, TypeError, KeyError, IndexError) as ex:
+        raise exceptions.RequestError('Invalid cursor.')
+    if any([x[0] is None for x in position.values()]):
+        raise exceptions.RequestError('Invalid cursor.')
+    return position
+
+
+def after(queryset, time_field, position, until, limit):
+    '''
+    Returns up to limit objects of the queryset past the position (a (datetime, id) tuple, or
+    None for the start) and before until, in order, and a boolean which is True if there are more
+    '''
+    if position is not None:
+        t, pk = position
+        queryset = queryset.filter(Q(**{time_field + '__gt': t}) | Q(**{time_field: t, 'id__gt': pk}))
+    queryset = queryset.filter(**{time_field + '__lt': until}).order_by(time_field, 'id')
+    objects = list(queryset[:limit + 1])
+    return objects[:limit], len(objects) > limit
+
+
+def changes(queryset, tombstones, cursor, limit, now):
+    '''
+    Returns what has changed since the cursor (None for a first sync) as a dict with keys:
+      - results: the objects of the queryset which were added or changed
+      - deleted: the primary keys from the tombstones (a Tombstone queryset, for the
+        same model and user as the queryset)
+      - cursor: the cursor for the next sync
+      - more: True if there are changes left, which a sync with the new cursor returns
+    '''
+    until = now - datetime.timedelta(seconds=get_setting('sync_settle_seconds', 5))
+    if cursor is None:
+        # the client gets every row, so it has no use for earlier deletions:
+        position = {'changed': None, 'deleted': (until, 0)}
+    else:
+        position = decode_cursor(cursor)
+        retention = datetime.timedelta(days=get_setting('tombstone_retention_days', 30))
+        if position['deleted'][0] < now - retention:
+            raise exceptions.CursorExpired()
+
+    results, more_results = after(queryset, 'updated_at', position['changed'], until, limit)
+    deleted, more_deleted = after(tombstones, 'deleted_at', position['deleted'], until, limit)
+
+    # once caught up, a position moves up to `until`, so that the cursor of a
+    # client which sees no changes (or no deletions) does not expire:
+    new_position = {
+        'changed': (results[-1].updated_at, results[-1].pk) if more_results else (until, 0),
+        'deleted': (deleted[-1].deleted_at, deleted[-1].pk) if more_deleted else (until, 0)
+    }
+    return {
+        'results': results,
+        'deleted': [x.object_id for x in deleted],
+        'cursor': encode_cursor(new_position),
+        'more': more_results or more_deleted
+    }
+
+
+def prune_tombstones(now):
+    '''
+    Removes the Tombstones older than tombstone_retention_days.  Run by the reaper.
+    '''
+    cutoff = now - datetime.timedelta(days=get_setting('tombstone_retention_days', 30))
+    num_removed, _ = Tombstone.objects.filter(deleted_at__lt=cutoff).delete()
+    return num_removed
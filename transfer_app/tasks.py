@@ -1,23 +1,116 @@
+import json
+
 from celery.decorators import task
+from django.utils import timezone
 
 from transfer_app import uploaders, downloaders
+from transfer_app.launchers import GoogleComputeLauncher, record_launch
+from transfer_app.models import LaunchAttempt
+from transfer_app.base import GoogleBase
+import transfer_app.scheduler as scheduler
+import transfer_app.reaper as reaper
+import transfer_app.sync as sync
 
 @task(name='upload')
-def upload(upload_info, upload_source):
+def upload(upload_info, upload_source, batch_id=None):
     '''
     upload_info is a list, with each entry a dictionary.
-    Each of those dictionaries has keys which are specific to the upload source
+    Each of those dictionaries has keys which are specific to the upload source.
+    batch_id is recorded on the TransferCoordinator (see submissions.py)
     '''
     uploader_cls = uploaders.get_uploader(upload_source)
-    uploader = uploader_cls(upload_info)
+    uploader = uploader_cls(upload_info, batch_id)
     uploader.upload()
 
 @task(name='download')
-def download(download_info, download_destination):
+def download(download_info, download_destination, batch_id=None):
     '''
     download_info is a list, with each entry a dictionary.
-    Each of those dictionaries has keys which are specific to the upload source
+    Each of those dictionaries has keys which are specific to the upload source.
+    batch_id is recorded on the TransferCoordinator (see submissions.py)
     '''
     downloader_cls = downloaders.get_downloader(download_destination)
-    downloader = downloader_cls(download_info)
+    downloader = downloader_cls(download_info, batch_id)
     downloader.download()
+
+@task(name='check_launch')
+def check_launch(project, zone, operation, polls=0):
+    '''
+    Follows the operation returned by the compute API when starting VMs
+    (see launchers.GoogleComputeLauncher) until it finishes, recording
+    failed launches on their Transfers.
+    '''
+    try:
+        finished = GoogleComputeLauncher.check_operation(project, zone, operation)
+    except Exception as ex:
+        print('Could not check on operation %s: %s' % (operation, ex))
+        finished = False
+    if not finished:
+        if polls < GoogleComputeLauncher.MAX_OPERATION_POLLS:
+            check_launch.apply_async(args=[project, zone, operation, polls + 1],
+                countdown=GoogleComputeLauncher.OPERATION_POLL_INTERVAL)
+        else:
+            print('Gave up waiting on operation %s' % operation)
+
+@task(name='launch_vm')
+def launch_vm(spec, launcher_name):
+    '''
+    Starts the VM(s) in one launch spec of a batch that was fanned out (see GoogleBase._fan_out).
+    A failure is recorded as a failed launch rather than raised, so it does not stop the
+    batch's chord.  Returns the outcome ('sent', 'queued' or 'failed') for finish_launches.
+    '''
+    admitted_spec = None
+    try:
+        admitted_spec = scheduler.admit(spec, launcher_name)
+        if admitted_spec is None:
+            return 'queued'
+        launcher = GoogleBase.launcher_classes[launcher_name]()
+        launcher.go(admitted_spec)
+        launcher.wait()
+        return 'sent'
+    except Exception as ex:
+        print('Could not launch %s: %s' % (', '.join(spec['instance_names']), ex))
+        # once admitted, the failure is recorded on the spec's LaunchAttempts:
+        record_launch(admitted_spec or spec, LaunchAttempt.FAILED, error=str(ex))
+        return 'failed'
+
+@task(name='finish_launches')
+def finish_launches(outcomes):
+    '''
+    Runs once every launch of a fanned-out batch has been sent, with the list of their outcomes
+    '''
+    counts = dict([(x, outcomes.count(x)) for x in ('sent', 'queued', 'failed')])
+    print('Batch launch finished: %(sent)d sent, %(queued)d queued, %(failed)d failed' % counts)
+    # launches that failed made room for queued VMs:
+    scheduler.release()
+
+@task(name='release_launches')
+def release_launches():
+    '''
+    Starts the queued VMs that now fit under the caps on running VMs (see scheduler.py).
+    As in launch_vm, a failure is recorded on that VM's LaunchAttempt, and does not 
+    stop the other claimed VMs from starting.
+    '''
+    launchers = {}
+    for attempt in scheduler.claim_queued():
+        spec = scheduler.launch_spec(attempt)
+        try:
+            if attempt.launcher not in launchers:
+                launchers[attempt.launcher] = GoogleBase.launcher_classes[attempt.launcher]()
+            launchers[attempt.launcher].go(spec)
+        except Exception as ex:
+            print('Could not launch %s: %s' % (attempt.instance_name, ex))
+            record_launch(spec, LaunchAttempt.FAILED, error=str(ex))
+    for launcher in launchers.values():
+        launcher.wait()
+
+@task(name='reap')
+def reap():
+    '''
+    Cleans up after workers that did not finish properly (see reaper.py).
+    Run periodically by celery beat.
+    '''
+    reaper.reap_transfers()
+    # and removes the old records of deletions (see sync.py):
+    sync.prune_tombstones(timezone.now())
+    reaper.reap_instances()
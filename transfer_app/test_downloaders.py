@@ -17,6 +17,14 @@ from transfer_app.models import Resource, Transfer, TransferCoordinator
 import transfer_app.downloaders as downloaders
 import transfer_app.exceptions as exceptions
 
+
+def container_arg(spec, flag):
+    '''
+    Returns the value following `flag` in the container args of a launch spec
+    '''
+    args = spec['container_args']
+    return args[args.index(flag) + 1]
+
 '''
 Tests for download transfer (Resources already exist in this case)
   - Transfers created, TransferCoordinator created
@@ -370,6 +378,12 @@ class GoogleEnvironmentDownloadTestCase(TestCase):
 class GoogleDropboxDownloadTestCase(GoogleEnvironmentDownloadTestCase):
 
     def setUp(self):
+        # the events published along the way go to a stand-in for redis:
+        self.redis_mock = mock.MagicMock()
+        patcher = mock.patch('transfer_app.events.get_redis', return_value=self.redis_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
         super()._setUp()
         self.destination = settings.DROPBOX
 
@@ -507,7 +521,7 @@ class GoogleDropboxDownloadTestCase(GoogleEnvironmentDownloadTestCase):
             body=expected_params, 
             headers=headers)
 
-        mock_download.delay.assert_called_once_with(download_info, self.destination)
+        mock_download.delay.assert_called_once_with(download_info, self.destination, mock.ANY)
 
     def test_download_auth_error_exchanging_code(self):
         super()._test_download_auth_error_exchanging_code()
@@ -524,10 +538,56 @@ class GoogleDropboxDownloadTestCase(GoogleEnvironmentDownloadTestCase):
     def test_simultaneous_download_by_two_originators(self):
         super()._test_simultaneous_download_by_two_originators()
 
+    def test_streaming_download_uses_minimum_disk(self):
+        '''
+        When the worker streams from storage into Dropbox, the file never touches the disk.
+        Check that the VM gets the minimum disk size (not scaled by the file size)
+        and that the worker is told to stream.
+        '''
+        downloader_cls = downloaders.get_downloader(self.destination)
+        download_info = [{'resource_pk':1, 'originator':2, 'destination':self.destination, 'access_token': 'abc123'}]
+        downloader = downloader_cls(download_info)
+        downloader.config_params['stream_transfers'] = 'True'
+        downloader.config_params['min_disk_size'] = 10
+        downloader.config_params['disk_size_factor'] = 3
+        m = mock.MagicMock()
+        downloader.launcher = m
+
+        downloader.download()
+        self.assertEqual(1, m.go.call_count)
+        spec = m.go.call_args[0][0]
+        self.assertEqual(spec['disk_size_gb'], 10)
+        self.assertTrue('-stream' in spec['container_args'])
+
+    def test_download_passes_slice_settings(self):
+        '''
+        The worker reads the object from the bucket in parallel byte ranges.
+        Check that the configured number/size of slices are passed along.
+        '''
+        downloader_cls = downloaders.get_downloader(self.destination)
+        download_info = [{'resource_pk':1, 'originator':2, 'destination':self.destination, 'access_token': 'abc123'}]
+        downloader = downloader_cls(download_info)
+        downloader.config_params['download_slices'] = 8
+        downloader.config_params['slice_size_mb'] = 32
+        m = mock.MagicMock()
+        downloader.launcher = m
+
+        downloader.download()
+        self.assertEqual(1, m.go.call_count)
+        spec = m.go.call_args[0][0]
+        self.assertEqual(container_arg(spec, '-slices'), 8)
+        self.assertEqual(container_arg(spec, '-slice_size'), 32)
+
 
 class GoogleDriveDownloadTestCase(GoogleEnvironmentDownloadTestCase):
 
     def setUp(self):
+        # the events published along the way go to a stand-in for redis:
+        self.redis_mock = mock.MagicMock()
+        patcher = mock.patch('transfer_app.events.get_redis', return_value=self.redis_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
         super()._setUp()
         self.destination = settings.GOOGLE_DRIVE
 
@@ -669,7 +729,7 @@ class GoogleDriveDownloadTestCase(GoogleEnvironmentDownloadTestCase):
             body=expected_params, 
             headers=headers)
 
-        mock_download.delay.assert_called_once_with(download_info, self.destination)
+        mock_download.delay.assert_called_once_with(download_info, self.destination, mock.ANY)
 
     def test_download_auth_error_exchanging_code(self):
         super()._test_download_auth_error_exchanging_code()
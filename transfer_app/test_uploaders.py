@@ -1,4 +1,5 @@
 import json
+import base64
 
 from django.test import TestCase
 import unittest.mock as mock
@@ -8,12 +9,21 @@ from rest_framework import status
 from django.urls import reverse
 from django.contrib.auth import get_user_model
 from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
-from transfer_app.models import Resource, Transfer, TransferCoordinator
+from transfer_app.models import Resource, Transfer, TransferCoordinator, WorkerJob, PoolWorker, LaunchAttempt
 import transfer_app.uploaders as uploaders
 import transfer_app.exceptions as exceptions
 
 
+def container_arg(spec, flag):
+    '''
+    Returns the value following `flag` in the container args of a launch spec
+    '''
+    args = spec['container_args']
+    return args[args.index(flag) + 1]
+
 class GeneralUploadInitTestCase(TestCase):
 
     def test_uploader_mod_returns_correct_uploader_implementation(self):
@@ -46,6 +56,12 @@ class DropboxGoogleUploadInitTestCase(TestCase):
     '''
 
     def setUp(self):
+        # the events published along the way go to a stand-in for redis:
+        self.redis_mock = mock.MagicMock()
+        patcher = mock.patch('transfer_app.events.get_redis', return_value=self.redis_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
         '''
         In an upload, users are transferring TO our system.  Resource objects do NOT exist up front.
 
@@ -305,6 +321,73 @@ class DropboxGoogleUploadInitTestCase(TestCase):
         self.assertTrue(all([not x.completed for x in all_transfers])) # no transfer is complete
         self.assertFalse(all_tc[0].completed) # the transfer coord is also not completed
 
+    def test_dropbox_uploader_setup_is_batched(self):
+        '''
+        The database objects for a batch are created with a fixed number of queries,
+        however many files there are, and each item gets the pk of its own Transfer
+        '''
+        uploader_cls = uploaders.get_uploader(settings.DROPBOX)
+
+        def count_setup_queries(num_files):
+            upload_info = [{'path': 'https://dropbox-link.com/%d/%d' % (num_files, i), 'name':'f%d_%d.txt' % (num_files, i), 'owner':2} for i in range(num_files)]
+            upload_info, error_messages = uploader_cls.check_format(upload_info, 2)
+            uploader = uploader_cls(upload_info)
+            with CaptureQueriesContext(connection) as queries:
+                uploader.uploader._transfer_setup()
+            for item in upload_info:
+                t = Transfer.objects.get(pk=item['transfer_pk'])
+                self.assertEqual(t.resource.path, item['path'])
+                self.assertEqual(t.originator.pk, 2)
+            return len(queries)
+
+        self.assertEqual(count_setup_queries(2), count_setup_queries(50))
+        self.assertEqual(Transfer.objects.count(), 52)
+        self.assertEqual(TransferCoordinator.objects.count(), 2)
+        self.assertEqual(sorted(TransferCoordinator.objects.values_list('total_transfers', flat=True)), [2, 50])
+
+    def test_setup_is_not_confused_by_concurrent_inserts(self):
+        '''
+        Where the database does not return the pks from a bulk insert, the new rows are
+        found by their content rather than by being the newest
+        '''
+        uploader_cls = uploaders.get_uploader(settings.DROPBOX)
+        upload_info = [{'path': 'https://dropbox-link.com/%d' % i, 'name':'f%d.txt' % i, 'owner':self.regular_user.pk} for i in range(3)]
+        upload_info, error_messages = uploader_cls.check_format(upload_info, self.regular_user.pk)
+
+        bulk_create = Resource.objects.bulk_create
+        def bulk_create_then_insert(instances):
+            result = bulk_create(instances)
+            # another request adds a Resource in the meantime:
+            Resource.objects.create(source='dropbox', path='https://dropbox-link.com/other', name='other.txt', owner=self.other_user)
+            return result
+        with mock.patch.object(connection.features, 'can_return_ids_from_bulk_insert', False, create=True), \
+            mock.patch.object(connection.features, 'can_return_rows_from_bulk_insert', False, create=True), \
+            mock.patch.object(Resource.objects, 'bulk_create', side_effect=bulk_create_then_insert):
+            uploader_cls(upload_info).uploader._transfer_setup()
+        for item in upload_info:
+            t = Transfer.objects.get(pk=item['transfer_pk'])
+            self.assertEqual(t.resource.path, item['path'])
+            self.assertEqual(t.resource.owner, self.regular_user)
+
+    def test_batch_can_be_found_by_submission_id(self):
+        '''
+        The id given to a submission is recorded on its TransferCoordinator, so a client
+        told that its request was a repeat can find the batch already started
+        '''
+        uploader_cls = uploaders.get_uploader(settings.DROPBOX)
+        upload_info = [{'path': 'https://dropbox-link.com/1', 'name':'f.txt', 'owner':self.regular_user.pk}]
+        upload_info, error_messages = uploader_cls.check_format(upload_info, self.regular_user.pk)
+        uploader_cls(upload_info, 'abc123').uploader._transfer_setup()
+        tc = Transfer.objects.get(pk=upload_info[0]['transfer_pk']).coordinator
+
+        client = APIClient()
+        client.login(email='reguser@gmail.com', password='abcd123!')
+        response = client.get(reverse('batch-list'), {'batch_id': 'abc123'})
+        self.assertEqual([x['id'] for x in response.data['results']], [tc.pk,])
+        self.assertEqual(response.data['results'][0]['batch_id'], 'abc123')
+        response = client.get(reverse('batch-list'), {'batch_id': 'other'})
+        self.assertEqual(response.data['results'], [])
+
     @mock.patch.dict('transfer_app.uploaders.os.environ', {'GCLOUD': '/mock/bin/gcloud'})
     def test_dropbox_uploader_on_google_params_single(self):
         
@@ -360,12 +443,230 @@ class DropboxGoogleUploadInitTestCase(TestCase):
         self.assertTrue(m.go.called)
         self.assertEqual(1, m.go.call_count)
 
-        call_arg = m.go.call_args
-        the_call = call_arg.call_list()[0]
-        import re
-        target = '--boot-disk-size=300GB'
-        matches = re.findall(target, str(the_call))
-        self.assertEqual(len(matches), 1)
+        spec = m.go.call_args[0][0]
+        self.assertEqual(spec['disk_size_gb'], 300)
+
+    def test_dropbox_uploader_on_google_records_shape(self):
+        '''
+        The VM shape comes from the sizing tiers, and is recorded on the Transfer
+        '''
+        uploader_cls = uploaders.get_uploader(settings.DROPBOX)
+        upload_info = {'path': 'https://dropbox-link.com/1', 'name':'f1.txt', 'owner':2, 'size_in_bytes': 500e9}
+        upload_info, error_messages = uploader_cls.check_format(upload_info, 2)
+
+        uploader = uploader_cls(upload_info)
+        uploader.config_params['sizing_tiers'] = '10 g1-small pd-standard\n* n1-standard-16 pd-ssd'
+        uploader.config_params['disk_size_factor'] = 2
+        m = mock.MagicMock()
+        uploader.launcher = m
+
+        uploader.upload()
+        spec = m.go.call_args[0][0]
+        self.assertEqual(spec['machine_type'], 'n1-standard-16')
+        self.assertEqual(spec['disk_type'], 'pd-ssd')
+        transfer = Transfer.objects.get(pk=spec['transfer_pks'][0])
+        self.assertEqual(transfer.machine_type, 'n1-standard-16')
+        self.assertEqual(transfer.disk_type, 'pd-ssd')
+        self.assertEqual(transfer.disk_size_gb, 1000)
+
+    @mock.patch.dict(settings.CONFIG_PARAMS, {'max_concurrent_vms': '1'})
+    def test_dropbox_uploader_on_google_queues_over_vm_cap(self):
+        '''
+        VMs beyond the cap on running VMs are queued rather than started
+        '''
+        uploader_cls = uploaders.get_uploader(settings.DROPBOX)
+        upload_info = []
+        for i in range(3):
+            upload_info.append({'path': 'https://dropbox-link.com/%d' % i, 'name':'f%d.txt' % i, 'owner':2, 'size_in_bytes': 1e9})
+        upload_info, error_messages = uploader_cls.check_format(upload_info, 2)
+
+        uploader = uploader_cls(upload_info)
+        m = mock.MagicMock()
+        uploader.launcher = m
+
+        uploader.upload()
+        self.assertEqual(1, m.go.call_count)
+        self.assertEqual(LaunchAttempt.objects.filter(status=LaunchAttempt.PENDING).count(), 1)
+        queued = LaunchAttempt.objects.filter(status=LaunchAttempt.QUEUED)
+        self.assertEqual(queued.count(), 2)
+        self.assertEqual(sorted([container_arg(json.loads(x.spec), '-path') for x in queued]), 
+            ['https://dropbox-link.com/1', 'https://dropbox-link.com/2'])
+
+    def test_dropbox_uploader_on_google_passes_connections(self):
+        '''
+        The worker downloads from the Dropbox link over several concurrent connections.
+        Check that the configured number is passed along.
+        '''
+        uploader_cls = uploaders.get_uploader(settings.DROPBOX)
+        upload_info = {'path': 'https://dropbox-link.com/1', 'name':'f1.txt', 'owner':2}
+        upload_info, error_messages = uploader_cls.check_format(upload_info, 2)
+
+        uploader = uploader_cls(upload_info)
+        uploader.config_params['download_connections'] = 6
+        m = mock.MagicMock()
+        uploader.launcher = m
+
+        uploader.upload()
+        self.assertEqual(1, m.go.call_count)
+        spec = m.go.call_args[0][0]
+        self.assertEqual(container_arg(spec, '-connections'), 6)
+
+    def test_dropbox_uploader_on_google_fans_out_large_batch(self):
+        '''
+        A batch needing at least launch_fanout_min_vms VMs is launched with one task per VM,
+        joined by a chord, instead of launching each VM in turn
+        '''
+        uploader_cls = uploaders.get_uploader(settings.DROPBOX)
+        upload_info = []
+        for i in range(3):
+            upload_info.append({'path': 'https://dropbox-link.com/%d' % i, 'name':'f%d.txt' % i, 'owner':2, 'size_in_bytes': 1e9})
+        upload_info, error_messages = uploader_cls.check_format(upload_info, 2)
+
+        uploader = uploader_cls(upload_info)
+        uploader.config_params['launch_fanout_min_vms'] = 3
+        m = mock.MagicMock()
+        uploader.launcher = m
+
+        with mock.patch('transfer_app.base.chord') as mock_chord:
+            uploader.upload()
+        self.assertEqual(0, m.go.call_count)
+        header = mock_chord.call_args[0][0]
+        self.assertEqual(len(header), 3)
+        self.assertEqual(sorted([container_arg(x.args[0], '-path') for x in header]), 
+            ['https://dropbox-link.com/0', 'https://dropbox-link.com/1', 'https://dropbox-link.com/2'])
+        self.assertEqual(header[0].args[1], 'gcloud')
+        # the callback is given to the chord:
+        self.assertEqual(mock_chord.return_value.call_args[0][0].task, 'finish_launches')
+
+    def test_dropbox_uploader_on_google_uses_spot_for_large_file(self):
+        '''
+        A large transfer with a VM to itself goes on a Spot VM, and its worker is told where 
+        to send checkpoints.  Smaller transfers get regular VMs.
+        '''
+        uploader_cls = uploaders.get_uploader(settings.DROPBOX)
+        upload_info = []
+        upload_info.append({'path': 'https://dropbox-link.com/1', 'name':'f1.txt', 'owner':2, 'size_in_bytes': 1e9})
+        upload_info.append({'path': 'https://dropbox-link.com/2', 'name':'f2.txt', 'owner':2, 'size_in_bytes': 200e9})
+        upload_info, error_messages = uploader_cls.check_format(upload_info, 2)
+
+        uploader = uploader_cls(upload_info)
+        uploader.config_params['spot_min_size_gb'] = 100
+        uploader.config_params['checkpoint_interval'] = 30
+        m = mock.MagicMock()
+        uploader.launcher = m
+
+        uploader.upload()
+        self.assertEqual(2, m.go.call_count)
+        small_spec = m.go.call_args_list[0][0][0]
+        self.assertFalse(small_spec.get('spot', False))
+        self.assertFalse('-checkpoint_url' in small_spec['container_args'])
+        large_spec = m.go.call_args_list[1][0][0]
+        self.assertTrue(large_spec['spot'])
+        self.assertEqual(container_arg(large_spec, '-path'), 'https://dropbox-link.com/2')
+        self.assertTrue(container_arg(large_spec, '-checkpoint_url').endswith(reverse('transfer-checkpoint')))
+        self.assertEqual(container_arg(large_spec, '-checkpoint_interval'), 30)
+
+    def test_dropbox_uploader_on_google_packs_batch(self):
+        '''
+        With batching enabled, transfers share a VM.  The worker receives a manifest
+        of the transfers, and files larger than the batch size limit get their own VM.
+        '''
+        uploader_cls = uploaders.get_uploader(settings.DROPBOX)
+        upload_info = []
+        upload_info.append({'path': 'https://dropbox-link.com/1', 'name':'f1.txt', 'owner':2, 'size_in_bytes': 1e9})
+        upload_info.append({'path': 'https://dropbox-link.com/2', 'name':'f2.txt', 'owner':2, 'size_in_bytes': 2e9})
+        upload_info.append({'path': 'https://dropbox-link.com/3', 'name':'f3.txt', 'owner':2, 'size_in_bytes': 100e9})
+        upload_info, error_messages = uploader_cls.check_format(upload_info, 2)
+
+        uploader = uploader_cls(upload_info)
+        uploader.config_params['batch_max_items'] = 10
+        uploader.config_params['batch_max_size_gb'] = 50
+        uploader.config_params['batch_concurrency'] = 2
+        m = mock.MagicMock()
+        uploader.launcher = m
+
+        uploader.upload()
+        self.assertEqual(2, m.go.call_count)
+
+        # the first VM gets a manifest with the two small files:
+        batch_spec = m.go.call_args_list[0][0][0]
+        manifest = json.loads(base64.b64decode(container_arg(batch_spec, '-manifest')).decode('utf-8'))
+        self.assertEqual([x['resource_path'] for x in manifest], ['https://dropbox-link.com/1', 'https://dropbox-link.com/2'])
+        transfer_pks = [x.pk for x in Transfer.objects.all()]
+        self.assertTrue(all([x['transfer_pk'] in transfer_pks for x in manifest]))
+        self.assertEqual(container_arg(batch_spec, '-concurrency'), 2)
+
+        # the large file is sent on its own, without a manifest:
+        single_spec = m.go.call_args_list[1][0][0]
+        self.assertFalse('-manifest' in single_spec['container_args'])
+        self.assertEqual(container_arg(single_spec, '-path'), 'https://dropbox-link.com/3')
+
+    def test_dropbox_uploader_on_google_runs_small_files_locally(self):
+        '''
+        Files below the local size limit are run by the worker script in this process,
+        with the same args a VM would get.  Larger files still get a VM.
+        '''
+        uploader_cls = uploaders.get_uploader(settings.DROPBOX)
+        upload_info = []
+        upload_info.append({'path': 'https://dropbox-link.com/1', 'name':'f1.txt', 'owner':2, 'size_in_bytes': 1e6})
+        upload_info.append({'path': 'https://dropbox-link.com/2', 'name':'f2.txt', 'owner':2, 'size_in_bytes': 100e9})
+        upload_info, error_messages = uploader_cls.check_format(upload_info, 2)
+
+        uploader = uploader_cls(upload_info)
+        uploader.config_params['local_transfer_max_size_mb'] = 50
+        uploader.config_params['local_transfer_concurrency'] = 3
+        m = mock.MagicMock()
+        uploader.launcher = m
+        local_launcher_cls = mock.MagicMock()
+        with mock.patch.object(uploaders.GoogleDropboxUploader, 'local_launcher_cls', local_launcher_cls):
+            uploader.upload()
+
+        self.assertEqual(1, m.go.call_count)
+        self.assertEqual(container_arg(m.go.call_args[0][0], '-path'), 'https://dropbox-link.com/2')
+
+        script_path, max_workers = local_launcher_cls.call_args[0]
+        self.assertTrue(script_path.endswith('startup_scripts/google/uploads/dropbox/container_startup.py'))
+        self.assertEqual(max_workers, 3)
+        local_launcher = local_launcher_cls.return_value
+        self.assertEqual(1, local_launcher.go.call_count)
+        spec = local_launcher.go.call_args[0][0]
+        self.assertEqual(container_arg(spec, '-path'), 'https://dropbox-link.com/1')
+        self.assertEqual(spec['transfer_pks'], [Transfer.objects.get(destination__endswith='f1.txt').pk,])
+        self.assertTrue(local_launcher.wait.called)
+
+    def test_dropbox_uploader_on_google_queues_for_pool(self):
+        '''
+        With the warm pool enabled, small transfers are queued as jobs for pool workers
+        (and pool workers are started) while large ones get their own VM.
+        '''
+        uploader_cls = uploaders.get_uploader(settings.DROPBOX)
+        upload_info = []
+        upload_info.append({'path': 'https://dropbox-link.com/1', 'name':'f1.txt', 'owner':2, 'size_in_bytes': 1e6})
+        upload_info.append({'path': 'https://dropbox-link.com/2', 'name':'f2.txt', 'owner':2, 'size_in_bytes': 2e6})
+        upload_info.append({'path': 'https://dropbox-link.com/3', 'name':'f3.txt', 'owner':2, 'size_in_bytes': 100e9})
+        upload_info, error_messages = uploader_cls.check_format(upload_info, 2)
+
+        uploader = uploader_cls(upload_info)
+        uploader.config_params['worker_pool_size'] = 1
+        uploader.config_params['worker_pool_max_file_size_gb'] = 5
+        m = mock.MagicMock()
+        uploader.launcher = m
+
+        uploader.upload()
+
+        # one pool worker and one VM for the large file:
+        self.assertEqual(2, m.go.call_count)
+        pool_spec = m.go.call_args_list[0][0][0]
+        self.assertEqual(container_arg(pool_spec, '-pool'), 'dropbox-upload')
+        self.assertFalse('-manifest' in pool_spec['container_args'])
+        single_spec = m.go.call_args_list[1][0][0]
+        self.assertEqual(container_arg(single_spec, '-path'), 'https://dropbox-link.com/3')
+
+        jobs = WorkerJob.objects.all()
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(sorted([json.loads(x.spec)['resource_path'] for x in jobs]), 
+            ['https://dropbox-link.com/1', 'https://dropbox-link.com/2'])
+        self.assertEqual(PoolWorker.objects.filter(pool='dropbox-upload').count(), 1)
 
 
 class DriveGoogleUploadInitTestCase(TestCase):
@@ -374,6 +675,12 @@ class DriveGoogleUploadInitTestCase(TestCase):
     '''
 
     def setUp(self):
+        # the events published along the way go to a stand-in for redis:
+        self.redis_mock = mock.MagicMock()
+        patcher = mock.patch('transfer_app.events.get_redis', return_value=self.redis_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
         '''
         In an upload, users are transferring TO our system.  Resource objects do NOT exist up front.
 
@@ -712,12 +1019,63 @@ class DriveGoogleUploadInitTestCase(TestCase):
         self.assertTrue(m.go.called)
         self.assertEqual(1, m.go.call_count)
 
-        call_arg = m.go.call_args
-        the_call = call_arg.call_list()[0]
-        import re
-        target = '--boot-disk-size=300GB'
-        matches = re.findall(target, str(the_call))
-        self.assertEqual(len(matches), 1)
+        spec = m.go.call_args[0][0]
+        self.assertEqual(spec['disk_size_gb'], 300)
+
+    def test_drive_uploader_on_google_streaming_uses_minimum_disk(self):
+        '''
+        When the worker streams from Drive into storage, the file never touches the disk,
+        so the VM gets the minimum disk size regardless of the file size
+        '''
+        uploader_cls = uploaders.get_uploader(settings.GOOGLE_DRIVE)
+        upload_info = [{
+                        'file_id': 'abc123',
+                        'drive_token': 'fooToken',
+                        'name':'f1.txt',
+                        'owner':2,
+                        'size_in_bytes': 100e9}]
+
+        upload_info, error_messages = uploader_cls.check_format(upload_info, 2)
+
+        uploader = uploader_cls(upload_info)
+        uploader.config_params['disk_size_factor'] = 3
+        uploader.config_params['min_disk_size'] = 10
+        uploader.config_params['stream_transfers'] = 'True'
+        m = mock.MagicMock()
+        uploader.launcher = m
+
+        uploader.upload()
+        self.assertEqual(1, m.go.call_count)
+        spec = m.go.call_args[0][0]
+        self.assertEqual(spec['disk_size_gb'], 10)
+        self.assertTrue('-stream' in spec['container_args'])
+
+    def test_drive_uploader_on_google_passes_composite_settings(self):
+        '''
+        Large files are pushed to storage as parallel composite parts.  Check that
+        the configured threshold and number of parts are passed to the worker.
+        '''
+        uploader_cls = uploaders.get_uploader(settings.GOOGLE_DRIVE)
+        upload_info = [{
+                        'file_id': 'abc123',
+                        'drive_token': 'fooToken',
+                        'name':'f1.txt',
+                        'owner':2,
+                        'size_in_bytes': 100e9}]
+
+        upload_info, error_messages = uploader_cls.check_format(upload_info, 2)
+
+        uploader = uploader_cls(upload_info)
+        uploader.config_params['composite_threshold_mb'] = 2048
+        uploader.config_params['composite_parts'] = 16
+        m = mock.MagicMock()
+        uploader.launcher = m
+
+        uploader.upload()
+        self.assertEqual(1, m.go.call_count)
+        spec = m.go.call_args[0][0]
+        self.assertEqual(container_arg(spec, '-composite_threshold'), 2048)
+        self.assertEqual(container_arg(spec, '-composite_parts'), 16)
 
 
 class GoogleEnvironmentUploadInitTestCase(TestCase):
@@ -726,6 +1084,12 @@ class GoogleEnvironmentUploadInitTestCase(TestCase):
     '''
 
     def setUp(self):
+        # the events published along the way go to a stand-in for redis:
+        self.redis_mock = mock.MagicMock()
+        patcher = mock.patch('transfer_app.events.get_redis', return_value=self.redis_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
         '''
         In an upload, users are transferring TO our system.  Resource objects do NOT exist up front.
         '''
@@ -942,3 +1306,22 @@ class GoogleEnvironmentUploadInitTestCase(TestCase):
         self.assertTrue(sum([not tc.completed for tc in all_tc])==1)
         self.assertTrue(sum([tc.completed for tc in all_tc])==1)
 
+
+    def test_conflict_check_is_one_query(self):
+        '''
+        The check against transfers in progress is a single query, however many
+        transfers there are
+        '''
+        uploader_cls = uploaders.get_uploader(settings.DROPBOX)
+        upload_info = [{'path': 'https://dropbox-link.com/%d' % i, 'name':'f%d.txt' % i, 'owner':2} for i in range(5)]
+        upload_info, error_messages = uploader_cls.check_format(upload_info, 2)
+        uploader = uploader_cls(upload_info)
+        uploader.launcher = mock.MagicMock()
+        uploader.upload()
+
+        additional_uploads = [dict(x) for x in upload_info[:3]]
+        additional_uploads.append(dict(upload_info[0], name='new.txt', destination=upload_info[0]['destination'] + '.new'))
+        with self.assertNumQueries(1):
+            processed_uploads, error_messages = uploader_cls._check_conflicts(additional_uploads)
+        self.assertEqual(len(processed_uploads), 1)
+        self.assertEqual(len(error_messages), 3)
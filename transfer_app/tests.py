@@ -1,4 +1,10 @@
+import os
 import sys
+import json
+import datetime
+import shutil
+import tempfile
+import unittest.mock as mock
 from Crypto.Cipher import DES
 import base64
 
@@ -9,8 +15,23 @@ from rest_framework import status
 from django.urls import reverse
 from django.contrib.auth import get_user_model
 from django.conf import settings
-
-from transfer_app.models import Resource, Transfer, TransferCoordinator
+from django.utils import timezone
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from transfer_app.models import Resource, Transfer, TransferCoordinator, WorkerJob, PoolWorker, LaunchAttempt, TransferCheckpoint, Tombstone
+from transfer_app.sizing import TieredSizingPolicy
+import transfer_app.scheduler as scheduler
+import transfer_app.launchers as launchers
+import transfer_app.reaper as reaper
+import transfer_app.routing as routing
+import transfer_app.submissions as submissions
+import transfer_app.events as events
+import transfer_app.sync as sync
+from transfer_app.base import GoogleBase
+import transfer_app.tasks as transfer_tasks
+import transfer_app.utils as utils
+from transfer_app.launchers import group_transfers, record_launch, GoogleLauncher, GoogleComputeLauncher, LocalLauncher
 
 # a method for creating a reasonable test dataset:
 def create_data(testcase_obj):
@@ -131,7 +152,7 @@ class ResourceListTestCase(TestCase):
         url = reverse('resource-list')
         response = client.get(url)
         self.assertEqual(response.status_code,200) 
-        self.assertEqual(len(response.data), len(r))
+        self.assertEqual(len(response.data['results']), len(r))
 
     def test_regular_user_can_list_only_their_resources(self):
         client = APIClient()
@@ -140,12 +161,12 @@ class ResourceListTestCase(TestCase):
         reguser_pk = u.pk
         url = reverse('resource-list')
         response = client.get(url)
-        data = response.data
+        data = response.data['results']
 
         # test that we received 200, there are two resources, and they both
         # are owned by the 'regular' user
         self.assertEqual(response.status_code,200) 
-        self.assertEqual(len(response.data), 3)
+        self.assertEqual(len(response.data['results']), 3)
         self.assertTrue(all([x.get('owner') == reguser_pk for x in data]))
 
     def test_unauthenticated_user_gets_403_for_basic_list(self):
@@ -394,9 +415,9 @@ class UserResourceListTestCase(TestCase):
 
         url = reverse('user-resource-list', args=[reguser_pk])
         response = client.get(url)
-        data = response.data
+        data = response.data['results']
         self.assertEqual(response.status_code,200) 
-        self.assertEqual(len(response.data), 3)
+        self.assertEqual(len(response.data['results']), 3)
         self.assertTrue(all([x.get('owner') == reguser_pk for x in data]))    
 
 '''
@@ -418,7 +439,7 @@ class TransferListTestCase(TestCase):
         url = reverse('transfer-list')
         response = admin_client.get(url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 5) 
+        self.assertEqual(len(response.data['results']), 5) 
 
     def test_nonadmin_list_returns_only_owned_transfers(self):
         '''
@@ -434,7 +455,53 @@ class TransferListTestCase(TestCase):
         url = reverse('transfer-list')
         response = reg_client.get(url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 3)
+        self.assertEqual(len(response.data['results']), 3)
+
+    def test_list_queries_do_not_grow_with_transfers(self):
+        '''
+        The listings (including the one with the Resource for each Transfer) take
+        the same number of queries however many Transfers there are
+        '''
+        reg_user = get_user_model().objects.get(email='reguser@gmail.com')
+        reg_client = APIClient()
+        reg_client.login(email='reguser@gmail.com', password='abcd123!')
+
+        def count_queries(url_name):
+            with CaptureQueriesContext(connection) as queries:
+                response = reg_client.get(reverse(url_name))
+            self.assertEqual(response.status_code, 200)
+            return len(queries), len(response.data['results'])
+
+        before = [count_queries(x) for x in ('transfer-list', 'transferred-resource-list', 'batch-list')]
+        t = Transfer.objects.user_transfers(reg_user)[0]
+        for i in range(5):
+            tc = TransferCoordinator.objects.create()
+            Transfer.objects.create(download=True, resource=t.resource, destination='dropbox', coordinator=tc, originator=reg_user)
+        after = [count_queries(x) for x in ('transfer-list', 'transferred-resource-list', 'batch-list')]
+        self.assertEqual([x[0] for x in before], [x[0] for x in after])
+        self.assertEqual([x[1] + 5 for x in before], [x[1] for x in after])
+
+    def test_list_is_paged_by_cursor(self):
+        '''
+        The listing comes in pages, newest first.  Following the 'next' links gives
+        every Transfer once, even if a Transfer is added part way through.
+        '''
+        admin_client = APIClient()
+        admin_client.login(email='admin@admin.com', password='abcd123!') 
+        url = '%s?page_size=2' % reverse('transfer-list')
+        seen = []
+        while url is not None:
+            response = admin_client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(len(response.data['results']) <= 2)
+            seen.extend([x['id'] for x in response.data['results']])
+            if len(seen) == 2:
+                t = Transfer.objects.all()[0]
+                Transfer.objects.create(download=True, resource=t.resource, destination='dropbox', 
+                    coordinator=t.coordinator, originator=t.originator)
+            url = response.data['next']
+        expected = Transfer.objects.order_by('-start_time', '-id').values_list('id', flat=True)
+        self.assertEqual(seen, list(expected)[1:])
 
     def test_list_download_transfers_for_admin(self):
         '''
@@ -447,7 +514,7 @@ class TransferListTestCase(TestCase):
         url = '%s?download=true' % url
         response = admin_client.get(url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 3)
+        self.assertEqual(len(response.data['results']), 3)
 
     def test_list_upload_transfers_for_admin(self):
         '''
@@ -460,7 +527,7 @@ class TransferListTestCase(TestCase):
         url = '%s?download=false' % url
         response = admin_client.get(url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 2)
+        self.assertEqual(len(response.data['results']), 2)
 
     def test_list_download_transfers_for_reguser(self):
         '''
@@ -473,7 +540,7 @@ class TransferListTestCase(TestCase):
         url = '%s?download=true' % url
         response = reg_client.get(url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 2)
+        self.assertEqual(len(response.data['results']), 2)
 
     def test_list_upload_transfers_for_reguser(self):
         '''
@@ -489,7 +556,7 @@ class TransferListTestCase(TestCase):
         url = '%s?download=false' % url
         response = reg_client.get(url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data['results']), 1)
         
 '''
 
@@ -646,9 +713,9 @@ class UserTransferListTestCase(TestCase):
 
         url = reverse('user-transfer-list', args=[reguser_pk])
         response = client.get(url)
-        data = response.data
+        data = response.data['results']
         self.assertEqual(response.status_code,200) 
-        self.assertEqual(len(response.data), 3)
+        self.assertEqual(len(response.data['results']), 3)
         owner_status = []
         for item in data:
             resource_pk = item['resource']
@@ -843,7 +910,7 @@ class TransferCoordinatorListTestCase(TestCase):
         url = reverse('batch-list')
         response = admin_client.get(url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 4) 
+        self.assertEqual(len(response.data['results']), 4) 
 
     def test_nonadmin_list_returns_only_owned_transfers(self):
         reg_user = get_user_model().objects.get(email='reguser@gmail.com')
@@ -855,8 +922,8 @@ class TransferCoordinatorListTestCase(TestCase):
         url = reverse('batch-list')
         response = reg_client.get(url)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(response.data), 2)
-        data = response.data
+        self.assertEqual(len(response.data['results']), 2)
+        data = response.data['results']
         result_set = set()
         for item in data:
             result_set.add(item['id'])
@@ -1025,9 +1092,9 @@ class TransferCoordinatorUserListCase(TestCase):
 
         url = reverse('user-batch-list', args=[reguser_pk])
         response = client.get(url)
-        data = response.data
+        data = response.data['results']
         self.assertEqual(response.status_code, 200) 
-        self.assertEqual(len(response.data), 2)
+        self.assertEqual(len(response.data['results']), 2)
 
         # check that the TransferCoordinators returned are all properly owned by reg_user
         owner_list = []
@@ -1040,6 +1107,20 @@ class TransferCoordinatorUserListCase(TestCase):
         self.assertTrue(len(owner_list) == 1)
         self.assertTrue(owner_list[0] == u)
 
+    def test_user_tc_lookup_is_one_query(self):
+        '''
+        The batches of a user are found with a single query, and a batch with 
+        several of the user's Transfers is listed once
+        '''
+        u = get_user_model().objects.get(email='reguser@gmail.com')
+        expected = set(Transfer.objects.user_transfers(u).values_list('coordinator', flat=True))
+        t = Transfer.objects.user_transfers(u)[0]
+        for i in range(3):
+            Transfer.objects.create(download=True, resource=t.resource, destination='dropbox', coordinator=t.coordinator, originator=u)
+        with self.assertNumQueries(1):
+            pks = [x.pk for x in TransferCoordinator.objects.user_transfer_coordinators(u)]
+        self.assertEqual(sorted(pks), sorted(expected))
+
 
 '''
 Tests for completion marking:
@@ -1051,6 +1132,12 @@ Tests for completion marking:
 class CompletionMarkingTestCase(TestCase):
 
     def setUp(self):
+        # the events published along the way go to a stand-in for redis:
+        self.redis_mock = mock.MagicMock()
+        patcher = mock.patch('transfer_app.events.get_redis', return_value=self.redis_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
         self.regular_user = get_user_model().objects.create_user(email='reguser@gmail.com', password='abcd123!')
 
         # create a couple of resources owned by the regular user:
@@ -1084,6 +1171,14 @@ class CompletionMarkingTestCase(TestCase):
             originator = self.regular_user
         )
 
+    def published(self):
+        '''
+        Returns the (event, data) of the messages published, in order
+        '''
+        pipe = self.redis_mock.pipeline.return_value
+        messages = [json.loads(x[0][1]) for x in pipe.publish.call_args_list]
+        return [(x['event'], x['data']) for x in messages]
+
     def test_single_worker_completion_signal(self):
         '''
         This tests where one of many workers has completed.  Not ALL 
@@ -1115,6 +1210,13 @@ class CompletionMarkingTestCase(TestCase):
         tc = TransferCoordinator.objects.get(pk=1)
         self.assertEqual(tc.completed, False)
 
+        # the browser is told of the completed Transfer, and of the batch's progress:
+        (transfer_event, transfer_data), (batch_event, batch_data) = self.published()
+        self.assertEqual((transfer_event, transfer_data['id']), ('transfer', 1))
+        self.assertTrue(transfer_data['completed'])
+        self.assertEqual((batch_event, batch_data['completed_transfers']), ('batch', 1))
+        self.assertFalse(batch_data['completed'])
+
     def test_full_completion_signal(self):
         '''
         This tests where both of two workers have completed.  ALL 
@@ -1157,6 +1259,35 @@ class CompletionMarkingTestCase(TestCase):
         tc = TransferCoordinator.objects.get(pk=1)
         self.assertTrue(tc.completed)
 
+        # the last update of the batch shows it complete:
+        batch_data = [data for event, data in self.published() if event == 'batch']
+        self.assertEqual(len(batch_data), 2)
+        self.assertEqual(batch_data[-1]['completed_transfers'], 2)
+        self.assertTrue(batch_data[-1]['completed'])
+
+    @mock.patch('transfer_app.utils.post_completion')
+    def test_completion_counts(self, mock_post_completion):
+        '''
+        The coordinator counts its completed Transfers, and notifies the
+        originators once when the last one completes, even if a worker reports twice
+        '''
+        tc = TransferCoordinator.objects.get(pk=1)
+        self.assertEqual((tc.total_transfers, tc.total_bytes), (2, 1000))
+
+        utils.mark_transfer_complete(Transfer.objects.get(pk=1), True)
+        utils.mark_transfer_complete(Transfer.objects.get(pk=1), True)
+        tc = TransferCoordinator.objects.get(pk=1)
+        self.assertEqual((tc.completed_transfers, tc.succeeded_transfers, tc.completed_bytes), (1, 1, 500))
+        self.assertFalse(tc.completed)
+        mock_post_completion.assert_not_called()
+
+        utils.mark_transfer_complete(Transfer.objects.get(pk=2), False)
+        utils.mark_transfer_complete(Transfer.objects.get(pk=2), False)
+        tc = TransferCoordinator.objects.get(pk=1)
+        self.assertEqual((tc.completed_transfers, tc.succeeded_transfers, tc.completed_bytes), (2, 1, 1000))
+        self.assertTrue(tc.completed)
+        mock_post_completion.assert_called_once_with(tc, ['reguser@gmail.com'])
+
     def test_completion_signal_with_wrong_token_is_rejected(self):
         '''
         This tests where a bad token is sent.  Should reject with 404
@@ -1240,3 +1371,1091 @@ class CompletionMarkingTestCase(TestCase):
 
 
 
+
+
+class TransferGroupingTestCase(TestCase):
+    '''
+    Tests the decision of which transfers share a worker VM
+    '''
+
+    def test_one_per_group_by_default(self):
+        items = [{'size_in_bytes': 10}, {'size_in_bytes': 20}, {'size_in_bytes': 30}]
+        groups = group_transfers(items, 1, 1000)
+        self.assertEqual(groups, [[x] for x in items])
+
+    def test_groups_limited_by_count(self):
+        items = [{'size_in_bytes': 1} for i in range(5)]
+        groups = group_transfers(items, 2, 1000)
+        self.assertEqual([len(x) for x in groups], [2, 2, 1])
+
+    def test_groups_limited_by_size(self):
+        items = [{'size_in_bytes': 40}, {'size_in_bytes': 50}, {'size_in_bytes': 500}, {'size_in_bytes': 10}]
+        groups = group_transfers(items, 10, 100)
+        self.assertEqual(groups, [items[:2], [items[2]], [items[3]]])
+
+
+class SizingPolicyTestCase(TestCase):
+    '''
+    Tests the choice of VM shape for a set of transfers
+    '''
+
+    def setUp(self):
+        self.config = {
+            'sizing_tiers': '''
+                10 g1-small pd-standard
+                100 n1-standard-2 pd-standard
+                * n1-standard-8 pd-ssd''',
+            'batch_concurrency': '2',
+            'disk_size_factor': '2',
+            'min_disk_size': '10'
+        }
+
+    def test_small_transfer_gets_smallest_tier(self):
+        shape = TieredSizingPolicy(self.config).choose([{'size_in_bytes': 1e9}], True, settings.DROPBOX)
+        self.assertEqual(shape, {'machine_type': 'g1-small', 'disk_type': 'pd-standard', 'disk_size_gb': 10})
+
+    def test_large_transfer_gets_largest_tier(self):
+        shape = TieredSizingPolicy(self.config).choose([{'size_in_bytes': 500e9}], True, settings.DROPBOX)
+        self.assertEqual(shape, {'machine_type': 'n1-standard-8', 'disk_type': 'pd-ssd', 'disk_size_gb': 1000})
+
+    def test_tier_uses_data_in_progress(self):
+        # only two of the three files are in progress at once:
+        items = [{'size_in_bytes': 40e9}, {'size_in_bytes': 30e9}, {'size_in_bytes': 70e9}]
+        shape = TieredSizingPolicy(self.config).choose(items, False, settings.GOOGLE_DRIVE)
+        self.assertEqual(shape['machine_type'], 'n1-standard-8')
+        self.assertEqual(shape['disk_size_gb'], 220)
+
+        items = [{'size_in_bytes': 40e9}, {'size_in_bytes': 30e9}, {'size_in_bytes': 20e9}]
+        shape = TieredSizingPolicy(self.config).choose(items, False, settings.GOOGLE_DRIVE)
+        self.assertEqual(shape['machine_type'], 'n1-standard-2')
+
+    def test_streaming_uses_minimum_disk(self):
+        self.config['stream_transfers'] = 'True'
+        shape = TieredSizingPolicy(self.config).choose([{'size_in_bytes': 500e9}], True, settings.DROPBOX)
+        self.assertEqual(shape['machine_type'], 'n1-standard-8')
+        self.assertEqual(shape['disk_size_gb'], 10)
+
+
+class RoutingTestCase(TestCase):
+    '''
+    Tests the routing of celery tasks to the fast, launch and maintenance queues
+    '''
+
+    @mock.patch.dict(settings.CONFIG_PARAMS, {'fast_queue_max_items': '1', 'fast_queue_max_size_mb': '1024'})
+    def test_small_transfer_takes_fast_queue(self):
+        route = routing.route_task('upload', ([{'size_in_bytes': 5e6}], settings.DROPBOX), {}, {})
+        self.assertEqual(route, {'queue': routing.FAST, 'priority': routing.INTERACTIVE})
+        route = routing.route_task('download', ([{'size_in_bytes': 5e6}], settings.GOOGLE_DRIVE), {}, {})
+        self.assertEqual(route['queue'], routing.FAST)
+        # the batch may be passed by name:
+        route = routing.route_task('download', (), {'download_destination': settings.GOOGLE_DRIVE, 
+            'download_info': [{'size_in_bytes': 5e6}]}, {})
+        self.assertEqual(route['queue'], routing.FAST)
+
+    @mock.patch.dict(settings.CONFIG_PARAMS, {'fast_queue_max_items': '1', 'fast_queue_max_size_mb': '1024', 'large_batch_min_items': '10'})
+    def test_other_transfers_take_launch_queue(self):
+        # too large, of unknown size, or too many:
+        for items in ([{'size_in_bytes': 5e9}], [{'size_in_bytes': 0}], [{}], [{'size_in_bytes': 5e6}, {'size_in_bytes': 5e6}]):
+            route = routing.route_task('upload', (items, settings.DROPBOX), {}, {})
+            self.assertEqual(route, {'queue': routing.LAUNCH, 'priority': routing.INTERACTIVE})
+        # a large batch waits behind the smaller ones:
+        route = routing.route_task('upload', ([{'size_in_bytes': 5e6}]*10, settings.DROPBOX), {}, {})
+        self.assertEqual(route, {'queue': routing.LAUNCH, 'priority': routing.BULK})
+
+    def test_launch_queue_priorities(self):
+        '''
+        Starting VMs that are already admitted or queued goes ahead of new batches,
+        and large batches (and their fanned-out launches) go last
+        '''
+        release = routing.route_task('release_launches', (), {}, {})['priority']
+        check = routing.route_task('check_launch', ('project', 'zone', 'operation'), {}, {})['priority']
+        launch = routing.route_task('launch_vm', ({}, 'gcloud'), {}, {})['priority']
+        self.assertTrue(release == check < routing.INTERACTIVE < launch)
+
+    def test_other_tasks(self):
+        self.assertEqual(routing.route_task('launch_vm', ({}, 'gcloud'), {}, {})['queue'], routing.LAUNCH)
+        self.assertEqual(routing.route_task('release_launches', (), {}, {})['queue'], routing.LAUNCH)
+        self.assertEqual(routing.route_task('reap', (), {}, {})['queue'], routing.MAINTENANCE)
+        self.assertEqual(routing.route_task('finish_launches', ([],), {}, {})['queue'], routing.MAINTENANCE)
+        # unknown tasks are left to the default queue:
+        self.assertIsNone(routing.route_task('some_other_task', (), {}, {}))
+
+
+class SubmissionTestCase(TestCase):
+    '''
+    Tests that repeated submissions of the same batch are only enqueued once
+    '''
+
+    def setUp(self):
+        # stands in for redis, keeping the keys in a dict (ignoring expiry):
+        self.store = {}
+        def set_key(key, value, nx=False, ex=None):
+            if nx and key in self.store:
+                return None
+            self.store[key] = value.encode('utf-8')
+            return True
+        self.client = mock.MagicMock()
+        self.client.set.side_effect = set_key
+        self.client.get.side_effect = lambda key: self.store.get(key)
+        def release_key(script, numkeys, key, value):
+            if self.store.get(key) == value.encode('utf-8'):
+                del self.store[key]
+                return 1
+            return 0
+        self.client.eval.side_effect = release_key
+        patcher = mock.patch('transfer_app.submissions.get_redis', return_value=self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.items = [{'path': 'a.txt', 'size_in_bytes': 100, 'owner': 1}, {'path': 'b.txt', 'size_in_bytes': 200, 'owner': 1}]
+
+    def test_repeat_returns_existing_batch(self):
+        task = mock.MagicMock()
+        batch_id, submitted = submissions.submit_once(task, self.items, settings.DROPBOX, 1)
+        self.assertTrue(submitted)
+        task.delay.assert_called_once_with(self.items, settings.DROPBOX, batch_id)
+
+        # the same files in another order, with a new token:
+        repeat_items = [dict(x, access_token='abc') for x in reversed(self.items)]
+        repeat_id, submitted = submissions.submit_once(task, repeat_items, settings.DROPBOX, 1)
+        self.assertFalse(submitted)
+        self.assertEqual(repeat_id, batch_id)
+        self.assertEqual(task.delay.call_count, 1)
+        self.client.set.assert_any_call(mock.ANY, batch_id, nx=True, ex=60)
+
+    def test_different_batches_are_submitted(self):
+        task = mock.MagicMock()
+        submissions.submit_once(task, self.items, settings.DROPBOX, 1)
+        submissions.submit_once(task, self.items[:1], settings.DROPBOX, 1)
+        submissions.submit_once(task, self.items, settings.GOOGLE_DRIVE, 1)
+        submissions.submit_once(task, self.items, settings.DROPBOX, 2)
+        self.assertEqual(task.delay.call_count, 4)
+
+    @mock.patch.dict(settings.CONFIG_PARAMS, {'submission_dedup_seconds': '0'})
+    def test_check_can_be_turned_off(self):
+        task = mock.MagicMock()
+        submissions.submit_once(task, self.items, settings.DROPBOX, 1)
+        submissions.submit_once(task, self.items, settings.DROPBOX, 1)
+        self.assertEqual(task.delay.call_count, 2)
+        self.client.set.assert_not_called()
+
+    def test_submits_if_redis_is_unavailable(self):
+        self.client.set.side_effect = submissions.redis.ConnectionError('no redis')
+        task = mock.MagicMock()
+        batch_id, submitted = submissions.submit_once(task, self.items, settings.DROPBOX, 1)
+        self.assertTrue(submitted)
+        task.delay.assert_called_once_with(self.items, settings.DROPBOX, batch_id)
+
+    def test_failed_enqueue_releases_the_key(self):
+        task = mock.MagicMock()
+        task.delay.side_effect = submissions.redis.ConnectionError('broker down')
+        with self.assertRaises(submissions.redis.ConnectionError):
+            submissions.submit_once(task, self.items, settings.DROPBOX, 1)
+        self.assertEqual(self.store, {})
+
+        # so the retry is submitted, rather than taken for a repeat:
+        task.delay.side_effect = None
+        batch_id, submitted = submissions.submit_once(task, self.items, settings.DROPBOX, 1)
+        self.assertTrue(submitted)
+
+    def test_release_leaves_a_newer_batch_alone(self):
+        key = submissions.submission_key(1, self.items, settings.DROPBOX)
+        self.store[key] = b'newer'
+        submissions.release(self.client, key, 'older')
+        self.assertEqual(self.store[key], b'newer')
+
+
+class TransferEventsTestCase(TestCase):
+    '''
+    Tests the publishing of changes to Transfers, and the stream of them sent to the browser
+    '''
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email='reguser@gmail.com', password='abcd123!')
+        r = Resource.objects.create(source='google_storage', path='gs://a/b/f.txt', name='f.txt', size=500, owner=self.user)
+        tc = TransferCoordinator.objects.create()
+        self.transfer = Transfer.objects.create(download=True, resource=r, destination='dropbox', 
+            coordinator=tc, originator=self.user)
+        self.client_mock = mock.MagicMock()
+        patcher = mock.patch('transfer_app.events.get_redis', return_value=self.client_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def published(self):
+        pipe = self.client_mock.pipeline.return_value
+        return [(x[0][0], json.loads(x[0][1])) for x in pipe.publish.call_args_list]
+
+    def test_completion_is_published(self):
+        utils.mark_transfer_complete(self.transfer, True)
+        messages = self.published()
+        channel = events.user_channel(self.user.pk)
+        self.assertEqual([x[0] for x in messages], [channel, channel])
+        transfer_message, batch_message = [x[1] for x in messages]
+        self.assertEqual(transfer_message['event'], 'transfer')
+        self.assertEqual(transfer_message['data']['id'], self.transfer.pk)
+        self.assertTrue(transfer_message['data']['completed'])
+        self.assertEqual(transfer_message['data']['resource']['name'], 'f.txt')
+        self.assertEqual(batch_message['event'], 'batch')
+        self.assertEqual(batch_message['data']['completed_transfers'], 1)
+        self.assertTrue(batch_message['data']['completed'])
+
+    def test_publishing_without_redis(self):
+        self.client_mock.pipeline.return_value.execute.side_effect = events.redis.ConnectionError('no redis')
+        utils.mark_transfer_complete(self.transfer, True)
+        self.assertTrue(Transfer.objects.get(pk=self.transfer.pk).completed)
+
+    @mock.patch('transfer_app.events.event_id', return_value='ID')
+    def test_stream(self, mock_event_id):
+        pubsub = self.client_mock.pubsub.return_value
+        message = json.dumps({'event': 'transfer', 'data': {'id': 1}})
+        pubsub.get_message.side_effect = [{'type': 'message', 'data': message.encode('utf-8')}, None]
+        stream = events.stream(self.user.pk, 15, 300)
+        self.assertEqual(next(stream), 'retry: %d\nid: ID\n\n' % events.RECONNECT_MS)
+        self.assertEqual(next(stream), 'id: ID\nevent: transfer\ndata: {"id": 1}\n\n')
+        self.assertEqual(next(stream), 'id: ID\n: keepalive\n\n')
+        pubsub.subscribe.assert_called_once_with(events.user_channel(self.user.pk))
+        stream.close()
+        self.assertTrue(pubsub.close.called)
+
+    def test_reconnect_replays_missed_changes(self):
+        '''
+        A reconnecting stream starts with the Transfers changed since the last event the
+        browser got, or with a reset if there are too many
+        '''
+        self.client_mock.pubsub.return_value.get_message.return_value = None
+        last_event_id = events.event_id()
+        utils.mark_transfer_complete(self.transfer, True)
+        stream = list(events.stream(self.user.pk, 0, 0, last_event_id))
+        self.assertEqual(len(stream), 2)
+        self.assertTrue(stream[1].startswith('event: transfer\n'))
+        data = json.loads(stream[1].split('data: ')[1])
+        self.assertEqual(data['id'], self.transfer.pk)
+        self.assertTrue(data['completed'])
+
+        # nothing to replay for a first connection, or a bad id:
+        self.assertEqual(events.replay(self.user.pk, None), [])
+        self.assertEqual(events.replay(self.user.pk, 'abc'), [])
+        with mock.patch.object(events, 'MAX_REPLAY', 0):
+            self.assertEqual(events.replay(self.user.pk, last_event_id), ['event: reset\ndata: {}\n\n'])
+
+    def test_stream_ends(self):
+        self.client_mock.pubsub.return_value.get_message.return_value = None
+        self.assertEqual(len(list(events.stream(self.user.pk, 0, 0))), 1)
+
+    @mock.patch('transfer_app.views.events.stream')
+    def test_event_view(self, mock_stream):
+        mock_stream.return_value = iter(['retry: 3000\n\n'])
+        client = APIClient()
+        response = client.get(reverse('transfer-events'))
+        self.assertEqual(response.status_code, 403)
+
+        client.login(email='reguser@gmail.com', password='abcd123!')
+        response = client.get(reverse('transfer-events'), HTTP_ACCEPT='text/event-stream')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(b''.join(response.streaming_content), b'retry: 3000\n\n')
+        self.assertEqual(mock_stream.call_args[0][0], self.user.pk)
+        self.assertIsNone(mock_stream.call_args[0][3])
+
+        client.get(reverse('transfer-events'), HTTP_ACCEPT='text/event-stream', HTTP_LAST_EVENT_ID='abc')
+        self.assertEqual(mock_stream.call_args[0][3], 'abc')
+
+
+@mock.patch.dict(settings.CONFIG_PARAMS, {'sync_settle_seconds': '0', 'tombstone_retention_days': '30'})
+class SyncTestCase(TestCase):
+    '''
+    Tests the endpoints giving the changes to Resources and Transfers since a client's last sync
+    '''
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email='reguser@gmail.com', password='abcd123!')
+        self.other_user = get_user_model().objects.create_user(email='otheruser@gmail.com', password='abcd123!')
+        self.tc = TransferCoordinator.objects.create()
+        self.transfers = []
+        for i, user in enumerate([self.user, self.user, self.other_user]):
+            r = Resource.objects.create(source='google_storage', path='gs://a/b/f%d.txt' % i, name='f%d.txt' % i, size=500, owner=user)
+            self.transfers.append(Transfer.objects.create(download=True, resource=r, destination='dropbox', 
+                coordinator=self.tc, originator=user))
+        self.client = APIClient()
+        self.client.login(email='reguser@gmail.com', password='abcd123!')
+
+    def sync(self, url_name, cursor=None, page_size=None):
+        params = {}
+        if cursor is not None:
+            params['cursor'] = cursor
+        if page_size is not None:
+            params['page_size'] = page_size
+        response = self.client.get(reverse(url_name), params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_changes_since_cursor(self):
+        data = self.sync('transfer-sync')
+        self.assertEqual(sorted([x['id'] for x in data['results']]), [self.transfers[0].pk, self.transfers[1].pk])
+        self.assertEqual(data['deleted'], [])
+        self.assertFalse(data['more'])
+
+        # nothing has changed:
+        data = self.sync('transfer-sync', data['cursor'])
+        self.assertEqual(data['results'], [])
+
+        # a bulk update counts as a change, as does a new Transfer.  The other user's do not show up
+        Transfer.objects.filter(pk=self.transfers[1].pk).update(completed=True)
+        Transfer.objects.filter(pk=self.transfers[2].pk).update(completed=True)
+        t = Transfer.objects.create(download=True, resource=self.transfers[0].resource, destination='dropbox', 
+            coordinator=self.tc, originator=self.user)
+        data = self.sync('transfer-sync', data['cursor'])
+        self.assertEqual([x['id'] for x in data['results']], [self.transfers[1].pk, t.pk])
+        self.assertTrue(data['results'][0]['completed'])
+
+    def test_recent_changes_wait(self):
+        with mock.patch.dict(settings.CONFIG_PARAMS, {'sync_settle_seconds': '60'}):
+            data = self.sync('resource-sync')
+        self.assertEqual(data['results'], [])
+        data = self.sync('resource-sync', data['cursor'])
+        self.assertEqual(len(data['results']), 2)
+
+    def test_deletions(self):
+        resource_cursor = self.sync('resource-sync')['cursor']
+        transfer_cursor = self.sync('transfer-sync')['cursor']
+
+        # removing a Resource removes its Transfer as well:
+        self.transfers[0].resource.delete()
+        self.transfers[2].resource.delete()
+        data = self.sync('resource-sync', resource_cursor)
+        self.assertEqual(data['results'], [])
+        self.assertEqual(data['deleted'], [self.transfers[0].resource_id])
+        data = self.sync('transfer-sync', transfer_cursor)
+        self.assertEqual(data['deleted'], [self.transfers[0].pk])
+
+        # a first sync has no use for earlier deletions:
+        self.assertEqual(self.sync('transfer-sync')['deleted'], [])
+
+    def test_pages(self):
+        seen = []
+        data = {'cursor': None, 'more': True}
+        while data['more']:
+            data = self.sync('resource-sync', data['cursor'], page_size=1)
+            self.assertTrue(len(data['results']) <= 1)
+            seen.extend([x['id'] for x in data['results']])
+        self.assertEqual(seen, [self.transfers[0].resource_id, self.transfers[1].resource_id])
+
+    def test_bad_cursors(self):
+        response = self.client.get(reverse('transfer-sync'), {'cursor': 'abc'})
+        self.assertEqual(response.status_code, 400)
+
+        now = timezone.now()
+        old = now - datetime.timedelta(days=31)
+        cursor = sync.encode_cursor({'changed': (old, 0), 'deleted': (old, 0)})
+        response = self.client.get(reverse('transfer-sync'), {'cursor': cursor})
+        self.assertEqual(response.status_code, 410)
+
+    def test_prune_tombstones(self):
+        pks = [x.pk for x in self.transfers[:2]]
+        Transfer.objects.filter(pk__in=pks).delete()
+        Tombstone.objects.filter(object_id=pks[0]).update(deleted_at=timezone.now() - datetime.timedelta(days=31))
+        self.assertEqual(sync.prune_tombstones(timezone.now()), 1)
+        self.assertEqual(list(Tombstone.objects.values_list('object_id', flat=True)), [pks[1]])
+
+
+class SchedulerTestCase(TestCase):
+    '''
+    Tests the caps on the number of VMs running at once
+    '''
+
+    def setUp(self):
+        # the events published along the way go to a stand-in for redis:
+        self.redis_mock = mock.MagicMock()
+        patcher = mock.patch('transfer_app.events.get_redis', return_value=self.redis_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.regular_user = get_user_model().objects.create_user(email='reguser@gmail.com', password='abcd123!')
+        r1 = Resource.objects.create(
+            source='google_storage',
+            path='gs://a/b/reg_owned1.txt',
+            size=500,
+            owner=self.regular_user,
+        )
+        tc1 = TransferCoordinator.objects.create()
+        self.transfers = []
+        for i in range(3):
+            self.transfers.append(Transfer.objects.create(download=True, resource=r1, destination='dropbox', 
+                coordinator=tc1, originator=self.regular_user))
+
+    def spec(self, instance_names, transfers, zone='us-east1-b'):
+        return {
+            'instance_names': instance_names,
+            'zone': zone,
+            'transfer_pks': [x.pk for x in transfers],
+            'container_args': ['-pk', transfers[0].pk] if len(transfers) > 0 else []
+        }
+
+    @mock.patch.dict(settings.CONFIG_PARAMS, {'max_concurrent_vms': '2', 'max_vms_per_zone': '0'})
+    def test_launches_over_global_cap_are_queued(self):
+        admitted = scheduler.admit(self.spec(['vm-0',], self.transfers[:1]), 'gcloud')
+        self.assertEqual(admitted['instance_names'], ['vm-0',])
+
+        # a pool spec with several VMs is partly admitted:
+        admitted = scheduler.admit(self.spec(['pool-0', 'pool-1'], []), 'api')
+        self.assertEqual(admitted['instance_names'], ['pool-0',])
+        admitted = scheduler.admit(self.spec(['vm-1',], self.transfers[1:2]), 'gcloud')
+        self.assertIsNone(admitted)
+
+        queued = LaunchAttempt.objects.filter(status=LaunchAttempt.QUEUED).order_by('pk')
+        self.assertEqual([x.instance_name for x in queued], ['pool-1', 'vm-1'])
+        self.assertEqual(json.loads(queued[0].spec)['instance_names'], ['pool-1',])
+        self.assertEqual(queued[0].launcher, 'api')
+
+    @mock.patch.dict(settings.CONFIG_PARAMS, {'max_concurrent_vms': '2', 'max_vms_per_zone': '0'})
+    def test_admitted_launch_is_never_queued(self):
+        '''
+        A VM admitted straight away is not QUEUED at any point, so that a concurrent
+        claim_queued cannot start it a second time
+        '''
+        statuses = {}
+        create = LaunchAttempt.objects.create
+        def record_status(**kwargs):
+            statuses[kwargs['instance_name']] = kwargs['status']
+            return create(**kwargs)
+        with mock.patch.object(LaunchAttempt.objects, 'create', side_effect=record_status):
+            scheduler.admit(self.spec(['vm-0', 'vm-1', 'vm-2'], self.transfers), 'gcloud')
+        self.assertEqual(statuses, {'vm-0': LaunchAttempt.PENDING, 'vm-1': LaunchAttempt.PENDING, 'vm-2': LaunchAttempt.QUEUED})
+        self.assertEqual(scheduler.claim_queued(), [])
+
+    @mock.patch.dict(settings.CONFIG_PARAMS, {'max_concurrent_vms': '0', 'max_vms_per_zone': '1'})
+    def test_zone_cap_only_counts_that_zone(self):
+        self.assertIsNotNone(scheduler.admit(self.spec(['vm-0',], self.transfers[:1]), 'gcloud'))
+        self.assertIsNone(scheduler.admit(self.spec(['vm-1',], self.transfers[1:2]), 'gcloud'))
+        self.assertIsNotNone(scheduler.admit(self.spec(['vm-2',], self.transfers[2:], zone='us-west1-a'), 'gcloud'))
+
+    @mock.patch.dict(settings.CONFIG_PARAMS, {'max_concurrent_vms': '1', 'max_vms_per_zone': '0'})
+    def test_completion_releases_queued_launch(self):
+        scheduler.admit(self.spec(['vm-0',], self.transfers[:1]), 'gcloud')
+        scheduler.admit(self.spec(['vm-1',], self.transfers[1:2]), 'gcloud')
+        scheduler.admit(self.spec(['vm-2',], self.transfers[2:]), 'gcloud')
+
+        with mock.patch.object(transfer_tasks.release_launches, 'delay') as mock_delay:
+            utils.mark_transfer_complete(self.transfers[0], True)
+            self.assertTrue(mock_delay.called)
+        self.assertEqual(LaunchAttempt.objects.get(instance_name='vm-0').status, LaunchAttempt.FINISHED)
+
+        # the oldest queued launch goes next, and there is only room for one:
+        mock_launcher = mock.MagicMock()
+        with mock.patch.dict(transfer_tasks.GoogleBase.launcher_classes, {'gcloud': mock_launcher}):
+            transfer_tasks.release_launches()
+        launcher = mock_launcher.return_value
+        self.assertEqual(launcher.go.call_count, 1)
+        self.assertEqual(launcher.go.call_args[0][0]['instance_names'], ['vm-1',])
+        self.assertTrue(launcher.wait.called)
+        self.assertEqual(LaunchAttempt.objects.get(instance_name='vm-1').status, LaunchAttempt.PENDING)
+        self.assertEqual(LaunchAttempt.objects.get(instance_name='vm-2').status, LaunchAttempt.QUEUED)
+
+    @mock.patch.dict(settings.CONFIG_PARAMS, {'max_concurrent_vms': '0', 'max_vms_per_zone': '0'})
+    def test_outcome_is_recorded_on_its_own_attempt(self):
+        '''
+        The outcome of a launch goes to the LaunchAttempts the scheduler created for it,
+        even if another batch used the same VM name
+        '''
+        first = scheduler.admit(self.spec(['vm-0',], self.transfers[:1]), 'gcloud')
+        second = scheduler.admit(self.spec(['vm-0',], self.transfers[1:2]), 'gcloud')
+        record_launch(second, LaunchAttempt.DONE)
+        self.assertEqual(LaunchAttempt.objects.get(pk=first['attempt_pks']['vm-0']).status, LaunchAttempt.PENDING)
+        attempt = LaunchAttempt.objects.get(pk=second['attempt_pks']['vm-0'])
+        self.assertEqual(attempt.status, LaunchAttempt.DONE)
+        self.assertEqual(list(attempt.transfers.all()), [self.transfers[1],])
+
+    @mock.patch.dict(settings.CONFIG_PARAMS, {'max_concurrent_vms': '1', 'max_vms_per_zone': '0'})
+    def test_failed_release_does_not_stop_the_others(self):
+        admitted = scheduler.admit(self.spec(['vm-0',], self.transfers[:1]), 'gcloud')
+        scheduler.admit(self.spec(['vm-1',], self.transfers[1:2]), 'gcloud')
+        scheduler.admit(self.spec(['vm-2',], self.transfers[2:]), 'gcloud')
+        # room for both queued VMs:
+        record_launch(admitted, LaunchAttempt.DONE)
+        LaunchAttempt.objects.filter(instance_name='vm-0').update(status=LaunchAttempt.FINISHED)
+
+        mock_launcher = mock.MagicMock()
+        mock_launcher.return_value.go.side_effect = [Exception('Invalid value for field machineType'), None]
+        with mock.patch.dict(settings.CONFIG_PARAMS, {'max_concurrent_vms': '2'}), \
+                mock.patch.dict(transfer_tasks.GoogleBase.launcher_classes, {'gcloud': mock_launcher}), \
+                mock.patch.object(transfer_tasks.release_launches, 'delay'):
+            transfer_tasks.release_launches()
+        launcher = mock_launcher.return_value
+        self.assertEqual(launcher.go.call_count, 2)
+        self.assertTrue(launcher.wait.called)
+        failed = LaunchAttempt.objects.get(instance_name='vm-1')
+        self.assertEqual(failed.status, LaunchAttempt.FAILED)
+        self.assertEqual(failed.error, 'Invalid value for field machineType')
+        self.assertEqual(LaunchAttempt.objects.get(instance_name='vm-2').status, LaunchAttempt.PENDING)
+
+    def test_instance_names_are_unique(self):
+        base = GoogleBase()
+        names = set([base._instance_name({'instance_name_prefix': 'dropbox-upload'}, 0) for i in range(10)])
+        self.assertEqual(len(names), 10)
+
+    @mock.patch.dict(settings.CONFIG_PARAMS, {'max_concurrent_vms': '1', 'max_vms_per_zone': '0'})
+    def test_failed_launch_releases_queued_launch(self):
+        admitted = scheduler.admit(self.spec(['vm-0',], self.transfers[:1]), 'gcloud')
+        scheduler.admit(self.spec(['vm-1',], self.transfers[1:2]), 'gcloud')
+        with mock.patch.object(transfer_tasks.release_launches, 'delay') as mock_delay:
+            record_launch(admitted, LaunchAttempt.FAILED, error='Invalid value for field machineType')
+            self.assertTrue(mock_delay.called)
+        self.assertEqual(scheduler.free_slots('us-east1-b'), 1)
+        self.assertTrue(Transfer.objects.get(pk=self.transfers[0].pk).completed)
+
+
+class LaunchRetryTestCase(TestCase):
+    '''
+    Tests the retries of failed launches
+    '''
+
+    def setUp(self):
+        # the events published along the way go to a stand-in for redis:
+        self.redis_mock = mock.MagicMock()
+        patcher = mock.patch('transfer_app.events.get_redis', return_value=self.redis_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.regular_user = get_user_model().objects.create_user(email='reguser@gmail.com', password='abcd123!')
+        r1 = Resource.objects.create(
+            source='google_storage',
+            path='gs://a/b/reg_owned1.txt',
+            size=500,
+            owner=self.regular_user,
+        )
+        tc1 = TransferCoordinator.objects.create()
+        self.transfer = Transfer.objects.create(download=True, resource=r1, destination='dropbox', 
+            coordinator=tc1, originator=self.regular_user)
+        self.spec = {
+            'instance_names': ['vm-0',],
+            'zone': 'us-east1-b',
+            'transfer_pks': [self.transfer.pk,],
+            'container_args': ['-proj', 'my-project', '-zone', 'us-east1-b', '-pk', self.transfer.pk]
+        }
+        self.config = {'fallback_zones': 'us-east1-b, us-central1-a', 'max_launch_retries': '2', 
+            'launch_retry_base_seconds': '30', 'launch_retry_max_seconds': '600'}
+
+    def test_classify_errors(self):
+        self.assertEqual(launchers.classify_error("Quota 'CPUS' exceeded.  Limit: 24.0 in region us-east1."), launchers.QUOTA)
+        self.assertEqual(launchers.classify_error('ZONE_RESOURCE_POOL_EXHAUSTED'), launchers.STOCKOUT)
+        self.assertEqual(launchers.classify_error('Request failed with status 503: backend unavailable'), launchers.TRANSIENT)
+        self.assertEqual(launchers.classify_error("Invalid value for field 'resource.machineType'"), launchers.PERMANENT)
+
+    def test_stockout_moves_to_fallback_zone(self):
+        with mock.patch.dict(settings.CONFIG_PARAMS, self.config):
+            admitted = scheduler.admit(self.spec, 'api')
+            with mock.patch.object(transfer_tasks.release_launches, 'apply_async') as mock_apply:
+                record_launch(admitted, LaunchAttempt.FAILED, error='ZONE_RESOURCE_POOL_EXHAUSTED')
+                self.assertEqual(mock_apply.call_args_list[0][1]['countdown'], 0)
+
+        failed = LaunchAttempt.objects.get(instance_name='vm-0')
+        self.assertEqual(failed.status, LaunchAttempt.FAILED)
+        self.assertEqual(failed.error_kind, launchers.STOCKOUT)
+        retry = LaunchAttempt.objects.get(instance_name='vm-0-r1')
+        self.assertEqual(retry.status, LaunchAttempt.QUEUED)
+        self.assertEqual(retry.zone, 'us-central1-a')
+        self.assertEqual(retry.attempt_number, 1)
+        self.assertEqual(retry.launcher, 'api')
+        retry_spec = json.loads(retry.spec)
+        self.assertEqual(retry_spec['container_args'][3], 'us-central1-a')
+        self.assertEqual(list(retry.transfers.all()), [self.transfer,])
+        self.assertFalse(Transfer.objects.get(pk=self.transfer.pk).completed)
+
+    def test_transient_failure_retries_later_in_same_zone(self):
+        with mock.patch.dict(settings.CONFIG_PARAMS, self.config):
+            admitted = scheduler.admit(self.spec, 'gcloud')
+            with mock.patch.object(transfer_tasks.release_launches, 'apply_async') as mock_apply:
+                record_launch(admitted, LaunchAttempt.FAILED, error='Request failed with status 503')
+                delay = mock_apply.call_args_list[0][1]['countdown']
+        self.assertTrue(15 <= delay <= 30)
+        retry = LaunchAttempt.objects.get(instance_name='vm-0-r1')
+        self.assertEqual(retry.zone, 'us-east1-b')
+        self.assertTrue(retry.not_before > timezone.now())
+        # not started before the backoff is over:
+        self.assertEqual(scheduler.claim_queued(), [])
+
+    def test_gives_up_after_max_retries(self):
+        self.spec['attempt_number'] = 2
+        with mock.patch.dict(settings.CONFIG_PARAMS, self.config):
+            admitted = scheduler.admit(self.spec, 'gcloud')
+            with mock.patch.object(transfer_tasks.release_launches, 'apply_async') as mock_apply:
+                record_launch(admitted, LaunchAttempt.FAILED, error='Request failed with status 503')
+                self.assertFalse(mock_apply.called)
+        transfer = Transfer.objects.get(pk=self.transfer.pk)
+        self.assertTrue(transfer.completed)
+        self.assertFalse(transfer.success)
+
+
+class WorkerLeaseTestCase(TestCase):
+    '''
+    Tests the endpoint where warm pool workers ask for transfers
+    '''
+
+    def setUp(self):
+        # the events published along the way go to a stand-in for redis:
+        self.redis_mock = mock.MagicMock()
+        patcher = mock.patch('transfer_app.events.get_redis', return_value=self.redis_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.regular_user = get_user_model().objects.create_user(email='reguser@gmail.com', password='abcd123!')
+        r1 = Resource.objects.create(
+            source='google_storage',
+            path='gs://a/b/reg_owned1.txt',
+            size=500,
+            owner=self.regular_user,
+        )
+        tc1 = TransferCoordinator.objects.create()
+        self.transfer = Transfer.objects.create(
+            download=True,
+            resource = r1,
+            destination = 'dropbox',
+            coordinator = tc1,
+            originator = self.regular_user
+        )
+        WorkerJob.objects.create(transfer=self.transfer, pool='dropbox-download', spec='{"transfer_pk": %d}' % self.transfer.pk)
+
+        token = settings.CONFIG_PARAMS['token']
+        obj=DES.new(settings.CONFIG_PARAMS['enc_key'], DES.MODE_ECB)
+        enc_token = obj.encrypt(token)
+        self.b64_str = base64.encodestring(enc_token)
+
+    def test_worker_leases_job_once(self):
+        client = APIClient()
+        url = reverse('worker-lease')
+        d = {'token': self.b64_str, 'pool': 'dropbox-download', 'worker': 'worker-1'}
+        response = client.post(url, d, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['job'], {'transfer_pk': self.transfer.pk})
+        job = WorkerJob.objects.get(transfer=self.transfer)
+        self.assertEqual(job.leased_by, 'worker-1')
+
+        # a second worker gets nothing, since the job was leased:
+        d['worker'] = 'worker-2'
+        response = client.post(url, d, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.data['job'])
+
+    def test_other_pool_gets_nothing(self):
+        client = APIClient()
+        url = reverse('worker-lease')
+        d = {'token': self.b64_str, 'pool': 'drive-download', 'worker': 'worker-1'}
+        response = client.post(url, d, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.data['job'])
+        self.assertIsNone(WorkerJob.objects.get(transfer=self.transfer).leased_by)
+
+    def test_idle_worker_retires(self):
+        PoolWorker.objects.create(instance_name='worker-1', pool='drive-download', last_seen=timezone.now())
+        client = APIClient()
+        url = reverse('worker-lease')
+        d = {'token': self.b64_str, 'pool': 'drive-download', 'worker': 'worker-1', 'idle': 1}
+        response = client.post(url, d, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['retire'])
+        self.assertEqual(PoolWorker.objects.filter(instance_name='worker-1').count(), 0)
+
+    def test_lease_with_wrong_token_is_rejected(self):
+        obj=DES.new(settings.CONFIG_PARAMS['enc_key'], DES.MODE_ECB)
+        bad_b64_str = base64.encodestring(obj.encrypt('xxxxYYYY'))
+        client = APIClient()
+        url = reverse('worker-lease')
+        d = {'token': bad_b64_str, 'pool': 'dropbox-download', 'worker': 'worker-1'}
+        response = client.post(url, d, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertIsNone(WorkerJob.objects.get(transfer=self.transfer).leased_by)
+
+    def test_completion_removes_job(self):
+        client = APIClient()
+        url = reverse('transfer-complete')
+        d = {'token': self.b64_str, 'transfer_pk': self.transfer.pk, 'success': True}
+        response = client.post(url, d, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(WorkerJob.objects.count(), 0)
+
+
+class WorkerCheckpointTestCase(TestCase):
+    '''
+    Tests the endpoint where workers on Spot VMs send checkpoints, and the
+    move of a preempted transfer to a replacement VM
+    '''
+
+    def setUp(self):
+        # the events published along the way go to a stand-in for redis:
+        self.redis_mock = mock.MagicMock()
+        patcher = mock.patch('transfer_app.events.get_redis', return_value=self.redis_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.regular_user = get_user_model().objects.create_user(email='reguser@gmail.com', password='abcd123!')
+        r1 = Resource.objects.create(
+            source='google_storage',
+            path='gs://a/b/reg_owned1.txt',
+            size=500,
+            owner=self.regular_user,
+        )
+        tc1 = TransferCoordinator.objects.create()
+        self.transfer = Transfer.objects.create(download=True, resource=r1, destination='dropbox', 
+            coordinator=tc1, originator=self.regular_user)
+        self.spec = {
+            'instance_names': ['vm-0',],
+            'zone': 'us-east1-b',
+            'spot': True,
+            'transfer_pks': [self.transfer.pk,],
+            'container_args': ['-zone', 'us-east1-b', '-pk', self.transfer.pk, '-checkpoint_url', 'https://x/']
+        }
+        scheduler.admit(self.spec, 'api')
+        LaunchAttempt.objects.filter(instance_name='vm-0').update(status=LaunchAttempt.DONE)
+
+        token = settings.CONFIG_PARAMS['token']
+        obj=DES.new(settings.CONFIG_PARAMS['enc_key'], DES.MODE_ECB)
+        enc_token = obj.encrypt(token)
+        self.b64_str = base64.encodestring(enc_token)
+
+    def test_checkpoint_is_stored(self):
+        client = APIClient()
+        url = reverse('transfer-checkpoint')
+        state = {'session_id': 'abc', 'offset': 1024}
+        d = {'token': self.b64_str, 'transfer_pk': self.transfer.pk, 'state': json.dumps(state), 'preempted': 0}
+        response = client.post(url, d, format='json')
+        self.assertEqual(response.status_code, 200)
+        checkpoint = TransferCheckpoint.objects.get(transfer=self.transfer)
+        self.assertEqual(json.loads(checkpoint.state), state)
+        self.assertEqual(checkpoint.preemptions, 0)
+        self.assertEqual(LaunchAttempt.objects.count(), 1)
+
+    def test_preempted_transfer_resumes_on_new_vm(self):
+        client = APIClient()
+        url = reverse('transfer-checkpoint')
+        state = {'session_id': 'abc', 'offset': 1024}
+        d = {'token': self.b64_str, 'transfer_pk': self.transfer.pk, 'state': json.dumps(state), 'preempted': 1}
+        with mock.patch.object(transfer_tasks.release_launches, 'apply_async') as mock_apply:
+            response = client.post(url, d, format='json')
+            self.assertEqual(mock_apply.call_count, 1)
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(LaunchAttempt.objects.get(instance_name='vm-0').status, LaunchAttempt.FINISHED)
+        replacement = LaunchAttempt.objects.get(instance_name='vm-0-p1')
+        self.assertEqual(replacement.status, LaunchAttempt.QUEUED)
+        self.assertEqual(replacement.launcher, 'api')
+        spec = json.loads(replacement.spec)
+        self.assertTrue(spec['spot'])
+        args = spec['container_args']
+        resume = args[args.index('-resume') + 1]
+        self.assertEqual(json.loads(base64.b64decode(resume).decode('utf-8')), state)
+        self.assertFalse(Transfer.objects.get(pk=self.transfer.pk).completed)
+
+    def test_transfer_fails_after_max_preemptions(self):
+        TransferCheckpoint.objects.create(transfer=self.transfer, preemptions=2)
+        client = APIClient()
+        url = reverse('transfer-checkpoint')
+        d = {'token': self.b64_str, 'transfer_pk': self.transfer.pk, 'state': 'null', 'preempted': 1}
+        with mock.patch.dict(settings.CONFIG_PARAMS, {'max_preemptions': '2'}):
+            with mock.patch.object(transfer_tasks.release_launches, 'apply_async') as mock_apply:
+                response = client.post(url, d, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(LaunchAttempt.objects.count(), 1)
+        t = Transfer.objects.get(pk=self.transfer.pk)
+        self.assertTrue(t.completed)
+        self.assertFalse(t.success)
+
+    def test_checkpoint_with_wrong_token_is_rejected(self):
+        obj=DES.new(settings.CONFIG_PARAMS['enc_key'], DES.MODE_ECB)
+        bad_b64_str = base64.encodestring(obj.encrypt('xxxxYYYY'))
+        client = APIClient()
+        url = reverse('transfer-checkpoint')
+        d = {'token': bad_b64_str, 'transfer_pk': self.transfer.pk, 'state': '{}', 'preempted': 1}
+        response = client.post(url, d, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(TransferCheckpoint.objects.count(), 0)
+
+
+class ReaperTestCase(TestCase):
+    '''
+    Tests the periodic cleanup of orphaned VMs and stale transfers
+    '''
+
+    def setUp(self):
+        # the events published along the way go to a stand-in for redis:
+        self.redis_mock = mock.MagicMock()
+        patcher = mock.patch('transfer_app.events.get_redis', return_value=self.redis_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.regular_user = get_user_model().objects.create_user(email='reguser@gmail.com', password='abcd123!')
+        self.tc = TransferCoordinator.objects.create()
+
+    def make_transfer(self, size, hours_ago=0, **kwargs):
+        r = Resource.objects.create(source='google_storage', path='gs://a/b/f.txt', size=size, owner=self.regular_user)
+        t = Transfer.objects.create(download=True, resource=r, destination='dropbox', 
+            coordinator=self.tc, originator=self.regular_user)
+        Transfer.objects.filter(pk=t.pk).update(start_time=timezone.now() - datetime.timedelta(hours=hours_ago), **kwargs)
+        return Transfer.objects.get(pk=t.pk)
+
+    def make_attempt(self, instance_name, status, transfer=None, spec=None, admitted=None):
+        attempt = LaunchAttempt.objects.create(instance_name=instance_name, zone='us-east1-b', status=status, 
+            spec=spec, launcher='api', admitted=admitted)
+        if transfer is not None:
+            attempt.transfers.set([transfer,])
+        return attempt
+
+    def test_instance_name_prefixes(self):
+        prefixes = reaper.instance_name_prefixes()
+        self.assertTrue('dropbox-upload' in prefixes)
+        self.assertTrue('drive-upload' in prefixes)
+
+    def test_find_orphans(self):
+        now = timezone.now()
+        old = now - datetime.timedelta(hours=2)
+        self.make_attempt('vm-busy', LaunchAttempt.DONE, self.make_transfer(500))
+        self.make_attempt('vm-done', LaunchAttempt.FINISHED, self.make_transfer(500, completed=True, success=True))
+        self.make_attempt('vm-failed', LaunchAttempt.FINISHED, self.make_transfer(500, completed=True, success=False, finish_time=now))
+        PoolWorker.objects.create(instance_name='vm-pool', pool='dropbox-upload', last_seen=now)
+        instances = [{'name': x, 'zone': 'us-east1-b', 'created': old} for x in 
+            ['vm-busy', 'vm-done', 'vm-failed', 'vm-pool', 'vm-unknown']]
+        instances.append({'name': 'vm-new', 'zone': 'us-east1-b', 'created': now})
+        orphans = reaper.find_orphans(instances, now)
+        self.assertEqual(sorted([x['name'] for x in orphans]), ['vm-done', 'vm-unknown'])
+
+    def test_reap_instances(self):
+        self.make_attempt('vm-done', LaunchAttempt.DONE, self.make_transfer(500, completed=True, success=True))
+        old = timezone.now() - datetime.timedelta(hours=2)
+        instances = [{'name': 'vm-done', 'zone': 'us-east1-b', 'created': old}]
+        with mock.patch.object(reaper, 'instance_name_prefixes', return_value=set(['vm'])), \
+            mock.patch.object(reaper, 'list_instances', return_value=instances), \
+            mock.patch.object(reaper, 'delete_instance') as mock_delete:
+            removed = reaper.reap_instances()
+        self.assertEqual(removed, instances)
+        mock_delete.assert_called_once_with(settings.CONFIG_PARAMS['google_project_id'], 'us-east1-b', 'vm-done')
+        self.assertEqual(LaunchAttempt.objects.get(instance_name='vm-done').status, LaunchAttempt.FINISHED)
+
+    def test_stale_transfers_fail(self):
+        '''
+        A 1GB transfer running for two hours is past its expected duration, while
+        a 100GB transfer is not, and a transfer still waiting for a VM is never stale
+        '''
+        stale = self.make_transfer(1e9, hours_ago=2)
+        self.make_attempt('vm-0', LaunchAttempt.DONE, stale)
+        large = self.make_transfer(100e9, hours_ago=2)
+        self.make_attempt('vm-1', LaunchAttempt.DONE, large)
+        waiting = self.make_transfer(1e9, hours_ago=2)
+        self.make_attempt('vm-2', LaunchAttempt.QUEUED, waiting)
+
+        with mock.patch.object(transfer_tasks.release_launches, 'apply_async') as mock_apply:
+            stale_pks, stale_checkpoints = reaper.reap_transfers()
+        self.assertEqual(stale_pks, [stale.pk,])
+        self.assertEqual(stale_checkpoints, [])
+        t = Transfer.objects.get(pk=stale.pk)
+        self.assertTrue(t.completed)
+        self.assertFalse(t.success)
+        self.assertIsNotNone(t.duration)
+        self.assertFalse(Transfer.objects.get(pk=large.pk).completed)
+        self.assertEqual(LaunchAttempt.objects.get(instance_name='vm-0').status, LaunchAttempt.FINISHED)
+        # the coordinator still has incomplete transfers:
+        self.assertFalse(TransferCoordinator.objects.get(pk=self.tc.pk).completed)
+
+    def test_wait_for_vm_is_not_counted(self):
+        '''
+        A transfer which waited under the VM caps is timed from when its VM was admitted
+        (or its pool job was leased), not from when it was created
+        '''
+        now = timezone.now()
+        launched = self.make_transfer(1e9, hours_ago=3)
+        self.make_attempt('vm-0', LaunchAttempt.DONE, launched, admitted=now - datetime.timedelta(minutes=10))
+        leased = self.make_transfer(1e9, hours_ago=3)
+        WorkerJob.objects.create(transfer=leased, pool='dropbox-upload', spec='{}', leased_by='vm-pool', 
+            lease_time=now - datetime.timedelta(minutes=10))
+        stale = self.make_transfer(1e9, hours_ago=3)
+        self.make_attempt('vm-1', LaunchAttempt.DONE, stale, admitted=now - datetime.timedelta(hours=2))
+        self.assertEqual(reaper.find_stale_transfers(now), ([stale.pk,], []))
+
+    def test_replacement_needs_its_own_checkpoint(self):
+        '''
+        After a preemption, the checkpoint only counts once the replacement VM has sent one.
+        Until then (and always, for a transfer which cannot resume), the expected duration applies.
+        '''
+        now = timezone.now()
+        resumable = self.make_transfer(100e9, hours_ago=3)
+        self.make_attempt('vm-0-p1', LaunchAttempt.DONE, resumable, admitted=now - datetime.timedelta(hours=1))
+        TransferCheckpoint.objects.create(transfer=resumable, state='{"offset": 10}', preemptions=1)
+        not_resumable = self.make_transfer(100e9, hours_ago=3)
+        self.make_attempt('vm-1-p1', LaunchAttempt.DONE, not_resumable, admitted=now - datetime.timedelta(hours=1))
+        TransferCheckpoint.objects.create(transfer=not_resumable, preemptions=1)
+        TransferCheckpoint.objects.update(updated=now - datetime.timedelta(hours=2))
+        self.assertEqual(reaper.find_stale_transfers(now), ([], []))
+
+        # the replacement checkpoints, and then goes quiet:
+        TransferCheckpoint.objects.filter(transfer=resumable).update(updated=now - datetime.timedelta(minutes=45))
+        self.assertEqual(reaper.find_stale_transfers(now), ([], [resumable.pk,]))
+
+    def test_quiet_spot_transfer_resumes(self):
+        transfer = self.make_transfer(100e9, hours_ago=2)
+        spec = {'instance_names': ['vm-0',], 'zone': 'us-east1-b', 'spot': True, 
+            'transfer_pks': [transfer.pk,], 'container_args': ['-pk', transfer.pk]}
+        self.make_attempt('vm-0', LaunchAttempt.DONE, transfer, spec=json.dumps(spec))
+        TransferCheckpoint.objects.create(transfer=transfer, state='{"offset": 10}')
+        TransferCheckpoint.objects.filter(transfer=transfer).update(updated=timezone.now() - datetime.timedelta(hours=1))
+
+        with mock.patch.object(transfer_tasks.release_launches, 'apply_async') as mock_apply:
+            stale_pks, stale_checkpoints = reaper.reap_transfers()
+        self.assertEqual(stale_pks, [])
+        self.assertEqual(stale_checkpoints, [transfer.pk,])
+        self.assertEqual(LaunchAttempt.objects.get(instance_name='vm-0-p1').status, LaunchAttempt.QUEUED)
+        self.assertFalse(Transfer.objects.get(pk=transfer.pk).completed)
+
+
+class LauncherTestCase(TestCase):
+    '''
+    Tests how the launchers turn a launch spec into VM requests, and how launches are recorded
+    '''
+
+    def setUp(self):
+        # the events published along the way go to a stand-in for redis:
+        self.redis_mock = mock.MagicMock()
+        patcher = mock.patch('transfer_app.events.get_redis', return_value=self.redis_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.regular_user = get_user_model().objects.create_user(email='reguser@gmail.com', password='abcd123!')
+        r1 = Resource.objects.create(
+            source='google_storage',
+            path='gs://a/b/reg_owned1.txt',
+            size=500,
+            owner=self.regular_user,
+        )
+        tc1 = TransferCoordinator.objects.create()
+        self.transfer = Transfer.objects.create(
+            download=True,
+            resource = r1,
+            destination = 'dropbox',
+            coordinator = tc1,
+            originator = self.regular_user
+        )
+        self.spec = {
+            'instance_names': ['worker-1',],
+            'project': 'my-project',
+            'zone': 'us-east1-b',
+            'scopes': 'https://www.googleapis.com/auth/cloud-platform',
+            'machine_type': 'g1-small',
+            'disk_size_gb': 20,
+            'disk_type': 'pd-ssd',
+            'docker_image': 'docker.io/foo/bar',
+            'transfer_pks': [self.transfer.pk,],
+            'container_args': ['-path', 'gs://a/b/reg_owned1.txt', '-stream']
+        }
+
+    def test_gcloud_command(self):
+        with mock.patch.dict('transfer_app.launchers.os.environ', {'GCLOUD': '/mock/bin/gcloud'}):
+            cmd = GoogleLauncher().render_command(self.spec, 'worker-1')
+        self.assertTrue(cmd.startswith('/mock/bin/gcloud beta compute --project=my-project'))
+        self.assertTrue('--boot-disk-size=20GB' in cmd)
+        self.assertTrue('--boot-disk-type=pd-ssd' in cmd)
+        self.assertTrue('--container-arg="-path" --container-arg="gs://a/b/reg_owned1.txt" --container-arg="-stream"' in cmd)
+
+    def test_api_inserts_single_instance(self):
+        url, body = GoogleComputeLauncher().request_body(self.spec)
+        self.assertTrue(url.endswith('/projects/my-project/zones/us-east1-b/instances'))
+        self.assertEqual(body['name'], 'worker-1')
+        self.assertEqual(body['machineType'], 'zones/us-east1-b/machineTypes/g1-small')
+        self.assertEqual(body['disks'][0]['initializeParams']['diskSizeGb'], '20')
+        self.assertEqual(body['disks'][0]['initializeParams']['diskType'], 'zones/us-east1-b/diskTypes/pd-ssd')
+        metadata = dict([(x['key'], x['value']) for x in body['metadata']['items']])
+        declaration = json.loads(metadata['gce-container-declaration'])
+        self.assertEqual(declaration['spec']['containers'][0]['args'], self.spec['container_args'])
+
+    def test_api_bulk_inserts_identical_instances(self):
+        self.spec['instance_names'] = ['worker-1', 'worker-2', 'worker-3']
+        url, body = GoogleComputeLauncher().request_body(self.spec)
+        self.assertTrue(url.endswith('/instances/bulkInsert'))
+        self.assertEqual(body['count'], 3)
+        self.assertEqual(sorted(body['perInstanceProperties'].keys()), self.spec['instance_names'])
+        self.assertEqual(body['instanceProperties']['machineType'], 'g1-small')
+
+    def test_launch_task_isolates_failure(self):
+        '''
+        A fanned-out launch that raises is recorded as a failed launch (failing its
+        Transfers) and reported to the chord, rather than raised
+        '''
+        broken_launcher = mock.MagicMock()
+        broken_launcher.return_value.go.side_effect = Exception('Invalid value for field machineType')
+        with mock.patch.dict(GoogleBase.launcher_classes, {'broken': broken_launcher}):
+            outcome = transfer_tasks.launch_vm(self.spec, 'broken')
+        self.assertEqual(outcome, 'failed')
+        self.assertEqual(LaunchAttempt.objects.get(instance_name='worker-1').status, LaunchAttempt.FAILED)
+        self.assertTrue(Transfer.objects.get(pk=self.transfer.pk).completed)
+
+    def test_launch_task_sends_spec(self):
+        launcher = mock.MagicMock()
+        with mock.patch.dict(GoogleBase.launcher_classes, {'mock': launcher}):
+            outcome = transfer_tasks.launch_vm(self.spec, 'mock')
+        self.assertEqual(outcome, 'sent')
+        attempt = LaunchAttempt.objects.get(instance_name='worker-1')
+        launcher.return_value.go.assert_called_once_with(dict(self.spec, attempt_pks={'worker-1': attempt.pk}))
+        self.assertEqual(launcher.return_value.wait.call_count, 1)
+
+    def test_spot_instances(self):
+        self.spec['spot'] = True
+        with mock.patch.dict('transfer_app.launchers.os.environ', {'GCLOUD': '/mock/bin/gcloud'}):
+            cmd = GoogleLauncher().render_command(self.spec, 'worker-1')
+        self.assertTrue('--provisioning-model=SPOT --instance-termination-action=DELETE' in cmd)
+        url, body = GoogleComputeLauncher().request_body(self.spec)
+        self.assertEqual(body['scheduling']['provisioningModel'], 'SPOT')
+        self.assertEqual(body['scheduling']['instanceTerminationAction'], 'DELETE')
+
+    def test_failed_launch_fails_transfers(self):
+        record_launch(self.spec, LaunchAttempt.FAILED, error='quota exceeded')
+        attempt = LaunchAttempt.objects.get(instance_name='worker-1')
+        self.assertEqual(attempt.status, LaunchAttempt.FAILED)
+        self.assertEqual(list(attempt.transfers.all()), [self.transfer,])
+        transfer = Transfer.objects.get(pk=self.transfer.pk)
+        self.assertTrue(transfer.completed)
+        self.assertFalse(transfer.success)
+
+    def test_pending_launch_waits_on_operation(self):
+        record_launch(self.spec, LaunchAttempt.PENDING, operation='operation-123')
+        self.assertEqual(LaunchAttempt.objects.get(instance_name='worker-1').operation, 'operation-123')
+        self.assertFalse(Transfer.objects.get(pk=self.transfer.pk).completed)
+
+    def test_local_launcher_marks_outcomes(self):
+        '''
+        The local launcher runs the worker script here and records the outcome the worker
+        reports, as the TransferComplete view would.  A transfer the worker never reports
+        on (here, since its args are rejected) is marked as failed.
+        '''
+        worker_script = '''
+import argparse
+WORKING_DIR = '/workspace'
+def notify_master(params, error=False):
+	raise Exception('Should not call back to the application')
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-pk", dest='transfer_pk', required=True)
+	parser.add_argument("-path", dest='resource_path', required=True)
+	params = vars(parser.parse_args(argv))
+	params['manifest'] = None
+	return params
+def run_transfer(params):
+	notify_master(params, error=(params['resource_path'] == 'bad'))
+'''
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        script_path = os.path.join(tmp_dir, 'container_startup.py')
+        with open(script_path, 'w') as fout:
+            fout.write(worker_script)
+
+        r1 = self.transfer.resource
+        transfers = [self.transfer,]
+        for i in range(2):
+            transfers.append(Transfer.objects.create(download=True, resource=r1, destination='dropbox', 
+                coordinator=self.transfer.coordinator, originator=self.regular_user))
+
+        launcher = LocalLauncher(script_path, 2)
+        launcher.go(dict(self.spec, transfer_pks=[transfers[0].pk,], container_args=['-pk', transfers[0].pk, '-path', 'good']))
+        launcher.go(dict(self.spec, transfer_pks=[transfers[1].pk,], container_args=['-pk', transfers[1].pk, '-path', 'bad']))
+        launcher.go(dict(self.spec, transfer_pks=[transfers[2].pk,], container_args=['-pk', transfers[2].pk]))
+        launcher.wait()
+
+        results = [Transfer.objects.get(pk=x.pk) for x in transfers]
+        self.assertTrue(all([x.completed for x in results]))
+        self.assertEqual([x.success for x in results], [True, False, False])
+        self.assertTrue(TransferCoordinator.objects.get(pk=self.transfer.coordinator.pk).completed)
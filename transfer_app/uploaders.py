@@ -5,15 +5,19 @@ import copy
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 from django.urls import reverse
 from django.contrib.sites.models import Site
 
 from transfer_app.base import GoogleBase, AWSBase
 import transfer_app.utils as utils
+import transfer_app.events as events
 from transfer_app.models import Resource, Transfer, TransferCoordinator
 import transfer_app.serializers as serializers
 import transfer_app.exceptions as exceptions
 from transfer_app.launchers import GoogleLauncher, AWSLauncher
+import transfer_app.launchers as _launchers
+from transfer_app.sizing import get_sizing_policy
 
 class Uploader(object):
 
@@ -22,8 +26,10 @@ class Uploader(object):
     # should be added to the child class under 'required_keys' class member
     required_keys = ['name', ]
 
-    def __init__(self, upload_data):
+    def __init__(self, upload_data, batch_id=None):
         self.upload_data = upload_data
+        # the id given to the batch when it was submitted (see submissions.py), if any
+        self.batch_id = batch_id
 
     @classmethod
     def get_config(cls, config_filepath):
@@ -84,45 +90,54 @@ class Uploader(object):
         item in the list is a dict.  Each dict NEEDS to have 'owner', 'destination', and
         'path' among the keys
         '''
-        if len(self.upload_data) > 0:
-            tc = TransferCoordinator()
-            tc.save()
-        else:
+        if len(self.upload_data) == 0:
             return
 
-        for item in self.upload_data:
-            owner = get_user_model().objects.get(pk=item['owner'])
-            originator = get_user_model().objects.get(pk=item['originator'])
+        # look up all the users at once, rather than per item:
+        user_pks = set([x['owner'] for x in self.upload_data] + [x['originator'] for x in self.upload_data])
+        users = get_user_model().objects.in_bulk(user_pks)
+        if len(users) < len(user_pks):
+            raise get_user_model().DoesNotExist('Unknown user(s): %s' % ', '.join([str(x) for x in user_pks if x not in users]))
 
-            try:
-                filesize_in_bytes = item['size_in_bytes']
-            except KeyError as e:
-                filesize_in_bytes =  0
+        for item in self.upload_data:
+            if not 'size_in_bytes' in item:
                 item['size_in_bytes'] = 0
 
-            r = Resource(
-                source = self.source,
-                path = item['path'],
-                name = item['name'],
-                owner = owner,
-                size = filesize_in_bytes,
-                is_active=False # otherwise it will present the file for re-download
-            )
-            r.save()
-
-            t = Transfer(
-                 download=False,
-                 resource=r,
-                 destination=item['destination'],
-                 coordinator=tc,
-                 originator = originator
+        with transaction.atomic():
+            tc = TransferCoordinator(batch_id=self.batch_id,
+                total_transfers=len(self.upload_data),
+                total_bytes=int(sum([x['size_in_bytes'] for x in self.upload_data]))
             )
-            t.save()
+            tc.save()
 
-            # finally add the transfer primary key to the dictionary so we will
-            # be able to track the transfers
+            resources = [Resource(
+                    source = self.source,
+                    path = item['path'],
+                    name = item['name'],
+                    owner = users[item['owner']],
+                    size = item['size_in_bytes'],
+                    is_active=False # otherwise it will present the file for re-download
+                ) for item in self.upload_data]
+            # (each Resource gets its own date_added, so with the owner and path it is found again)
+            utils.bulk_create_with_pks(Resource, resources, ('owner', 'path', 'date_added'))
+
+            transfers = [Transfer(
+                    download=False,
+                    resource=r,
+                    destination=item['destination'],
+                    coordinator=tc,
+                    originator = users[item['originator']]
+                ) for item, r in zip(self.upload_data, resources)]
+            utils.bulk_create_with_pks(Transfer, transfers, ('coordinator', 'resource'))
+
+        # finally add the transfer primary key to the dictionary so we will
+        # be able to track the transfers
+        for item, t in zip(self.upload_data, transfers):
             item['transfer_pk'] = t.pk
 
+        events.publish_transfers([t.pk for t in transfers])
+        events.publish_batch(tc)
+
 
 class DropboxUploader(Uploader):
     '''
@@ -246,10 +261,9 @@ class EnvironmentSpecificUploader(object):
     config_key_list = []
     config_file = settings.UPLOADER_CONFIG['CONFIG_PATH']
 
-    def __init__(self, upload_data):
+    def __init__(self, upload_data, batch_id=None):
         #instantiate the wrapped classes:
-        self.uploader = self.uploader_cls(upload_data)
-        self.launcher = self.launcher_cls()
+        self.uploader = self.uploader_cls(upload_data, batch_id)
 
         # get the config params for the uploader:
         uploader_cfg = self.uploader_cls.get_config(self.config_file)
@@ -257,6 +271,9 @@ class EnvironmentSpecificUploader(object):
         uploader_cfg.update(additional_cfg)
         self.config_params = uploader_cfg
 
+        # the config can choose how VMs are started, so this comes after loading it
+        self.launcher = self._create_launcher()
+
     @classmethod
     def check_format(cls, upload_info, uploader_pk):
         return cls.uploader_cls.check_format(upload_info, uploader_pk)
@@ -268,16 +285,6 @@ class EnvironmentSpecificUploader(object):
 
 class GoogleEnvironmentUploader(EnvironmentSpecificUploader, GoogleBase):
 
-    gcloud_cmd_template = '''{gcloud} beta compute --project={google_project_id} instances \
-                             create-with-container {instance_name} \
-                             --zone={google_zone} \
-                             --scopes={scopes} \
-                             --machine-type={machine_type} \
-                             --boot-disk-size={disk_size_gb}GB \
-                             --metadata=google-logging-enabled=true \
-                             --container-image={docker_image} \
-                             --no-restart-on-failure --container-restart-policy=never \
-                           '''
 
     @classmethod
     def check_format(cls, upload_info, uploader_pk):
@@ -328,8 +335,10 @@ class GoogleEnvironmentUploader(EnvironmentSpecificUploader, GoogleBase):
         Each item in self.upload_data has a key of 'destination'.  If any existing, INCOMPLETE
         transfers have the same destination, then we block it.
         '''
-        all_incomplete_transfers = Transfer.objects.filter(completed=False)
-        destinations = [x.destination for x in all_incomplete_transfers]
+        # only the incomplete transfers to the requested destinations are fetched (see the 
+        # indexes on Transfer):
+        requested_destinations = [x['destination'] for x in upload_data]
+        destinations = set(Transfer.objects.filter(completed=False, destination__in=requested_destinations).values_list('destination', flat=True))
         new_transfers = []
         error_messages = []
         for item in upload_data:
@@ -343,94 +352,145 @@ class GoogleEnvironmentUploader(EnvironmentSpecificUploader, GoogleBase):
 
         return new_transfers, error_messages
 
-    def __init__(self, upload_data):
-        self.config_key_list.extend(GoogleBase.config_keys)
-        super().__init__(upload_data)
-
-    def _prep_single_upload(self, custom_config, index, item):
-
-        disk_size_factor = float(custom_config['disk_size_factor'])
-        min_disk_size = int(float(custom_config['min_disk_size']))
+    def __init__(self, upload_data, batch_id=None):
+        self.config_key_list = self.config_key_list + GoogleBase.config_keys
+        super().__init__(upload_data, batch_id)
 
+    def _prep_instance(self, custom_config, instance_name, items):
+        '''
+        Builds the launch spec for the worker VM named `instance_name` which will run the 
+        transfers in `items` (a list of the item dicts).  The spec is a dict describing the
+        machine and the container, and is turned into an actual VM by the launcher.  
+        Its container args are those common to every transfer; the caller adds the 
+        per-transfer args.
+        '''
         # construct a callback so the worker can communicate back to the application server:
         callback_url = reverse('transfer-complete')
         current_site = Site.objects.get_current()
         domain = current_site.domain
         full_callback_url = 'https://%s%s' % (domain, callback_url)
 
-        docker_image = custom_config['docker_image']
+        # the machine and disk are chosen by the sizing policy:
+        stream = utils.get_boolean(custom_config, 'stream_transfers')
+        shape = get_sizing_policy(custom_config).choose(items, False, self.uploader_cls.source)
+
+        spec = {
+            'instance_names': [instance_name,],
+            'project': settings.CONFIG_PARAMS['google_project_id'],
+            'zone': settings.CONFIG_PARAMS['google_zone'],
+            'scopes': custom_config['scopes'],
+            'machine_type': shape['machine_type'],
+            'disk_type': shape['disk_type'],
+            'disk_size_gb': shape['disk_size_gb'],
+            'docker_image': custom_config['docker_image'],
+            'transfer_pks': [],
+        }
 
+        # These should be common to all google-environment activity.  
+        # Args specific to the particular uploader should be handled in the subclass
+        spec['container_args'] = [
+            '-token', settings.CONFIG_PARAMS['token'],
+            '-key', settings.CONFIG_PARAMS['enc_key'],
+            '-url', full_callback_url,
+            '-proj', settings.CONFIG_PARAMS['google_project_id'],
+            '-zone', settings.CONFIG_PARAMS['google_zone'],
+            '-composite_threshold', custom_config['composite_threshold_mb'],
+            '-composite_parts', custom_config['composite_parts'],
+        ]
+        if stream:
+            spec['container_args'].append('-stream')
+        return spec
 
-        instance_name = '%s-%s-%s' % (custom_config['instance_name_prefix'], \
-           datetime.datetime.now().strftime('%m%d%y%H%M%S'), \
-           index
-        )
+    def config_and_start_uploads(self):
 
-        # approx size in Gb so we can size the VM appropriately
-        size_in_gb = item['size_in_bytes']/1e9
-        target_disk_size = int(disk_size_factor*size_in_gb)
-        if target_disk_size < min_disk_size:
-            target_disk_size = min_disk_size
-
-        # fill out the template command:
-        cmd = self.gcloud_cmd_template.format(gcloud=os.environ['GCLOUD'],
-                google_project_id = settings.CONFIG_PARAMS['google_project_id'],
-                google_zone = settings.CONFIG_PARAMS['google_zone'],
-                instance_name = instance_name,
-                scopes = custom_config['scopes'],
-                machine_type = custom_config['machine_type'],
-                disk_size_gb = target_disk_size,
-                docker_image = custom_config['docker_image']
-        )
+        custom_config = copy.deepcopy(self.config_params)
 
-        # Since these are passed via the gcloud command, the arg strings are a bit strange
-        # These should be common to all google-environment activity.  
-        # Args specific to the particular uploader should be handled in the subclass
-        cmd += ' --container-arg="-token" --container-arg="%s"' % settings.CONFIG_PARAMS['token']
-        cmd += ' --container-arg="-key" --container-arg="%s"' % settings.CONFIG_PARAMS['enc_key']
-        cmd += ' --container-arg="-pk" --container-arg="%s"' % item['transfer_pk']
-        cmd += ' --container-arg="-url" --container-arg="%s"' % full_callback_url
-        cmd += ' --container-arg="-proj" --container-arg="%s"' % settings.CONFIG_PARAMS['google_project_id']
-        cmd += ' --container-arg="-zone" --container-arg="%s"' % settings.CONFIG_PARAMS['google_zone']
-        return cmd
+        items = self.uploader.upload_data
+
+        # the smallest transfers are run right here, which is much faster than starting a VM:
+        local_items, items = self._split_local_items(custom_config, items)
+
+        # small transfers can go to the warm pool, if it is enabled:
+        if self._pool_enabled(custom_config):
+            pool_items, items = self._split_pool_items(custom_config, items)
+            if len(pool_items) > 0:
+                self._queue_for_pool(custom_config, pool_items)
+
+        # decide which of the remaining transfers share a VM:
+        groups = _launchers.group_transfers(items, 
+            int(custom_config['batch_max_items']),
+            float(custom_config['batch_max_size_gb'])*1e9
+        )
+        specs = []
+        for i, items in enumerate(groups):
+            instance_name = self._instance_name(custom_config, i)
+            spec = self._prep_instance(custom_config, instance_name, items)
+            spec['container_args'].extend(self._transfer_args(custom_config, items))
+            spec['transfer_pks'] = [x['transfer_pk'] for x in items]
+            if self._use_spot(custom_config, items):
+                spec['spot'] = True
+                spec['container_args'].extend(self._spot_args(custom_config))
+            self._record_shape(spec)
+            specs.append(spec)
+        self._launch_all(custom_config, specs)
+
+        # the VMs start up while the local transfers run:
+        if len(local_items) > 0:
+            self._run_locally(custom_config, local_items)
 
 class GoogleDropboxUploader(GoogleEnvironmentUploader):
     uploader_cls = DropboxUploader
     config_keys = ['dropbox_in_google',]
+    worker_script = os.path.join('startup_scripts', 'google', 'uploads', 'dropbox', 'container_startup.py')
 
-    def __init__(self, upload_data):
-        self.config_key_list.extend(GoogleDropboxUploader.config_keys)
-        super().__init__(upload_data)
+    # maps the worker's parameter names to its command-line flags
+    worker_flags = {
+        'transfer_pk': '-pk',
+        'resource_path': '-path',
+        'destination': '-destination'
+    }
 
-    def config_and_start_uploads(self):
+    def __init__(self, upload_data, batch_id=None):
+        self.config_key_list = self.config_key_list + GoogleDropboxUploader.config_keys
+        super().__init__(upload_data, batch_id)
 
-        custom_config = copy.deepcopy(self.config_params)
+    def _prep_instance(self, custom_config, instance_name, items):
+        spec = super()._prep_instance(custom_config, instance_name, items)
+        spec['container_args'].extend(['-connections', custom_config['download_connections']])
+        return spec
 
-        for i, item in enumerate(self.uploader.upload_data):
-            cmd = self._prep_single_upload(custom_config, i, item)
-            cmd += ' --container-arg="-path" --container-arg="%s"' % item['path'] # the special Dropbox link
-            cmd += ' --container-arg="-destination" --container-arg="%s"' % item['destination'] # the destination (in storage)
-            self.launcher.go(cmd)
+    def _manifest_entry(self, custom_config, item):
+        return {
+            'transfer_pk': item['transfer_pk'],
+            'resource_path': item['path'], # the special Dropbox link
+            'destination': item['destination'] # the destination (in storage)
+        }
  
 
 class GoogleDriveUploader(GoogleEnvironmentUploader):
     uploader_cls = DriveUploader
     config_keys = ['drive_in_google',]
+    worker_script = os.path.join('startup_scripts', 'google', 'uploads', 'google_drive', 'container_startup.py')
+
+    # maps the worker's parameter names to its command-line flags
+    worker_flags = {
+        'transfer_pk': '-pk',
+        'access_token': '-drive_token',
+        'file_id': '-file_id',
+        'destination': '-destination'
+    }
 
-    def __init__(self, upload_data):
-        self.config_key_list.extend(GoogleDriveUploader.config_keys)
-        super().__init__(upload_data)
-
-    def config_and_start_uploads(self):
-
-        custom_config = copy.deepcopy(self.config_params)
+    def __init__(self, upload_data, batch_id=None):
+        self.config_key_list = self.config_key_list + GoogleDriveUploader.config_keys
+        super().__init__(upload_data, batch_id)
 
-        for i, item in enumerate(self.uploader.upload_data):
-            cmd = self._prep_single_upload(custom_config, i, item)
-            cmd += ' --container-arg="-drive_token" --container-arg="%s"' % item['drive_token'] # the token for accessing drive
-            cmd += ' --container-arg="-file_id" --container-arg="%s"' % item['file_id'] # the unique file ID
-            cmd += ' --container-arg="-destination" --container-arg="%s"' % item['destination'] # the destination (in storage)
-            self.launcher.go(cmd)
+    def _manifest_entry(self, custom_config, item):
+        return {
+            'transfer_pk': item['transfer_pk'],
+            'access_token': item['drive_token'], # the token for accessing drive
+            'file_id': item['file_id'], # the unique file ID
+            'destination': item['destination'] # the destination (in storage)
+        }
 
 
 class AWSEnvironmentUploader(EnvironmentSpecificUploader):
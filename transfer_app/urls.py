@@ -25,6 +25,7 @@ urlpatterns = [
     re_path(r'^resources/$', views.ResourceList.as_view(), name='resource-list'),
     re_path(r'^resources/(?P<pk>[0-9]+)/$', views.ResourceDetail.as_view(), name='resource-detail'),
     re_path(r'^resources/user/(?P<user_pk>[0-9]+)/$', views.UserResourceList.as_view(), name='user-resource-list'),
+    re_path(r'^resources/sync/$', views.ResourceSync.as_view(), name='resource-sync'),
 
     # endpoints related to querying Transfers:
     re_path(r'^transfers/$', views.TransferList.as_view(), name='transfer-list'),
@@ -32,6 +33,7 @@ urlpatterns = [
     re_path(r'^transfers/download/init/$', views.InitDownload.as_view(), name='download-transfer-initiation'),
     re_path(r'^transfers/(?P<pk>[0-9]+)/$', views.TransferDetail.as_view(), name='transfer-detail'),
     re_path(r'^transfers/user/(?P<user_pk>[0-9]+)/$', views.UserTransferList.as_view(), name='user-transfer-list'),
+    re_path(r'^transfers/sync/$', views.TransferSync.as_view(), name='transfer-sync'),
     re_path(r'^transferred-resources/$', views.TransferredResourceList.as_view(), name='transferred-resource-list'),
 
     # endpoints related to querying TransferCoordinators, so we can group the Transfer instances
@@ -44,6 +46,11 @@ urlpatterns = format_suffix_patterns(urlpatterns)
 urlpatterns.extend([
     # endpoints for communicating from worker machines:
     re_path(r'^transfers/complete/$', views.TransferComplete.as_view(), name='transfer-complete'),
+    re_path(r'^transfers/lease/$', views.WorkerLease.as_view(), name='worker-lease'),
+    re_path(r'^transfers/checkpoint/$', views.WorkerCheckpoint.as_view(), name='transfer-checkpoint'),
+
+    # a stream of the changes to a user's transfers, for the front page:
+    re_path(r'^transfers/events/$', views.TransferEvents.as_view(), name='transfer-events'),
 
     # endpoints for callbacks:
     re_path(r'^dropbox/callback/$', DropboxDownloader.finish_authentication_and_start_download, name='dropbox_token_callback'),
@@ -1,5 +1,8 @@
 import configparser
 import os
+import datetime
+import json
+import base64
 import sys
 
 from jinja2 import Environment, FileSystemLoader
@@ -7,9 +10,13 @@ from jinja2 import Environment, FileSystemLoader
 from django.conf import settings
 from django.http import Http404
 from django.contrib.sites.models import Site
+from django.utils import timezone
+from django.db import connection, transaction
+from django.db.models import F, Value, ExpressionWrapper, DateTimeField, DurationField
 
-from transfer_app.models import Resource, Transfer, TransferCoordinator
-import transfer_app.launchers as _launchers
+from transfer_app.models import Resource, Transfer, TransferCoordinator, WorkerJob
+import transfer_app.scheduler as scheduler
+import transfer_app.events as events
 
 sys.path.append(os.path.realpath('helpers'))
 from email_utils import send_email
@@ -37,6 +44,174 @@ def load_config(config_filepath, config_keys=[]):
     return d
 
 
+def get_boolean(config_params, key, default=False):
+    '''
+    Values loaded by load_config are strings.  This interprets the
+    value under `key` as a boolean (e.g. "True", "yes", "1")
+    If the key is not present, returns `default`
+    '''
+    try:
+        value = config_params[key]
+    except KeyError as ex:
+        return default
+    try:
+        return configparser.ConfigParser.BOOLEAN_STATES[str(value).strip().lower()]
+    except KeyError as ex:
+        raise ValueError('Could not interpret the value "%s" for %s as a boolean' % (value, key))
+
+
+def encode_manifest(entries):
+    '''
+    Encodes a list of dicts (one per transfer) so it can be passed to a 
+    worker as a single command-line argument.  The worker decodes it with
+    json.loads(base64.b64decode(...))
+    '''
+    return base64.b64encode(json.dumps(entries).encode('utf-8')).decode('utf-8')
+
+
+def bulk_create_with_pks(model, instances, key_fields):
+    '''
+    Creates the model instances with bulk inserts and sets their primary keys, which
+    not every database returns from a bulk insert (e.g. sqlite, MySQL).  There, the new
+    rows are read back by the values of key_fields, which must only match rows created here:
+    e.g. a foreign key to an object created in the same transaction, or an auto_now_add
+    timestamp (which bulk_create sets on the instances).  Instances with the same key 
+    get their rows in the order they were inserted.
+    Must be called inside a transaction (transaction.atomic).  Returns the list of instances.
+    '''
+    model.objects.bulk_create(instances)
+    # (the name of this feature flag differs between Django versions)
+    features = connection.features
+    returns_pks = getattr(features, 'can_return_rows_from_bulk_insert', getattr(features, 'can_return_ids_from_bulk_insert', False))
+    if (len(instances) == 0) or returns_pks:
+        return instances
+    attnames = [model._meta.get_field(x).attname for x in key_fields]
+    get_key = lambda obj: tuple([getattr(obj, x) for x in attnames])
+    query = dict([('%s__in' % x, set([getattr(obj, x) for obj in instances])) for x in attnames])
+    rows = {}
+    for values in model.objects.filter(**query).order_by('pk').values_list('pk', *attnames):
+        rows.setdefault(tuple(values[1:]), []).append(values[0])
+    for instance in instances:
+        instance.pk = rows[get_key(instance)].pop(0)
+    return instances
+
+
+def lease_worker_job(pool, worker_name):
+    '''
+    Hands the oldest waiting job in `pool` to the worker named `worker_name`.
+    Several workers can ask at the same time, so the job is claimed with a 
+    conditional update.  If another worker claimed it first, we move on to the next.
+    Returns the leased WorkerJob, or None if no job is waiting.
+    '''
+    waiting_jobs = WorkerJob.objects.filter(pool=pool, leased_by__isnull=True).order_by('created', 'pk')
+    for job in waiting_jobs[:10]:
+        claimed = WorkerJob.objects.filter(pk=job.pk, leased_by__isnull=True).update(
+            leased_by=worker_name, 
+            lease_time=timezone.now()
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+    return None
+
+
+def mark_transfer_complete(transfer_obj, success):
+    '''
+    Marks the Transfer as completed (successfully or not).  If that was the last 
+    incomplete Transfer managed by its TransferCoordinator, the coordinator is
+    marked complete as well and the originators are notified.
+
+    A Transfer that is already complete (e.g. its worker reported twice) is left as is.
+    '''
+    now = timezone.now()
+    duration = now - transfer_obj.start_time
+    with transaction.atomic():
+        newly_completed = Transfer.objects.filter(pk=transfer_obj.pk, completed=False).update(completed=True, 
+            success=success, 
+            finish_time=now, 
+            duration=duration
+        )
+        if newly_completed:
+            batch_completed = count_completions(transfer_obj.coordinator_id, 1, int(bool(success)), transfer_obj.resource.size, now)
+    if not newly_completed:
+        return
+    transfer_obj.completed = True
+    transfer_obj.success = success
+    transfer_obj.finish_time = now
+    transfer_obj.duration = duration
+
+    # if a pool worker ran this transfer, the job is done:
+    WorkerJob.objects.filter(transfer=transfer_obj).delete()
+
+    # the VM may be done, making room for queued VMs:
+    scheduler.transfer_finished(transfer_obj)
+
+    events.publish_transfers([transfer_obj.pk,])
+    events.publish_batch(TransferCoordinator.objects.get(pk=transfer_obj.coordinator_id))
+
+    if batch_completed:
+        notify_originators(transfer_obj.coordinator)
+
+
+def mark_transfers_failed(transfer_pks):
+    '''
+    Marks the Transfers as completed (and unsuccessful) with a few bulk queries, rather
+    than one at a time as mark_transfer_complete does.  As there, coordinators whose
+    Transfers are now all complete are marked complete and the originators are notified.
+    '''
+    now = timezone.now()
+    duration = ExpressionWrapper(Value(now, output_field=DateTimeField()) - F('start_time'), output_field=DurationField())
+    completed_coordinators = []
+    with transaction.atomic():
+        rows = Transfer.objects.select_for_update().filter(pk__in=transfer_pks, completed=False).values_list('pk', 'coordinator', 'resource__size')
+        rows = list(rows)
+        transfer_pks = [x[0] for x in rows]
+        Transfer.objects.filter(pk__in=transfer_pks).update(completed=True, success=False, finish_time=now, duration=duration)
+
+        # the counts and bytes to add to each coordinator:
+        counts = {}
+        for pk, coordinator_pk, size in rows:
+            num_completed, num_bytes = counts.get(coordinator_pk, (0, 0))
+            counts[coordinator_pk] = (num_completed + 1, num_bytes + size)
+        for coordinator_pk, (num_completed, num_bytes) in counts.items():
+            if count_completions(coordinator_pk, num_completed, 0, num_bytes, now):
+                completed_coordinators.append(coordinator_pk)
+
+    # if pool workers were to run these transfers, the jobs are done:
+    WorkerJob.objects.filter(transfer__in=transfer_pks).delete()
+
+    # their VMs may be done, making room for queued VMs:
+    scheduler.transfers_finished(transfer_pks)
+
+    events.publish_transfers(transfer_pks)
+    for tc in TransferCoordinator.objects.filter(pk__in=counts.keys()):
+        events.publish_batch(tc)
+        if tc.pk in completed_coordinators:
+            notify_originators(tc)
+
+
+def count_completions(coordinator_pk, num_completed, num_succeeded, num_bytes, now):
+    '''
+    Adds newly completed Transfers to their TransferCoordinator's counts, and marks it
+    complete if that was the last of its Transfers.  Returns True only for the call
+    that completed the batch, so concurrent completions notify the originators once.
+    Should be called in the same transaction that marks the Transfers complete.
+    '''
+    coordinators = TransferCoordinator.objects.filter(pk=coordinator_pk)
+    coordinators.update(completed_transfers=F('completed_transfers') + num_completed,
+        succeeded_transfers=F('succeeded_transfers') + num_succeeded,
+        completed_bytes=F('completed_bytes') + num_bytes
+    )
+    # only one caller can see the count reach the total while the coordinator is incomplete:
+    return coordinators.filter(completed=False, completed_transfers__gte=F('total_transfers')).update(completed=True, 
+        finish_time=now) > 0
+
+
+def notify_originators(transfer_coordinator):
+    all_originators = list(Transfer.objects.filter(coordinator=transfer_coordinator).values_list('originator__email', flat=True).distinct())
+    post_completion(transfer_coordinator, all_originators)
+
+
 def post_completion(transfer_coordinator, originator_emails):
     '''
     transfer_coordinator is a TransferCoordinator instance
@@ -6,10 +6,13 @@ import httplib2
 
 from django.contrib.sites.models import Site
 from django.core.exceptions import ObjectDoesNotExist
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse
+from django.core.exceptions import PermissionDenied
+from django.views import View
 from django.conf import settings
 from django.shortcuts import render
 from django.contrib.auth.decorators import login_required
+from django.utils import timezone
 
 from rest_framework import generics, permissions, renderers, status
 from rest_framework.decorators import api_view
@@ -21,7 +24,7 @@ from rest_framework.views import exception_handler, APIView
 from django_filters.rest_framework import DjangoFilterBackend
 from django.contrib.auth import get_user_model
 
-from transfer_app.models import Resource, Transfer, TransferCoordinator
+from transfer_app.models import Resource, Transfer, TransferCoordinator, WorkerJob, PoolWorker, TransferCheckpoint, Tombstone
 from transfer_app.serializers import ResourceSerializer, \
      TransferSerializer, \
      TransferCoordinatorSerializer, \
@@ -29,10 +32,16 @@ from transfer_app.serializers import ResourceSerializer, \
      TransferredResourceSerializer
 
 import transfer_app.utils as utils
+import transfer_app.scheduler as scheduler
+import transfer_app.submissions as submissions
+import transfer_app.events as events
+import transfer_app.sync as sync
+import transfer_app.launchers as _launchers
 import transfer_app.exceptions as exceptions
 import transfer_app.tasks as transfer_tasks
 import transfer_app.uploaders as _uploaders
 import transfer_app.downloaders as _downloaders
+from transfer_app.pagination import ResourcePagination, TransferPagination, BatchPagination
 
 @login_required
 def index(request):
@@ -51,6 +60,31 @@ def api_root(request, format=None):
     })
 
 
+class OwnerScopedMixin(object):
+    '''
+    Limits a view's queryset to the objects the requesting user may see, as part of 
+    the query rather than by checking each object afterward.  Admins see everything.
+    
+    owner_lookup is the lookup from the model to the user it belongs to, and 
+    related_fields are the relations the serializer follows, which are joined in 
+    the same query.  For a detail view, an object outside the queryset gives a 404 
+    (rather than a 403, which would expose that it exists).
+    '''
+    owner_lookup = None
+    related_fields = ()
+
+    def scope_queryset(self, queryset, user):
+        return queryset.filter(**{self.owner_lookup: user})
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if not self.request.user.is_staff:
+            queryset = self.scope_queryset(queryset, self.request.user)
+        if len(self.related_fields) > 0:
+            queryset = queryset.select_related(*self.related_fields)
+        return queryset
+
+
 class UserList(generics.ListCreateAPIView):
     '''
     This allows:
@@ -78,7 +112,7 @@ class UserDetail(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = (permissions.IsAdminUser,)
     
 
-class ResourceList(generics.ListCreateAPIView):
+class ResourceList(OwnerScopedMixin, generics.ListCreateAPIView):
     '''
     This endpoint allows us to list or create Resources
     See methods below regarding listing logic and creation logic
@@ -86,21 +120,11 @@ class ResourceList(generics.ListCreateAPIView):
     '''
     queryset = Resource.objects.all()
     serializer_class = ResourceSerializer
+    pagination_class = ResourcePagination
     permission_classes = (permissions.IsAuthenticated,)
     filter_backends = (DjangoFilterBackend,)
     filter_fields = ('is_active',)
-    
-    def get_queryset(self):
-        '''
-        This overrides the get_queryset method of rest_framework.generics.GenericAPIView
-        This allows us to return only Resource instances belonging to the user.
-        If an admin is requesting, then we return all
-        '''
-        queryset = super(ResourceList, self).get_queryset()
-        if not self.request.user.is_staff:
-            queryset = Resource.objects.user_resources(self.request.user)
-        return queryset
-
+    owner_lookup = 'owner'
 
     def create(self, request, *args, **kwargs):
         '''
@@ -114,23 +138,48 @@ class ResourceList(generics.ListCreateAPIView):
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
 
-class ResourceDetail(generics.RetrieveUpdateDestroyAPIView):
+class ResourceDetail(OwnerScopedMixin, generics.RetrieveUpdateDestroyAPIView):
+    '''
+    Admins can get anything.  Regular users can only get objects they own, 
+    and get a 404 for others (see OwnerScopedMixin)
+    '''
     queryset = Resource.objects.all()
     serializer_class = ResourceSerializer
     permission_classes = (permissions.IsAuthenticated,)
+    owner_lookup = 'owner'
 
-    def get_object(self):
-        '''
-        Custom behavior for object retrieval- admins can get anything
-        Regular users can only get objects they own.  
-        Instead of the default 403 (which exposes that a particular object
-        does exist), return 404 if they are not allowed to access an object.
-        '''
-        obj = super(ResourceDetail, self).get_object()
-        if (self.request.user.is_staff) or (obj.get_owner() == self.request.user):
-            return obj
-        else:
-            raise Http404
+
+class SyncView(OwnerScopedMixin, generics.GenericAPIView):
+    '''
+    The changes since the client's last sync (see sync.py).  GET with the cursor
+    from the previous response as the 'cursor' query parameter, or without one the first time.
+    The number of changed rows (and of deletions) per response can be set with page_size.
+    '''
+    permission_classes = (permissions.IsAuthenticated,)
+
+    # the kind of Tombstone recording deletions of this view's model
+    tombstone_model_name = None
+
+    def get(self, request, *args, **kwargs):
+        tombstones = Tombstone.objects.filter(model_name=self.tombstone_model_name)
+        if not request.user.is_staff:
+            tombstones = tombstones.filter(user_pk=request.user.pk)
+        try:
+            limit = min(int(request.query_params.get('page_size', sync.PAGE_SIZE)), sync.MAX_PAGE_SIZE)
+        except ValueError:
+            raise exceptions.RequestError('page_size must be an integer.')
+        if limit < 1:
+            raise exceptions.RequestError('page_size must be positive.')
+        result = sync.changes(self.get_queryset(), tombstones, request.query_params.get('cursor'), limit, timezone.now())
+        result['results'] = self.get_serializer(result['results'], many=True).data
+        return Response(result)
+
+
+class ResourceSync(SyncView):
+    queryset = Resource.objects.all()
+    serializer_class = ResourceSerializer
+    owner_lookup = 'owner'
+    tombstone_model_name = Tombstone.RESOURCE
 
 
 class UserResourceList(generics.ListAPIView):
@@ -141,6 +190,7 @@ class UserResourceList(generics.ListAPIView):
     they can just use the "vanilla" listing endpoint
     '''
     serializer_class = ResourceSerializer
+    pagination_class = ResourcePagination
     permission_classes = (permissions.IsAdminUser,)
     filter_backends = (DjangoFilterBackend,)
     filter_fields = ('is_active',)
@@ -154,7 +204,7 @@ class UserResourceList(generics.ListAPIView):
             raise Http404
 
 
-class TransferList(generics.ListAPIView):
+class TransferList(OwnerScopedMixin, generics.ListAPIView):
     '''
     This only allows a listing.  Creation of Transfer objects
     is handled by a TransferCoordinator.  We cannot explicitly
@@ -163,43 +213,22 @@ class TransferList(generics.ListAPIView):
     '''
     queryset = Transfer.objects.all()
     serializer_class = TransferSerializer
+    pagination_class = TransferPagination
     permission_classes = (permissions.IsAuthenticated,)
     filter_backends = (DjangoFilterBackend,)
     filter_fields = ('completed', 'success', 'download')
-
-    def get_queryset(self):
-        '''
-        This overrides the get_queryset method of rest_framework.generics.GenericAPIView
-        This allows us to return only Transfer instances belonging to the user.
-        If an admin is requesting, then we return all
-        '''
-        queryset = super(TransferList, self).get_queryset()
-        if not self.request.user.is_staff:
-            queryset = Transfer.objects.user_transfers(self.request.user)
-        return queryset
+    owner_lookup = 'originator'
 
 
-class TransferDetail(generics.RetrieveAPIView):
+class TransferDetail(OwnerScopedMixin, generics.RetrieveAPIView):
     '''
     Here we allow only retrieval of objects.  We have no reason to edit or destroy
-    info about the Transfers
+    info about the Transfers.  Regular users can only get the Transfers they started.
     '''
     queryset = Transfer.objects.all()
     serializer_class = TransferSerializer
     permission_classes = (permissions.IsAuthenticated,)
-
-    def get_object(self):
-        '''
-        Custom behavior for object retrieval- admins can get anything
-        Regular users can only get objects they own.  
-        Instead of the default 403 (which exposes that a particular object
-        does exist), return 404 if they are not allowed to access an object.
-        '''
-        obj = super(TransferDetail, self).get_object()
-        if (self.request.user.is_staff) or (obj.originator == self.request.user):
-            return obj
-        else:
-            raise Http404
+    owner_lookup = 'originator'
 
 
 class UserTransferList(generics.ListAPIView):
@@ -210,6 +239,7 @@ class UserTransferList(generics.ListAPIView):
     they can just use the "vanilla" listing endpoint
     '''
     serializer_class = TransferSerializer
+    pagination_class = TransferPagination
     permission_classes = (permissions.IsAdminUser,)
     filter_backends = (DjangoFilterBackend,)
     filter_fields = ('completed', 'success', 'download')
@@ -223,7 +253,14 @@ class UserTransferList(generics.ListAPIView):
             raise Http404
 
 
-class TransferredResourceList(generics.ListAPIView):
+class TransferSync(SyncView):
+    queryset = Transfer.objects.all()
+    serializer_class = TransferSerializer
+    owner_lookup = 'originator'
+    tombstone_model_name = Tombstone.TRANSFER
+
+
+class TransferredResourceList(OwnerScopedMixin, generics.ListAPIView):
     '''
     This creates a shortcut API which effectively joins
     a Transfer with the Resource it wraps.  Mainly used to limit
@@ -231,15 +268,12 @@ class TransferredResourceList(generics.ListAPIView):
     '''
     queryset = Transfer.objects.all()
     serializer_class = TransferredResourceSerializer
+    pagination_class = TransferPagination
     permission_classes = (permissions.IsAuthenticated,)
+    owner_lookup = 'originator'
+    related_fields = ('resource',)
 
-    def get_queryset(self):
-        queryset = super(TransferredResourceList, self).get_queryset()
-        if not self.request.user.is_staff:
-            queryset = Transfer.objects.user_transfers(self.request.user)
-        return queryset
-
-class BatchList(generics.ListAPIView):
+class BatchList(OwnerScopedMixin, generics.ListAPIView):
     '''
     This only allows a listing of the TransferCoordinators.  
     Creation of TransferCoordinator objects is handled 
@@ -247,47 +281,29 @@ class BatchList(generics.ListAPIView):
     '''
     queryset = TransferCoordinator.objects.all()
     serializer_class = TransferCoordinatorSerializer
+    pagination_class = BatchPagination
     permission_classes = (permissions.IsAuthenticated,)
     filter_backends = (DjangoFilterBackend,)
-    filter_fields = ('completed',)
+    filter_fields = ('completed', 'batch_id')
 
-    def get_queryset(self):
-        '''
-        This overrides the get_queryset method of rest_framework.generics.GenericAPIView
-        This allows us to return only TransferCoordinator instances belonging to the user.
-        If an admin is requesting, then we return all instances
-        '''
-        queryset = super(BatchList, self).get_queryset()
-        if not self.request.user.is_staff:
-            queryset = TransferCoordinator.objects.user_transfer_coordinators(self.request.user)
-        return queryset
+    def scope_queryset(self, queryset, user):
+        return TransferCoordinator.objects.user_transfer_coordinators(user)
 
 
-class BatchDetail(generics.RetrieveAPIView):
+class BatchDetail(OwnerScopedMixin, generics.RetrieveAPIView):
     '''
     Here we allow only retrieval of objects.  We have no reason to edit or destroy
-    TransferCoordinators
+    TransferCoordinators.  Regular users can only get the batches whose files they own.
     '''
     queryset = TransferCoordinator.objects.all()
     serializer_class = TransferCoordinatorSerializer
     permission_classes = (permissions.IsAuthenticated,)
 
-    def get_object(self):
-        '''
-        Custom behavior for object retrieval- admins can get anything
-        Regular users can only get objects they own.  
-        Instead of the default 403 (which exposes that a particular object
-        does exist), return 404 if they are not allowed to access an object.
-        '''
-        obj = super(BatchDetail, self).get_object()
-        obj_owners = list(set([x.resource.owner for x in Transfer.objects.filter(coordinator = obj)]))
-        if len(obj_owners) == 1:            
-            if (self.request.user.is_staff) or (obj_owners[0] == self.request.user):
-                return obj
-            else:
-                raise Http404
-        else:
-            raise Http404
+    def scope_queryset(self, queryset, user):
+        # batches which have a file owned by this user, and none owned by anyone else:
+        owned = Transfer.objects.filter(resource__owner=user).values('coordinator')
+        others = Transfer.objects.exclude(resource__owner=user).values('coordinator')
+        return queryset.filter(pk__in=owned).exclude(pk__in=others)
 
 
 class UserBatchList(generics.ListAPIView):
@@ -298,6 +314,7 @@ class UserBatchList(generics.ListAPIView):
     they can just use the "vanilla" listing endpoint
     '''
     serializer_class = TransferCoordinatorSerializer
+    pagination_class = BatchPagination
     permission_classes = (permissions.IsAdminUser,)
     filter_backends = (DjangoFilterBackend,)
     filter_fields = ('completed',)
@@ -311,6 +328,21 @@ class UserBatchList(generics.ListAPIView):
             raise Http404
 
 
+def has_worker_token(data):
+    '''
+    Requests from worker machines carry the encrypted token they were given
+    at startup.  Returns True if the request data contains the proper token.
+    '''
+    if 'token' in data:
+        b64_enc_token = data['token']
+        enc_token = base64.decodestring(b64_enc_token.encode('ascii'))
+        expected_token = settings.CONFIG_PARAMS['token'] 
+        obj=DES.new(settings.CONFIG_PARAMS['enc_key'], DES.MODE_ECB)
+        decrypted_token = obj.decrypt(enc_token)
+        return decrypted_token == expected_token.encode('ascii')
+    return False
+
+
 class TransferComplete(APIView):
 
     permission_classes = (permissions.AllowAny,)
@@ -318,12 +350,7 @@ class TransferComplete(APIView):
     def post(self, request, format=None):    
         data = request.data
         if 'token' in data:
-            b64_enc_token = data['token']
-            enc_token = base64.decodestring(b64_enc_token.encode('ascii'))
-            expected_token = settings.CONFIG_PARAMS['token'] 
-            obj=DES.new(settings.CONFIG_PARAMS['enc_key'], DES.MODE_ECB)
-            decrypted_token = obj.decrypt(enc_token)
-            if decrypted_token == expected_token.encode('ascii'):
+            if has_worker_token(data):
                 # we can trust the content since it contained the proper token
                 try:
                     transfer_pk = data['transfer_pk']
@@ -332,27 +359,7 @@ class TransferComplete(APIView):
                     raise exceptions.RequestError('The request did not have the correct formatting.')  
                 try:
                     transfer_obj = Transfer.objects.get(pk=transfer_pk)
-                    transfer_obj.completed = True
-                    transfer_obj.success = success
-                    tz = transfer_obj.start_time.tzinfo
-                    now = datetime.datetime.now(tz)
-                    duration = now - transfer_obj.start_time
-                    transfer_obj.duration = duration
-                    transfer_obj.finish_time = now
-                    transfer_obj.save()
-
-                    # now check if all the Transfers belonging to this TransferCoordinator are complete:
-                    try:
-                        tc = transfer_obj.coordinator
-                    except ObjectDoesNotExist as ex:
-                        raise exceptions.RequestError('TransferCoordinator with pk=%d did not exist' % coordinator_pk)
-                    all_transfers = Transfer.objects.filter(coordinator = tc)
-                    if all([x.completed for x in all_transfers]):
-                        tc.completed = True
-                        tc.finish_time = datetime.datetime.now()
-                        tc.save()
-                        all_originators = list(set([x.originator.email for x in all_transfers]))
-                        utils.post_completion(tc, all_originators)
+                    utils.mark_transfer_complete(transfer_obj, success)
                     return Response({'message': 'thanks'})
                 except ObjectDoesNotExist as ex:
                     raise exceptions.RequestError('Transfer with pk=%d did not exist' % transfer_pk)
@@ -362,6 +369,100 @@ class TransferComplete(APIView):
             raise Http404
 
 
+class WorkerLease(APIView):
+    '''
+    Workers in a warm pool ask this endpoint for work.  The request gives the 
+    pool name and the worker's instance name.  The response has a job spec
+    (the parameters for a single transfer) or null if nothing is waiting.
+
+    A worker that has been idle past its timeout says so with 'idle'.  If there is still 
+    nothing to do, it is told to retire and is removed from the pool.
+    '''
+
+    permission_classes = (permissions.AllowAny,)
+
+    def post(self, request, format=None):
+        data = request.data
+        if not has_worker_token(data):
+            raise Http404
+        try:
+            pool = data['pool']
+            worker_name = data['worker']
+        except KeyError as ex:
+            raise exceptions.RequestError('The request did not have the correct formatting.')
+        idle = str(data.get('idle', 0)).lower() in ('1', 'true')
+
+        job = utils.lease_worker_job(pool, worker_name)
+        if job is not None:
+            PoolWorker.objects.filter(instance_name=worker_name).update(last_seen=timezone.now())
+            return Response({'job': json.loads(job.spec)})
+        elif idle:
+            PoolWorker.objects.filter(instance_name=worker_name).delete()
+            scheduler.workers_finished([worker_name,])
+            return Response({'job': None, 'retire': True})
+        else:
+            # a worker we did not start (or had given up on) is still part of the pool
+            PoolWorker.objects.update_or_create(instance_name=worker_name, 
+                defaults={'pool': pool, 'last_seen': timezone.now()}
+            )
+            return Response({'job': None})
+
+
+class WorkerCheckpoint(APIView):
+    '''
+    Workers on Spot VMs send the state of their transfer here every so often (as JSON in 'state'),
+    and once more with 'preempted' when the VM is being preempted.  A preempted transfer is
+    moved to a replacement VM, which resumes from the last state.
+    '''
+
+    permission_classes = (permissions.AllowAny,)
+
+    def post(self, request, format=None):
+        data = request.data
+        if not has_worker_token(data):
+            raise Http404
+        try:
+            transfer_pk = data['transfer_pk']
+            state = json.loads(data['state'])
+        except (KeyError, ValueError) as ex:
+            raise exceptions.RequestError('The request did not have the correct formatting.')
+        preempted = str(data.get('preempted', 0)).lower() in ('1', 'true')
+
+        try:
+            transfer_obj = Transfer.objects.get(pk=transfer_pk)
+        except ObjectDoesNotExist as ex:
+            raise exceptions.RequestError('Transfer with pk=%s did not exist' % transfer_pk)
+
+        # a worker preempted before its first checkpoint has no state to send:
+        if state is not None:
+            TransferCheckpoint.objects.update_or_create(transfer=transfer_obj, defaults={'state': json.dumps(state)})
+        if preempted and not transfer_obj.completed:
+            _launchers.relaunch_preempted(transfer_obj)
+        return Response({'message': 'thanks'})
+
+
+class TransferEvents(View):
+    '''
+    A stream of server-sent events (text/event-stream) with the changes to the requesting
+    user's Transfers and batches, as they happen (see events.py).  This is a plain Django
+    view since the browser asks for text/event-stream, which the API renderers do not produce.
+    '''
+
+    def get(self, request):
+        if not request.user.is_authenticated:
+            raise PermissionDenied
+        heartbeat_seconds = float(settings.CONFIG_PARAMS.get('event_heartbeat_seconds', 15))
+        max_seconds = float(settings.CONFIG_PARAMS.get('event_stream_max_seconds', 300))
+        # a reconnecting browser sends the id of the last event it got (see events.replay):
+        last_event_id = request.META.get('HTTP_LAST_EVENT_ID')
+        response = StreamingHttpResponse(events.stream(request.user.pk, heartbeat_seconds, max_seconds, last_event_id), 
+            content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # otherwise nginx holds the events back until its buffer fills:
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
 class InitDownload(generics.CreateAPIView):
     '''
     This endpoint is where we POST data for the creation of 
@@ -445,9 +546,11 @@ class InitUpload(generics.CreateAPIView):
             if len(error_messages) > 0:
                 return Response({'errors': error_messages})
             elif len(upload_info) > 0:
-                # call async method:
-                transfer_tasks.upload.delay(upload_info, upload_source)
-                return Response({})
+                # call async method.  A repeat of a recent submission (e.g. a double-click)
+                # gets back the batch that was already submitted.  Either way, the batch can
+                # be found with the batch_id filter of the batch listing:
+                batch_id, submitted = submissions.submit_once(transfer_tasks.upload, upload_info, upload_source, user_pk)
+                return Response({'batch_id': batch_id, 'duplicate': not submitted})
             else: # no errors, but also nothing to do...
                 return Response({})
         except exceptions.ExceptionWithMessage as ex: